@@ -0,0 +1,102 @@
+"""
+Пиковая память сборки датасета для Word2Vec.
+
+История генерируется в одном процессе, а create_dataset каждой конфигурации запускается
+в отдельном свежем процессе, чтобы пики не складывались. Печатает JSON со временем
+и пиковым RSS процесса (ru_maxrss): до сборки (импорт библиотек) и после нее.
+
+    python benchmarks/dataset_memory.py --events 1000000 10000000 --history-limit 0 50
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'regular_pipeline'), os.path.join(ROOT, 'utils')]
+
+
+def peak_rss_mb():
+    # в linux ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_history(store, n_events, n_users, n_items, chunk_size=1_000_000, seed=42):
+    import numpy as np
+    import polars as pl
+
+    rng = np.random.default_rng(seed)
+    t_start = 1.7e9
+    for offset in range(0, n_events, chunk_size):
+        n = min(chunk_size, n_events - offset)
+        # популярность фильмов по закону Ципфа, как в MovieLens
+        items = np.minimum(rng.zipf(1.3, n), n_items)
+        store.append(pl.DataFrame({
+            'user_id': rng.integers(0, n_users, n).astype(str),
+            'item_id': items.astype(str),
+            'action': np.where(rng.random(n) < 0.8, 'like', 'dislike'),
+            'timestamp': t_start + np.sort(rng.uniform(0, 86400, n)) + offset,
+        }))
+
+
+def generate(config):
+    os.chdir(config['workdir'])
+    from interaction_store import InteractionStore
+
+    write_history(InteractionStore('./data/interactions'), config['events'], config['users'], config['items'])
+
+
+def measure(config, result):
+    os.chdir(config['workdir'])
+    import ml_model
+    from interaction_store import InteractionStore
+
+    ml_model.HISTORY_LIMIT = config['history_limit'] or None
+    store = InteractionStore('./data/interactions')
+    result['baseline_rss_mb'] = peak_rss_mb()
+
+    t_start = time.time()
+    ml_model.W2V_model.create_dataset(store)
+    result['create_dataset_s'] = time.time() - t_start
+    result['sessions'] = len(ml_model.W2V_model.grouped_df)
+    result['dataset_mb'] = ml_model.W2V_model.grouped_df.estimated_size('mb')
+    result['peak_rss_mb'] = peak_rss_mb()
+
+
+def run_process(context, target, *args):
+    process = context.Process(target=target, args=args)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f'{target.__name__} failed with exit code {process.exitcode}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, nargs='+', default=[1_000_000])
+    parser.add_argument('--history-limit', type=int, nargs='+', default=[0])
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--items', type=int, default=60_000)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for events in args.events:
+        with tempfile.TemporaryDirectory() as workdir, context.Manager() as manager:
+            config = {'events': events, 'users': args.users, 'items': args.items, 'workdir': workdir}
+            os.makedirs(os.path.join(workdir, 'data'))
+            run_process(context, generate, config)
+            for history_limit in args.history_limit:
+                result = manager.dict()
+                run_process(context, measure, {**config, 'history_limit': history_limit}, result)
+                results.append({'events': events, 'history_limit': history_limit, **result})
+                print(json.dumps(results[-1]), file=sys.stderr)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+Сквозной бенчмарк сервисов в одном процессе: event collector, чтение очереди ml-pipeline,
+этапы обучения и сервис рекомендаций работают с брокером AMQP в памяти и fakeredis
+вместо RabbitMQ и Redis, запросы идут через httpx.ASGITransport без сети.
+
+Этапы:
+
+- ``interact`` - конкурентные клиенты шлют синтетические клики в /interact и /interact/batch,
+  пока BatchConsumer пайплайна читает очередь и пишет историю. Считаются события в секунду,
+  задержки запросов и отставание потребителя (от времени события до его чтения из очереди).
+- ``pipeline`` - для каждого числа пользователей генерируется история и замеряется время
+  create_dataset, обучения, get_recommendations и сборки индекса похожих фильмов.
+- ``recs`` - конкурентные запросы /recs по пользователям последнего этапа pipeline.
+
+Результаты печатаются и пишутся в JSON, с ``--baseline`` к ним добавляется сравнение
+с прошлым прогоном:
+
+    python benchmarks/end_to_end.py --users 1000 10000 100000 --output bench.json
+    python benchmarks/end_to_end.py --users 1000 10000 100000 --output bench-new.json --baseline bench.json
+
+Шардирование очереди здесь не проверяется: воркеры шардов - отдельные процессы, а брокер
+живет в памяти этого процесса. Процессы шардов проверяет tests/test_shards.py. Пиковая память create_dataset - в dataset_memory.py, деградация
+сервиса рекомендаций под нагрузкой - в webapp_degraded.py.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+from harness import (LINKS_PATH, MOVIES_PATH, MemoryBroker, SyntheticTraffic, add_service_paths, fake_redis,
+                     latency_stats, load_module, run_load, write_results)
+
+# параметры обучения без подбора, близкие к тем, что обычно находит optuna
+FIT_PARAMS = {'sg': 1, 'window': 5, 'ns_exponent': 0.5, 'negative': 10, 'min_count': 1, 'vector_size': 64}
+
+
+class Services:
+    """
+    Модули сервисов, импортированные в рабочей директории и подключенные к стенд-инам.
+    """
+
+    def __init__(self, workdir, confirm_delay):
+        from catalogue import build
+
+        os.makedirs(os.path.join(workdir, 'data'))
+        catalogue_path = os.path.join(workdir, 'data', 'catalogue.bin')
+        build(MOVIES_PATH, LINKS_PATH, catalogue_path)
+        os.environ['CATALOGUE_PATH'] = catalogue_path
+        # стенд-ины подменяются до импорта: сервисы создают клиентов при импорте
+        self.broker = MemoryBroker(confirm_delay).install()
+        self.redis, self.async_redis = fake_redis()
+
+        self.collector = load_module('event_collector_main', 'event_collector/main.py')
+        self.pipeline = load_module('pipeline_main', 'regular_pipeline/main.py')
+        self.recs = load_module('recommendations_main', 'recommendations/main.py')
+        self.ml_model = sys.modules['ml_model']
+
+        self.collector.redis_connection = self.async_redis
+        self.collector.watched_filter.redis_connection = self.async_redis
+        self.recs.redis_connection = self.async_redis
+        self.recs.watched_filter.redis_connection = self.async_redis
+        self.pipeline.redis_connection = self.redis
+        self.ml_model.redis_connection = self.redis
+
+
+async def wait_drained(broker, consumer, timeout=60):
+    t_start = time.perf_counter()
+    while broker.pending() or consumer.stats['unflushed_events']:
+        if time.perf_counter() - t_start > timeout:
+            raise TimeoutError(f'{broker.pending()} messages are still in the queue')
+        await asyncio.sleep(0.01)
+    return time.perf_counter() - t_start
+
+
+async def bench_interact(services, traffic, args):
+    from consumer import BatchConsumer, open_rabbitmq_queue
+    from instrumentation import track_flush
+    from interaction_store import InteractionStore
+    from popularity import PopularityEngine
+
+    pipeline = services.pipeline
+    pipeline.interaction_store = InteractionStore('./data/interactions')
+    pipeline.popularity = PopularityEngine(top_n=500)
+    lags = []
+
+    def on_events(events):
+        now = time.time()
+        lags.extend(now - event['timestamp'] for event in events)
+        pipeline.track_events(events)
+
+    queue = await open_rabbitmq_queue(0, 1)
+    consumer = BatchConsumer(queue, pipeline.interaction_store.append, on_events=on_events,
+                             on_flush=lambda *flush: track_flush(0, *flush),
+                             flush_interval=args.flush_interval, stats=pipeline.consumer_stats)
+    consumer_task = asyncio.create_task(consumer.run())
+
+    # события генерируются заранее, чтобы не мерить генератор вместе с сервисом
+    pool = traffic.events(10_000)
+    results = {}
+    app = services.collector.app
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://collector') as client:
+            for mode, batch_size in (('single', 1), ('batch', args.batch_size)):
+                events = itertools.cycle(pool)
+                if batch_size == 1:
+                    async def request(worker):
+                        response = await client.post('/interact', json=next(events))
+                        response.raise_for_status()
+                else:
+                    async def request(worker):
+                        batch = list(itertools.islice(events, batch_size))
+                        response = await client.post('/interact/batch', json=batch)
+                        response.raise_for_status()
+
+                lags.clear()
+                flushes = consumer.stats['flushes']
+                stats = await run_load(request, args.concurrency, args.duration)
+                stats['events_per_s'] = stats.get('rps', 0) * batch_size
+                # все принятые события должны дойти до хранилища
+                stats['drain_s'] = await wait_drained(services.broker, consumer)
+                stats['consumer_lag'] = latency_stats(lags)
+                stats['consumer_flushes'] = consumer.stats['flushes'] - flushes
+                results[mode] = stats
+                print(f'interact {mode}: {stats}', file=sys.stderr)
+
+    consumer_task.cancel()
+    queue.cancel()
+    # то же, что calculate_top_recommendations в пайплайне
+    services.redis.json().set('top_items', '.', pipeline.popularity.top())
+    results['broker'] = services.broker.stats()
+    return results
+
+
+def bench_pipeline(services, item_ids, args):
+    import polars as pl
+    from interaction_store import InteractionStore
+
+    W2V_model = services.ml_model.W2V_model
+    results = []
+    workdir = os.getcwd()
+    for n_users in args.users:
+        # у каждого размера свои data/: словарь, датасет и модель не должны переживать замер
+        run_dir = os.path.join(workdir, f'users_{n_users}')
+        os.makedirs(os.path.join(run_dir, 'data'))
+        os.chdir(run_dir)
+        store = InteractionStore('./data/interactions')
+        traffic = SyntheticTraffic(item_ids, n_users)
+        n_events = n_users * args.events_per_user
+        for offset in range(0, n_events, 1_000_000):
+            store.append(pl.DataFrame(traffic.history(min(1_000_000, n_events - offset), t_start=1.7e9 + offset)))
+
+        result = {'users': n_users, 'events': n_events}
+        t_start = time.perf_counter()
+        W2V_model.create_dataset(store)
+        result['create_dataset_s'] = time.perf_counter() - t_start
+        result['sessions'] = len(W2V_model.grouped_df)
+
+        params = FIT_PARAMS
+        if args.trials:
+            services.ml_model.N_TRIALS = args.trials
+            services.ml_model.TUNING_WORKERS = args.tuning_workers
+            study = W2V_model.new_study()
+            t_start = time.perf_counter()
+            W2V_model.tune(study)
+            result['tune_s'] = time.perf_counter() - t_start
+            result['trials'] = len(study.trials)
+            params = study.best_params
+        t_start = time.perf_counter()
+        W2V_model.fit_best(params)
+        result['fit_s'] = time.perf_counter() - t_start
+
+        t_start = time.perf_counter()
+        stats = W2V_model.get_recommendations()
+        result['get_recommendations_s'] = time.perf_counter() - t_start
+        result['recs_keys'] = stats['keys'] if stats else 0
+
+        t_start = time.perf_counter()
+        W2V_model.build_item_index()
+        result['build_item_index_s'] = time.perf_counter() - t_start
+
+        mean_ndcg, mean_recall = W2V_model.evaluate_model(W2V_model.model)
+        result['ndcg'], result['recall'] = float(mean_ndcg), float(mean_recall)
+        results.append(result)
+        print(f'pipeline: {result}', file=sys.stderr)
+    # /recs читает индекс похожих фильмов последнего размера из ./data
+    return results
+
+
+async def bench_recs(services, n_users, args):
+    recs = services.recs
+    rng = np.random.default_rng(0)
+    sizes = []
+    async with recs.app.router.lifespan_context(recs.app):
+        await recs.refresh_hot_cache()
+        transport = httpx.ASGITransport(app=recs.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://recs') as client:
+            async def request(worker):
+                response = await client.get(f'/recs/{SyntheticTraffic.user_id(rng.integers(n_users))}')
+                response.raise_for_status()
+                sizes.append(len(response.json()['item_ids']))
+
+            # прогрев: загрузка индекса похожих фильмов
+            await run_load(request, 1, 0.5)
+            sizes.clear()
+            stats = await run_load(request, args.concurrency, args.duration)
+    stats['mean_items'] = float(np.mean(sizes)) if sizes else 0
+    stats['generation'] = recs.hot_cache['generation']
+    print(f'recs: {stats}', file=sys.stderr)
+    return stats
+
+
+async def run(services, args):
+    item_ids = services.recs.catalogue.item_ids
+    results = {}
+    if 'interact' in args.stages:
+        results['interact'] = await bench_interact(services, SyntheticTraffic(item_ids, args.interact_users), args)
+    n_users = args.interact_users
+    if 'pipeline' in args.stages:
+        # обучение синхронное, как в потоке JobScheduler; остальные этапы в это время не идут
+        results['pipeline'] = bench_pipeline(services, item_ids, args)
+        n_users = args.users[-1]
+    if 'recs' in args.stages:
+        results['recs'] = await bench_recs(services, n_users, args)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', nargs='+', choices=['interact', 'pipeline', 'recs'],
+                        default=['interact', 'pipeline', 'recs'])
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load per scenario')
+    parser.add_argument('--batch-size', type=int, default=50, help='events per /interact/batch request')
+    parser.add_argument('--interact-users', type=int, default=10_000)
+    parser.add_argument('--flush-interval', type=float, default=1, help='consumer flush interval, seconds')
+    parser.add_argument('--confirm-delay', type=float, default=0.0,
+                        help='simulated broker confirm latency, seconds')
+    parser.add_argument('--users', type=int, nargs='+', default=[1_000, 10_000, 50_000])
+    parser.add_argument('--events-per-user', type=int, default=20)
+    parser.add_argument('--trials', type=int, default=0, help='optuna trials before fit, 0 fits fixed params')
+    parser.add_argument('--tuning-workers', type=int, default=1)
+    parser.add_argument('--output', help='JSON file for results')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+    args.users = sorted(args.users)
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    if args.baseline:
+        args.baseline = os.path.abspath(args.baseline)
+
+    add_service_paths()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # сервисы пишут логи и данные относительно текущей директории
+        os.chdir(workdir)
+        try:
+            services = Services(workdir, args.confirm_delay)
+            results = asyncio.run(run(services, args))
+        finally:
+            os.chdir(cwd)
+    params = {name: value for name, value in vars(args).items() if name not in ('output', 'baseline')}
+    write_results(results, args.output, args.baseline, **params)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,410 @@
+"""
+Общие части бенчмарков: брокер AMQP в памяти, fake Redis, загрузка сервисов в один процесс,
+синтетический трафик по каталогу MovieLens и запись результатов в JSON со сравнением
+с предыдущим прогоном.
+"""
+import asyncio
+import collections
+import csv
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOVIES_PATH = os.path.join(ROOT, 'webapp', 'static', 'movies.csv')
+LINKS_PATH = os.path.join(ROOT, 'webapp', 'static', 'links.csv')
+
+
+def add_service_paths():
+    # модули сервисов импортируют друг друга по имени, как в контейнерах с PYTHONPATH=/app/utils
+    for name in ('utils', 'regular_pipeline', 'recommendations', 'event_collector'):
+        path = os.path.join(ROOT, name)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def load_module(name, path):
+    """
+    Импортирует main.py сервиса под уникальным именем: у всех сервисов модуль называется main.
+    """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class MemoryMessage:
+
+    def __init__(self, queue, body, delivery_tag):
+        self.queue = queue
+        self.body = body
+        self.delivery_tag = delivery_tag
+
+    async def ack(self, multiple=False):
+        self.queue._settle(self.delivery_tag, multiple, requeue=False)
+
+    async def nack(self, multiple=False, requeue=True):
+        self.queue._settle(self.delivery_tag, multiple, requeue=requeue)
+
+    async def reject(self, requeue=False):
+        self.queue._settle(self.delivery_tag, False, requeue=requeue)
+
+
+class MemoryQueue:
+    """
+    Очередь с доставкой по prefetch и подтверждениями с ``multiple``, как у RabbitMQ.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.prefetch_count = 0
+        self._ready = collections.deque()
+        self._unacked = collections.OrderedDict()
+        self._tags = itertools.count(1)
+        self._wakeup = asyncio.Event()
+        self._consumers = []
+        self.stats = {'published': 0, 'delivered': 0, 'acked': 0, 'requeued': 0}
+
+    def __len__(self):
+        return len(self._ready) + len(self._unacked)
+
+    async def bind(self, exchange, routing_key):
+        # повторное объявление binding, как и в RabbitMQ, ничего не меняет
+        if self not in exchange.bindings[routing_key]:
+            exchange.bindings[routing_key].append(self)
+
+    def put(self, body):
+        self._ready.append(body)
+        self.stats['published'] += 1
+        self._wakeup.set()
+
+    def _settle(self, delivery_tag, multiple, requeue):
+        if multiple:
+            tags = [tag for tag in self._unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag] if delivery_tag in self._unacked else []
+        bodies = [self._unacked.pop(tag) for tag in tags]
+        if requeue:
+            self._ready.extendleft(reversed(bodies))
+            self.stats['requeued'] += len(bodies)
+        else:
+            self.stats['acked'] += len(bodies)
+        self._wakeup.set()
+
+    async def consume(self, callback):
+        self._consumers.append(asyncio.create_task(self._deliver(callback)))
+
+    async def _deliver(self, callback):
+        while True:
+            if self._ready and (not self.prefetch_count or len(self._unacked) < self.prefetch_count):
+                tag = next(self._tags)
+                body = self._unacked[tag] = self._ready.popleft()
+                self.stats['delivered'] += 1
+                await callback(MemoryMessage(self, body, tag))
+                # отдаем управление, иначе доставка займет event loop целиком
+                await asyncio.sleep(0)
+            else:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+    async def purge(self):
+        purged = len(self._ready)
+        self._ready.clear()
+        return purged
+
+    def cancel(self):
+        for task in self._consumers:
+            task.cancel()
+        self._consumers = []
+
+
+class MemoryExchange:
+
+    def __init__(self, broker, name):
+        self.broker = broker
+        self.name = name
+        self.bindings = collections.defaultdict(list)
+
+    async def publish(self, message, routing_key):
+        if self.broker.confirm_delay:
+            # задержка подтверждения публикации, как у брокера по сети
+            await asyncio.sleep(self.broker.confirm_delay)
+        for queue in self.bindings.get(routing_key, ()):
+            queue.put(message.body)
+
+
+class MemoryChannel:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.prefetch_count = 0
+        self.is_closed = False
+
+    async def set_qos(self, prefetch_count=0, **kwargs):
+        self.prefetch_count = prefetch_count
+
+    async def declare_exchange(self, name, type='direct', **kwargs):
+        return self.broker.exchanges.setdefault(name, MemoryExchange(self.broker, name))
+
+    async def get_exchange(self, name, ensure=True):
+        return self.broker.exchanges[name]
+
+    async def declare_queue(self, name, **kwargs):
+        queue = self.broker.queues.setdefault(name, MemoryQueue(name))
+        if self.prefetch_count:
+            queue.prefetch_count = self.prefetch_count
+        return queue
+
+    async def get_queue(self, name, ensure=True):
+        return self.broker.queues[name]
+
+    async def close(self):
+        self.is_closed = True
+
+
+class MemoryConnection:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_closed = False
+        self.reconnect_callbacks = set()
+        self.connected = asyncio.Event()
+        self.connected.set()
+
+    async def channel(self, publisher_confirms=True, **kwargs):
+        return MemoryChannel(self.broker)
+
+    async def close(self):
+        self.is_closed = True
+
+
+class MemoryBroker:
+    """
+    Брокер AMQP в памяти процесса вместо RabbitMQ: подменяет ``aio_pika.connect_robust``,
+    поэтому RabbitMQPool, BatchPublisher и BatchConsumer работают без изменений.
+
+    :param confirm_delay: seconds every publish waits for a "broker confirm"
+    """
+
+    def __init__(self, confirm_delay=0.0):
+        self.confirm_delay = confirm_delay
+        self.exchanges = {}
+        self.queues = {}
+
+    async def connect_robust(self, url=None, **kwargs):
+        return MemoryConnection(self)
+
+    def install(self):
+        import aio_pika
+
+        aio_pika.connect_robust = self.connect_robust
+        return self
+
+    def pending(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self):
+        return {name: dict(queue.stats) for name, queue in self.queues.items()}
+
+
+def fake_redis(latency=0.0):
+    """
+    :param latency: seconds every round-trip waits, as to a Redis over the network
+    :return: sync and async fakeredis clients sharing one in-memory server, with RedisJSON commands
+    """
+    import fakeredis
+    import fakeredis.aioredis
+
+    class Connection(fakeredis.FakeRedisConnection):
+
+        def send_packed_command(self, command, check_health=True):
+            # одна отправка - одна команда или целый pipeline
+            time.sleep(latency)
+            super().send_packed_command(command, check_health)
+
+    class AsyncConnection(fakeredis.aioredis.FakeAsyncRedisConnection):
+
+        async def send_packed_command(self, command, check_health=True):
+            await asyncio.sleep(latency)
+            await super().send_packed_command(command, check_health)
+
+    server = fakeredis.FakeServer()
+    if not latency:
+        return fakeredis.FakeRedis(server=server), fakeredis.aioredis.FakeRedis(server=server)
+    return (fakeredis.FakeRedis(server=server, connection_class=Connection),
+            fakeredis.aioredis.FakeRedis(server=server, connection_class=AsyncConnection))
+
+
+def load_movie_ids(path=MOVIES_PATH):
+    with open(path, newline='', encoding='utf-8') as f:
+        return np.array([int(row['movieId']) for row in csv.DictReader(f)], dtype=np.int64)
+
+
+class SyntheticTraffic:
+    """
+    Синтетические взаимодействия по каталогу MovieLens: популярность фильмов по закону Ципфа,
+    как в рейтингах MovieLens, 80% лайков.
+
+    :param item_ids: catalogue item ids
+    :param n_users: number of distinct users
+    """
+
+    def __init__(self, item_ids, n_users, zipf_exponent=1.1, like_share=0.8, seed=42):
+        self.rng = np.random.default_rng(seed)
+        self.n_users = n_users
+        self.like_share = like_share
+        # ранги популярности раздаются фильмам в случайном порядке
+        self.item_ids = self.rng.permutation(item_ids)
+        weights = 1 / np.arange(1, len(item_ids) + 1) ** zipf_exponent
+        self.item_cdf = np.cumsum(weights / weights.sum())
+
+    @staticmethod
+    def user_id(user):
+        return f'u{user}'
+
+    def items(self, n):
+        return self.item_ids[np.minimum(np.searchsorted(self.item_cdf, self.rng.random(n)), len(self.item_ids) - 1)]
+
+    def actions(self, n):
+        return np.where(self.rng.random(n) < self.like_share, 'like', 'dislike')
+
+    def events(self, n, items_per_event=1):
+        """
+        :return: list of n events in /interact format
+        """
+        users = self.rng.integers(0, self.n_users, n)
+        items = self.items(n * items_per_event).astype(str).reshape(n, items_per_event).tolist()
+        actions = self.actions(n * items_per_event).reshape(n, items_per_event).tolist()
+        return [
+            {'user_id': self.user_id(user), 'item_ids': item_ids, 'actions': user_actions}
+            for user, item_ids, user_actions in zip(users.tolist(), items, actions)
+        ]
+
+    def history(self, n_events, t_start=1.7e9, duration=86400):
+        """
+        :return: dict of columns with n_events interactions in InteractionStore schema
+        """
+        users = self.rng.integers(0, self.n_users, n_events)
+        return {
+            'user_id': np.char.add('u', users.astype(str)),
+            'item_id': self.items(n_events).astype(str),
+            'action': self.actions(n_events),
+            'timestamp': t_start + np.sort(self.rng.uniform(0, duration, n_events)),
+        }
+
+
+def latency_stats(latencies, duration=None):
+    """
+    :param latencies: request latencies in seconds
+    :return: count, rate and percentiles in milliseconds
+    """
+    latencies = np.asarray(latencies) * 1000
+    if len(latencies) == 0:
+        return {'requests': 0}
+    stats = {
+        'requests': len(latencies),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+    }
+    if duration:
+        stats['rps'] = len(latencies) / duration
+    return stats
+
+
+async def run_load(request, concurrency, duration):
+    """
+    Гоняет ``concurrency`` конкурентных клиентов ``duration`` секунд.
+
+    :param request: coroutine function of the worker number, makes one request
+    :return: latency_stats of successful requests plus the number of errors
+    """
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+
+    async def worker(number):
+        while time.perf_counter() < deadline:
+            t_start = time.perf_counter()
+            try:
+                await request(number)
+            except Exception as e:
+                errors.append(repr(e))
+                continue
+            latencies.append(time.perf_counter() - t_start)
+
+    t_start = time.perf_counter()
+    await asyncio.gather(*[worker(number) for number in range(concurrency)])
+    stats = latency_stats(latencies, time.perf_counter() - t_start)
+    stats['errors'] = len(errors)
+    if errors:
+        stats['first_error'] = errors[0]
+    return stats
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def _flatten(value, prefix=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(item, f'{prefix}.{key}' if prefix else str(key))
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            yield from _flatten(item, f'{prefix}[{i}]')
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def compare(baseline, results):
+    """
+    :return: relative change of every numeric metric present in both runs
+    """
+    old = dict(_flatten(baseline.get('results', {})))
+    return {
+        name: {'baseline': old[name], 'current': value,
+               'change': (value - old[name]) / abs(old[name]) if old[name] else None}
+        for name, value in _flatten(results)
+        if name in old
+    }
+
+
+def write_results(results, output=None, baseline=None, **params):
+    """
+    Печатает результаты и пишет их в JSON вместе с параметрами запуска и окружением.
+    С ``baseline`` добавляет сравнение с предыдущим прогоном.
+    """
+    report = {'environment': environment(), 'params': params, 'results': results}
+    if baseline:
+        with open(baseline) as f:
+            report['comparison'] = compare(json.load(f), results)
+        for name, change in report['comparison'].items():
+            if change['change'] is not None:
+                print(f'{name}: {change["baseline"]:.4g} -> {change["current"]:.4g} '
+                      f'({change["change"]:+.1%})', file=sys.stderr)
+    text = json.dumps(report, indent=2, default=str)
+    if output:
+        with open(output + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(output + '.tmp', output)
+    print(text)
+    return report
@@ -0,0 +1,392 @@
+"""
+Микробенчмарки отдельных горячих мест, каждое в сравнении с наивной реализацией:
+
+- ``scorer`` - пакетный predict_output_words против цикла Word2Vec.predict_output_word
+- ``metrics`` - batch_metrics против цикла user_ndcg/user_recall
+- ``dataset`` - create_dataset на Polars-выражениях против прежней сборки через map_elements
+  на синтетической истории из 10M событий
+- ``watched`` - фильтр просмотренного на один запрос /recs: прежний GET ключа ``{user}_{item}``
+  на каждого кандидата против одного SMISMEMBER по множеству пользователя, на fakeredis
+- ``recs_redis`` - пропускная способность /recs: прежний синхронный обработчик с чтением
+  top_items и рекомендаций на каждый запрос против асинхронного сервиса с пулом соединений
+  и кэшем в памяти, на fakeredis с задержкой round-trip
+- ``candidates`` - выборка случайных кандидатов против ``np.random.choice(list(set))`` и blend
+  на один запрос /recs при каталоге 100k и 1M
+- ``publisher`` - BatchPublisher против публикации каждого события отдельным сообщением,
+  через RabbitMQPool и брокер в памяти с задержкой подтверждения
+
+    python benchmarks/micro.py --output micro.json
+    python benchmarks/micro.py --stages metrics --metrics-users 10000000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from harness import (LINKS_PATH, MOVIES_PATH, MemoryBroker, SyntheticTraffic, add_service_paths, fake_redis,
+                     latency_stats, load_module, load_movie_ids, run_load, write_results)
+
+
+def timed(func, *args, repeat=1):
+    t_start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*args)
+    return (time.perf_counter() - t_start) / repeat, result
+
+
+def bench_scorer(item_ids, args):
+    from gensim.models import Word2Vec
+    from batch_scorer import predict_output_words
+
+    traffic = SyntheticTraffic(item_ids, args.scorer_users)
+    history = traffic.history(args.scorer_users * 20)
+    order = np.argsort(history['user_id'], kind='stable')
+    users, starts = np.unique(history['user_id'][order], return_index=True)
+    sessions = [session.tolist() for session in np.split(history['item_id'][order], starts[1:])]
+    model = Word2Vec(sessions, vector_size=64, window=5, negative=10, min_count=1, sg=1, epochs=3, seed=42)
+
+    contexts = [session[-model.window:] for session in sessions]
+    batch_s, _ = timed(predict_output_words, model, contexts, 30)
+    sample = contexts[:args.scorer_loop_users]
+    loop_s, _ = timed(lambda: [model.predict_output_word(context, topn=30) for context in sample])
+    loop_s *= len(contexts) / len(sample)
+    return {'users': len(contexts), 'items': len(model.wv), 'batch_s': batch_s,
+            'loop_s_extrapolated': loop_s, 'speedup': loop_s / batch_s}
+
+
+def bench_metrics(args):
+    from ml_metrics import batch_metrics, to_csr, user_ndcg, user_recall
+
+    rng = np.random.default_rng(42)
+    n_users, k = args.metrics_users, 30
+    y_rec = rng.integers(0, 20_000, (n_users, k))
+    y_rel = rng.integers(0, 20_000, n_users).reshape(-1, 1).tolist()
+    t_start = time.perf_counter()
+    indptr, indices = to_csr(y_rel)
+    batch_metrics(y_rec, indptr, indices, k=k)
+    batch_s = time.perf_counter() - t_start
+
+    n_loop = min(n_users, args.metrics_loop_users)
+    sample = y_rec[:n_loop].tolist()
+    loop_s, _ = timed(lambda: [(user_ndcg(rel, rec, k), user_recall(rel, rec, k))
+                               for rel, rec in zip(y_rel[:n_loop], sample)])
+    loop_s *= n_users / n_loop
+    return {'users': n_users, 'batch_s': batch_s, 'loop_s_extrapolated': loop_s, 'speedup': loop_s / batch_s}
+
+
+def create_dataset_map_elements(interactions):
+    """
+    Сборка датасета до перехода на Polars-выражения: словарь пересобирается на каждом запуске,
+    id кодируются и история делится на train/test вызовами Python на каждую строку и группу.
+    """
+    import polars as pl
+
+    interactions = interactions.collect()
+    user_mapping = {k: v for v, k in enumerate(interactions['item_id'].unique())}
+    return (
+        interactions
+        .sort('timestamp')
+        .filter(pl.col('action') == 'like')
+        .with_columns(pl.col('item_id').map_elements(user_mapping.get, return_dtype=pl.Int64))
+        .group_by('user_id')
+        .agg([
+            pl.col('item_id').map_elements(lambda x: x[:-1], return_dtype=pl.List(pl.Int64)).alias('train_item_ids'),
+            pl.col('item_id').map_elements(lambda x: x[-1:], return_dtype=pl.List(pl.Int64)).alias('test_item_ids'),
+        ])
+        .filter(pl.col('train_item_ids').list.len() > 0)
+    )
+
+
+def bench_dataset(item_ids, args):
+    import polars as pl
+    import ml_model
+    from interaction_store import InteractionStore
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # create_dataset пишет словарь и датасет в ./data
+        os.chdir(workdir)
+        try:
+            os.makedirs('data')
+            store = InteractionStore('./data/interactions')
+            traffic = SyntheticTraffic(item_ids, args.dataset_users)
+            for offset in range(0, args.dataset_events, 1_000_000):
+                n = min(1_000_000, args.dataset_events - offset)
+                store.append(pl.DataFrame(traffic.history(n, t_start=1.7e9 + offset)))
+
+            new_s, _ = timed(ml_model.W2V_model.create_dataset, store)
+            with store.snapshot() as interactions:
+                old_s, grouped_df = timed(create_dataset_map_elements, interactions)
+        finally:
+            os.chdir(cwd)
+    sessions = len(ml_model.W2V_model.grouped_df)
+    # обе сборки должны дать одни и те же сессии
+    assert sessions == len(grouped_df), (sessions, len(grouped_df))
+    return {'events': args.dataset_events, 'users': args.dataset_users, 'sessions': sessions,
+            'native_s': new_s, 'map_elements_s': old_s, 'speedup': old_s / new_s}
+
+
+def bench_watched(item_ids, args):
+    from watched_filter import WatchedFilter
+
+    redis_connection, async_redis = fake_redis()
+    watched_filter = WatchedFilter(redis_connection=async_redis)
+    rng = np.random.default_rng(42)
+    users = [f'u{user}' for user in range(args.watched_users)]
+    for user_id in users:
+        watched = rng.choice(item_ids, args.watched_items, replace=False).astype(str).tolist()
+        # прежняя схема: ключ на каждую пару (пользователь, фильм)
+        redis_connection.mset({f'{user_id}_{item_id}': 1 for item_id in watched})
+        redis_connection.sadd(WatchedFilter.key(user_id), *watched)
+
+    # кандидаты запроса: топ популярных, персональные и случайные, часть уже просмотрена
+    requests = [(users[rng.integers(len(users))], rng.choice(item_ids, args.watched_candidates,
+                                                             replace=False).astype(str).tolist())
+                for _ in range(args.watched_requests)]
+
+    get_times, get_results = [], []
+    for user_id, candidates in requests:
+        t_start = time.perf_counter()
+        get_results.append([i for i in candidates if redis_connection.get(f'{user_id}_{i}') is None])
+        get_times.append(time.perf_counter() - t_start)
+
+    async def filter_all():
+        times, results = [], []
+        for user_id, candidates in requests:
+            t_start = time.perf_counter()
+            results.append(await watched_filter.filter(user_id, candidates))
+            times.append(time.perf_counter() - t_start)
+        return times, results
+
+    set_times, set_results = asyncio.run(filter_all())
+    # оба фильтра оставляют одних и тех же кандидатов
+    assert get_results == set_results
+    return {
+        'candidates': args.watched_candidates,
+        'watched_per_user': args.watched_items,
+        'get_per_candidate': {'round_trips': args.watched_candidates, **latency_stats(get_times)},
+        'smismember': {'round_trips': 1, **latency_stats(set_times)},
+    }
+
+
+def sync_recs_app(redis_connection, catalogue):
+    """
+    /recs до перехода на асинхронный клиент: обработчик занимает поток из пула на все
+    round-trip'ы к Redis, а top_items и поколение рекомендаций читает на каждый запрос.
+    """
+    import random
+
+    from fastapi import FastAPI
+    from models import RecommendationsResponse
+    from recs_store import RECS_GENERATION_KEY, recs_key
+    from watched_filter import WatchedFilter
+
+    app = FastAPI()
+
+    @app.get('/recs/{user_id}')
+    def get_recs(user_id: str):
+        generation = redis_connection.get(RECS_GENERATION_KEY)
+        personal = redis_connection.zrange(recs_key(generation.decode(), user_id), 0, -1) if generation else []
+        popular = redis_connection.json().get('top_items') or []
+        item_ids = [item_id.decode() for item_id in personal] + popular + random.sample(catalogue, 20)
+        watched = redis_connection.smismember(WatchedFilter.key(user_id), item_ids)
+        item_ids = WatchedFilter.unwatched(item_ids, watched)[:30]
+        return RecommendationsResponse(item_ids=item_ids)
+
+    return app
+
+
+async def recs_throughput(apps, n_users, args, before=None):
+    """
+    :param apps: dict mode -> ASGI app serving /recs
+    :param before: optional coroutine awaited first, in the same event loop as the load
+    :return: dict mode -> run_load stats
+    """
+    import httpx
+
+    if before is not None:
+        await before
+    rng = np.random.default_rng(0)
+    results = {}
+    for mode, app in apps.items():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://recs') as client:
+            async def request(worker):
+                response = await client.get(f'/recs/{SyntheticTraffic.user_id(rng.integers(n_users))}')
+                response.raise_for_status()
+
+            await run_load(request, 1, 0.2)
+            results[mode] = await run_load(request, args.recs_concurrency, args.recs_duration)
+    return results
+
+
+def bench_recs_redis(item_ids, args):
+    from catalogue import CATALOGUE_PATH, build
+    from recs_store import RECS_GENERATION_KEY, ranked, recs_key
+    from watched_filter import WatchedFilter
+
+    cwd = os.getcwd()
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        # сервис пишет лог и читает каталог относительно текущей директории
+        os.chdir(workdir)
+        try:
+            os.makedirs('data')
+            build(MOVIES_PATH, LINKS_PATH, CATALOGUE_PATH)
+            recs = load_module('recommendations_main', 'recommendations/main.py')
+            for latency in args.redis_latencies:
+                redis_connection, async_redis = fake_redis(latency)
+                traffic = SyntheticTraffic(item_ids, args.recs_users)
+                pipe = redis_connection.pipeline(transaction=False)
+                pipe.set(RECS_GENERATION_KEY, 'bench')
+                pipe.json().set('top_items', '.', traffic.items(500).astype(str).tolist())
+                for user in range(args.recs_users):
+                    user_id = SyntheticTraffic.user_id(user)
+                    pipe.zadd(recs_key('bench', user_id), ranked(traffic.items(30).astype(str).tolist()))
+                    pipe.sadd(WatchedFilter.key(user_id), *traffic.items(50).astype(str).tolist())
+                pipe.execute()
+
+                recs.redis_connection = recs.watched_filter.redis_connection = async_redis
+                # асинхронный клиент привязан к event loop, поэтому кэш заполняется в том же цикле
+                apps = {'sync': sync_recs_app(redis_connection, recs.catalogue.item_ids.astype(str).tolist()),
+                        'async_pooled': recs.app}
+                stats = asyncio.run(recs_throughput(apps, args.recs_users, args, before=recs.refresh_hot_cache()))
+                for mode, mode_stats in stats.items():
+                    results.append({'latency_ms': latency * 1000, 'mode': mode, **mode_stats})
+                    print(f'recs_redis: {results[-1]}', file=sys.stderr)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def bench_candidates(args):
+    from candidates import ItemArray, blend
+
+    rng = np.random.default_rng(42)
+    results = []
+    for n_items in args.catalogue_sizes:
+        catalogue = ItemArray(np.arange(1, n_items + 1))
+        popular = rng.choice(n_items, 90, replace=False) + 1
+        personal = rng.choice(n_items, 30, replace=False) + 1
+        watched = rng.choice(n_items, 200, replace=False) + 1
+        quotas = {'personal': 18, 'popular': 5, 'random': 7}
+
+        # так каталог хранился до ItemArray: множество, которое на каждый запрос становится списком
+        catalogue_set = set(catalogue.values.tolist())
+        sample_times, naive_times, blend_times = [], [], []
+        for _ in range(args.candidate_requests):
+            t_start = time.perf_counter()
+            random_items = catalogue.sample(3 * quotas['random'] + 30, rng)
+            sample_times.append(time.perf_counter() - t_start)
+
+            t_start = time.perf_counter()
+            np.random.choice(list(catalogue_set), size=3 * quotas['random'] + 30, replace=False)
+            naive_times.append(time.perf_counter() - t_start)
+
+            t_start = time.perf_counter()
+            blend({'personal': personal, 'popular': popular, 'random': random_items}, quotas, 30, exclude=watched)
+            blend_times.append(time.perf_counter() - t_start)
+        results.append({
+            'items': n_items,
+            'sample': latency_stats(sample_times),
+            'set_to_list_choice': latency_stats(naive_times),
+            'blend': latency_stats(blend_times),
+        })
+    return results
+
+
+async def publish_events(broker, events, batched):
+    from aio_pika import Message
+    import orjson
+    from batch_publisher import BatchPublisher
+    from rabbitmq_pool import RabbitMQPool
+
+    rabbitmq = RabbitMQPool(exchange_name=f'bench.{batched}.{broker.confirm_delay}', num_shards=1)
+    await rabbitmq.connect()
+    t_start = time.perf_counter()
+    if batched:
+        publisher = BatchPublisher(rabbitmq.publish, rabbitmq.routing_key(), max_queue=len(events))
+        publisher.start()
+        # клиенты ждут подтверждения конкурентно, как запросы в event collector
+        await asyncio.gather(*[publisher.submit(event) for event in events])
+        await publisher.stop()
+    else:
+        semaphore = asyncio.Semaphore(rabbitmq.pool_size)
+
+        async def publish(event):
+            async with semaphore:
+                await rabbitmq.publish(Message(orjson.dumps(event)), rabbitmq.routing_key())
+        await asyncio.gather(*[publish(event) for event in events])
+    elapsed = time.perf_counter() - t_start
+    await rabbitmq.close()
+    return {'events_per_s': len(events) / elapsed, 'messages': broker.stats()[rabbitmq.queue_name()]['published']}
+
+
+def bench_publisher(item_ids, args):
+    events = SyntheticTraffic(item_ids, 10_000).events(args.publisher_events)
+    results = []
+    for confirm_delay in args.confirm_delays:
+        for batched in (False, True):
+            # у каждого прогона свой брокер, чтобы сообщения прошлых прогонов не копились в очереди
+            broker = MemoryBroker(confirm_delay).install()
+            result = asyncio.run(publish_events(broker, events, batched))
+            results.append({'confirm_delay_ms': confirm_delay * 1000,
+                            'mode': 'batch' if batched else 'per_event', **result})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', nargs='+', choices=['scorer', 'metrics', 'dataset', 'watched', 'recs_redis', 'candidates', 'publisher'],
+                        default=['scorer', 'metrics', 'dataset', 'watched', 'recs_redis', 'candidates', 'publisher'])
+    parser.add_argument('--scorer-users', type=int, default=20_000)
+    parser.add_argument('--scorer-loop-users', type=int, default=1_000,
+                        help='users scored in the loop, the time is extrapolated to all users')
+    parser.add_argument('--metrics-users', type=int, default=1_000_000)
+    parser.add_argument('--metrics-loop-users', type=int, default=100_000)
+    parser.add_argument('--dataset-events', type=int, default=10_000_000)
+    parser.add_argument('--dataset-users', type=int, default=500_000)
+    parser.add_argument('--watched-users', type=int, default=1_000)
+    parser.add_argument('--watched-items', type=int, default=200, help='watched items per user')
+    parser.add_argument('--watched-candidates', type=int, default=550,
+                        help='candidates per request: top 500, personal and random')
+    parser.add_argument('--watched-requests', type=int, default=1_000)
+    parser.add_argument('--recs-users', type=int, default=10_000)
+    parser.add_argument('--recs-concurrency', type=int, default=64)
+    parser.add_argument('--recs-duration', type=float, default=5, help='seconds of load per mode')
+    parser.add_argument('--redis-latencies', type=float, nargs='+', default=[0.0, 0.0005, 0.002],
+                        help='simulated Redis round-trip latencies, seconds')
+    parser.add_argument('--catalogue-sizes', type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument('--candidate-requests', type=int, default=1_000)
+    parser.add_argument('--publisher-events', type=int, default=20_000)
+    parser.add_argument('--confirm-delays', type=float, nargs='+', default=[0.0, 0.001],
+                        help='simulated broker confirm latencies, seconds')
+    parser.add_argument('--output', help='JSON file for results')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    add_service_paths()
+    item_ids = load_movie_ids()
+    stages = {
+        'scorer': lambda: bench_scorer(item_ids, args),
+        'metrics': lambda: bench_metrics(args),
+        'dataset': lambda: bench_dataset(item_ids, args),
+        'watched': lambda: bench_watched(item_ids, args),
+        'recs_redis': lambda: bench_recs_redis(item_ids, args),
+        'candidates': lambda: bench_candidates(args),
+        'publisher': lambda: bench_publisher(item_ids, args),
+    }
+    results = {}
+    for stage in args.stages:
+        results[stage] = stages[stage]()
+        print(f'{stage}: {results[stage]}', file=sys.stderr)
+    params = {name: value for name, value in vars(args).items() if name not in ('output', 'baseline')}
+    write_results(results, args.output and os.path.abspath(args.output), args.baseline, **params)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Нагрузочный тест главной страницы при деградации сервиса рекомендаций.
+
+Поднимает в отдельных процессах заглушку сервиса рекомендаций с настраиваемой задержкой /recs
+и сам webapp, затем для каждого сценария (быстрый сервис, медленный, очень медленный,
+недоступный) гоняет конкурентные запросы к / и печатает JSON с числом запросов в секунду
+и перцентилями задержки. При исправном таймауте и размыкателе пропускная способность
+не должна падать вместе со скоростью /recs.
+
+    python benchmarks/webapp_degraded.py --concurrency 50 --duration 10
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, HTTPException
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'utils'))
+
+RECS_PORT = 18001
+WEBAPP_PORT = 18000
+
+# задержка и доступность заглушки меняются между сценариями через общую память процессов
+stub_state = {'delay': None, 'down': None}
+stub = FastAPI()
+
+
+@stub.get('/recs/{user_id}')
+async def stub_recs(user_id: str):
+    if stub_state['down'].value:
+        raise HTTPException(status_code=503)
+    await asyncio.sleep(stub_state['delay'].value)
+    return {'item_ids': [str(i) for i in range(1, 31)]}
+
+
+@stub.get('/popular')
+async def stub_popular(k: int = 100):
+    return {'item_ids': [str(i) for i in range(1, k + 1)]}
+
+
+def run_stub(delay, down):
+    stub_state.update(delay=delay, down=down)
+    uvicorn.run(stub, port=RECS_PORT, log_level='warning')
+
+
+def run_webapp(workdir):
+    uvicorn.run(load_webapp(workdir).app, port=WEBAPP_PORT, log_level='warning')
+
+
+def wait_ready(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(url)
+
+
+def load_webapp(workdir):
+    """
+    Импортирует webapp/app.py в рабочей директории с данными фронтенда, но без картинок.
+    """
+    os.makedirs(os.path.join(workdir, 'static', 'images'))
+    for name in ('movies.csv', 'links.csv'):
+        os.symlink(os.path.join(ROOT, 'webapp', 'static', name), os.path.join(workdir, 'static', name))
+    os.symlink(os.path.join(ROOT, 'webapp', 'templates'), os.path.join(workdir, 'templates'))
+    os.chdir(workdir)
+    os.environ['RECSYS_SERVICE_URL'] = f'http://127.0.0.1:{RECS_PORT}'
+    spec = importlib.util.spec_from_file_location('webapp', os.path.join(ROOT, 'webapp', 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def run_load(concurrency, duration):
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    async def worker(client):
+        while time.perf_counter() < deadline:
+            t_start = time.perf_counter()
+            response = await client.get('/', cookies={'user_id': 'load-test'})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - t_start)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{WEBAPP_PORT}', limits=limits, timeout=30) as client:
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / duration,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    scenarios = [
+        ('healthy', {'delay': 0.01, 'down': False}),
+        ('slow_300ms', {'delay': 0.3, 'down': False}),
+        ('slow_2s', {'delay': 2.0, 'down': False}),
+        ('down', {'delay': 0.0, 'down': True}),
+    ]
+    context = multiprocessing.get_context('spawn')
+    delay, down = context.Value('d', 0.0), context.Value('b', False)
+    with tempfile.TemporaryDirectory() as workdir:
+        processes = [
+            context.Process(target=run_stub, args=(delay, down), daemon=True),
+            context.Process(target=run_webapp, args=(workdir,), daemon=True),
+        ]
+        for process in processes:
+            process.start()
+        try:
+            wait_ready(f'http://127.0.0.1:{RECS_PORT}/popular')
+            wait_ready(f'http://127.0.0.1:{WEBAPP_PORT}/healthcheck')
+            # прогрев: шаблоны, пул соединений, кэш популярного
+            asyncio.run(run_load(args.concurrency, 1))
+
+            results = []
+            for name, state in scenarios:
+                delay.value, down.value = state['delay'], state['down']
+                result = {'scenario': name, **asyncio.run(run_load(args.concurrency, args.duration)),
+                          'circuit': httpx.get(f'http://127.0.0.1:{WEBAPP_PORT}/healthcheck').json()['recs_circuit']}
+                results.append(result)
+                print(json.dumps(result), file=sys.stderr)
+        finally:
+            for process in processes:
+                process.terminate()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,27 @@
 import os
 import asyncio
-import json
 import time
 import logging
+from typing import List
+from contextlib import asynccontextmanager
 
-import redis
-import aio_pika
-from aio_pika import Message
-from aio_pika.abc import AbstractRobustExchange, AbstractRobustConnection
-from fastapi import FastAPI
+import orjson
+import redis.asyncio as redis
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter, ValidationError
 
+from batch_publisher import BatchPublisher
+from instrumentation import instrument_app, track_call
 from models import InteractEvent
+from rabbitmq_pool import RabbitMQPool
+from recs_store import recent_likes_key, LIKES_CHANNEL, RECENT_LIKES_LIMIT
 from watched_filter import WatchedFilter
 
 logging.basicConfig(level=logging.INFO, filename=".logs",filemode="w",
                     format="%(asctime)s %(levelname)s %(message)s")
 
-app = FastAPI()
 redis_conn = 'redis://{username}:{password}@{host}:{port}/0'.format(
     username=os.environ.get('REDIS_USER', 'default'),
     password=os.environ.get('REDIS_PASSWORD'),
@@ -25,14 +29,66 @@ redis_conn = 'redis://{username}:{password}@{host}:{port}/0'.format(
     port=os.environ.get('REDIS_PORT', 6379),
 )
 redis_connection = redis.Redis.from_url(redis_conn)
-watched_filter = WatchedFilter()
+watched_filter = WatchedFilter(redis_connection=redis_connection)
+
+rabbitmq = RabbitMQPool(pool_size=int(os.environ.get('RABBITMQ_CHANNEL_POOL_SIZE', 8)))
+
+# ограничение на число событий в одном запросе к /interact/batch
+MAX_BATCH_EVENTS = int(os.environ.get('MAX_BATCH_EVENTS', 1000))
+events_adapter = TypeAdapter(List[InteractEvent])
+
+
+async def save_batch_to_redis(events):
+    """
+    Записывает просмотренные фильмы и последние лайки всей пачки одним pipeline
+    и сообщает о новых лайках сервису рекомендаций.
+    """
+    pipe = redis_connection.pipeline(transaction=False)
+    likes = []
+    for event in events:
+        watched_filter.add_to_pipeline(pipe, event['user_id'], *event['item_ids'])
+        liked = [item_id for item_id, action in zip(event['item_ids'], event['actions']) if action == 'like']
+        if liked:
+            key = recent_likes_key(event['user_id'])
+            pipe.lpush(key, *liked)
+            pipe.ltrim(key, 0, RECENT_LIKES_LIMIT - 1)
+            likes.append([event['user_id'], liked])
+    if likes:
+        pipe.publish(LIKES_CHANNEL, orjson.dumps(likes))
+    try:
+        with track_call('redis', 'save_batch'):
+            await pipe.execute()
+    except redis.ConnectionError:
+        # ignore errors if redis unavailable
+        pass
+
+
+publisher = BatchPublisher(
+    rabbitmq.publish,
+    # события пользователя всегда попадают в очередь одного шарда
+    lambda event: rabbitmq.routing_key_for(event['user_id']),
+    on_batch=save_batch_to_redis,
+    max_batch=int(os.environ.get('PUBLISH_BATCH_SIZE', 500)),
+    max_delay=float(os.environ.get('PUBLISH_BATCH_DELAY', 0.05)),
+    max_queue=int(os.environ.get('PUBLISH_QUEUE_SIZE', 10000)),
+)
+
 
-queue_name = "user_interactions"
-routing_key = "user.interact.message"
-exchange = "user.interact"
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        await rabbitmq.connect()
+    except Exception:
+        # не падаем при старте, соединение откроет первая публикация
+        logging.exception('rabbitmq unavailable at startup')
+    publisher.start()
+    yield
+    await publisher.stop()
+    await rabbitmq.close()
 
-_rabbitmq_connection: AbstractRobustConnection = None
-_rabbitmq_exchange = None
+
+app = FastAPI(lifespan=lifespan)
+instrument_app(app)
 
 # Configure CORS
 app.add_middleware(
@@ -47,53 +103,57 @@ app.add_middleware(
 @app.get('/healthcheck')
 def healthcheck():
     logging.info('/healthcheck')
-    return 200
+    # без брокера события принимать некуда
+    status_code = 200 if rabbitmq.is_healthy() else 503
+    return JSONResponse({'rabbitmq': rabbitmq.health()}, status_code=status_code)
 
 
 @app.post('/interact')
 async def interact(message: InteractEvent):
     logging.info(f'/interact {message.user_id} {message.item_ids}')
     message.timestamp = time.time()
-    await publish_message(Message(
-        bytes(json.dumps(message.model_dump()), "utf-8"),
-        content_type="text/json",
-    ))
-
-    for item_id in message.item_ids:
-        await watched_filter.add(message.user_id, item_id)
+    try:
+        confirmed = publisher.submit(message.model_dump())
+    except asyncio.QueueFull:
+        # буфер переполнен - просим клиента повторить позже, а не копим память
+        raise HTTPException(status_code=429, detail='too many events, retry later')
+    await confirmed
     return 200
 
-async def create_rabbitmq_exchange() -> AbstractRobustExchange:
-    global _rabbitmq_exchange, _rabbitmq_connection
-    if _rabbitmq_exchange is None or _rabbitmq_connection.is_closed:
-        conn_url = "amqp://{}:{}@{}/".format(
-            os.environ.get('RABBITMQ_USER', 'guest'),
-            os.environ.get('RABBITMQ_PASS', 'guest'),
-            os.environ.get('RABBITMQ_HOST', 'localhost')
-        )
-        _rabbitmq_connection = await aio_pika.connect_robust(
-            conn_url,
-            loop=asyncio.get_event_loop(),
-            port=int(os.environ.get('RABBITMQ_PORT', 5672))
-        )
-
-        # Creating channel
-        channel = await _rabbitmq_connection.channel()
-
-        # Declaring exchange
-        _rabbitmq_exchange = await channel.declare_exchange("user.interact", type='direct')
-
-        # Declaring queue
-        queue = await channel.declare_queue(queue_name)
-
-        # Binding queue
-        await queue.bind(_rabbitmq_exchange, routing_key)
-    return _rabbitmq_exchange
-
-
-async def publish_message(message: Message):
-    rabbitmq_exchange = await create_rabbitmq_exchange()
-    await rabbitmq_exchange.publish(
-        message,
-        routing_key,
-    )
+
+def parse_events(body, content_type):
+    """
+    :param body: JSON array of events or NDJSON, one event per line
+    :param content_type: request content type
+    :return: list of events as dicts
+    """
+    if content_type.startswith('application/x-ndjson'):
+        return [orjson.loads(line) for line in body.splitlines() if line.strip()]
+    events = orjson.loads(body)
+    return events if isinstance(events, list) else [events]
+
+
+@app.post('/interact/batch')
+async def interact_batch(request: Request):
+    try:
+        raw_events = parse_events(await request.body(), request.headers.get('content-type', ''))
+    except orjson.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f'invalid json: {e}')
+    if len(raw_events) > MAX_BATCH_EVENTS:
+        raise HTTPException(status_code=413, detail=f'more than {MAX_BATCH_EVENTS} events in one request')
+    # вся пачка проверяется одним вызовом pydantic
+    try:
+        events = events_adapter.validate_python(raw_events)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+    logging.info(f'/interact/batch {len(events)} events')
+    if not events:
+        return 200
+
+    timestamp = time.time()
+    try:
+        confirmed = publisher.submit_many([{**event.model_dump(), 'timestamp': timestamp} for event in events])
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=429, detail='too many events, retry later')
+    await confirmed
+    return 200
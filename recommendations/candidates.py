@@ -0,0 +1,93 @@
+import numpy as np
+
+
+class ItemArray:
+    """
+    Дописываемый массив идентификаторов фильмов (int64) с амортизированным ростом.
+    Повторно добавленные фильмы игнорируются.
+    """
+
+    def __init__(self, item_ids=(), capacity=1024):
+        item_ids = np.unique(np.asarray(list(item_ids), dtype=np.int64))
+        self._data = np.empty(max(capacity, len(item_ids)), dtype=np.int64)
+        self._data[:len(item_ids)] = item_ids
+        self._size = len(item_ids)
+        self._members = set(item_ids.tolist())
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def values(self):
+        return self._data[:self._size]
+
+    def extend(self, item_ids):
+        new_items = [item_id for item_id in dict.fromkeys(item_ids) if item_id not in self._members]
+        if not new_items:
+            return
+        if self._size + len(new_items) > len(self._data):
+            data = np.empty(max(2 * len(self._data), self._size + len(new_items)), dtype=np.int64)
+            data[:self._size] = self.values
+            self._data = data
+        self._data[self._size:self._size + len(new_items)] = new_items
+        self._size += len(new_items)
+        self._members.update(new_items)
+
+    def sample(self, k, rng):
+        return sample_items(self.values, k, rng)
+
+
+def sample_items(item_ids, k, rng):
+    """
+    Случайные k разных фильмов. Generator.choice без возвращения при малых k выбирает
+    индексы алгоритмом Флойда за O(k) и не перемешивает массив целиком, поэтому из
+    memmap каталога читаются только выбранные элементы.
+
+    :param item_ids: int64 array, e.g. a memory-mapped catalogue
+    """
+    if k >= len(item_ids):
+        return rng.permutation(item_ids)
+    return rng.choice(item_ids, k, replace=False)
+
+
+def blend(sources, quotas, k, exclude=()):
+    """
+    Смешивает кандидатов из нескольких источников.
+
+    Источники перечислены по приоритету. Сначала из каждого берется не больше его квоты,
+    затем недобор заполняется оставшимися кандидатами в порядке приоритета. Просмотренные
+    фильмы и повторы убираются заранее, поэтому при достаточном запасе кандидатов
+    в выдаче всегда k фильмов.
+
+    :param sources: dict source name -> item ids (int64) in source ranking order
+    :param quotas: dict source name -> number of items guaranteed to the source
+    :param k: number of items to return
+    :param exclude: item ids which must not be recommended
+    :return: int64 array of at most k items
+    """
+    names = list(sources)
+    arrays = [np.asarray(sources[name], dtype=np.int64) for name in names]
+    candidates = np.concatenate(arrays)
+    labels = np.repeat(np.arange(len(names)), [len(array) for array in arrays])
+
+    keep = ~np.isin(candidates, exclude)
+    candidates, labels = candidates[keep], labels[keep]
+    # фильм остается в самом приоритетном источнике, где он встретился
+    _, first = np.unique(candidates, return_index=True)
+    first = np.sort(first)
+    candidates, labels = candidates[first], labels[first]
+
+    # позиция кандидата внутри своего источника (метки идут по возрастанию)
+    rank = np.arange(len(labels)) - np.searchsorted(labels, labels)
+    limits = np.array([quotas.get(name, 0) for name in names], dtype=np.int64)
+    in_quota = rank < limits[labels]
+    return np.concatenate([candidates[in_quota], candidates[~in_quota]])[:k]
+
+
+def to_item_array(item_ids):
+    """
+    :param item_ids: item ids as str, bytes or int
+    :return: int64 array, non-numeric ids are dropped
+    """
+    item_ids = [item_id.decode() if isinstance(item_id, bytes) else str(item_id) for item_id in item_ids]
+    return np.array([int(item_id) for item_id in item_ids if item_id.isdigit()], dtype=np.int64)
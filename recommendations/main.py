@@ -1,86 +1,266 @@
 import os
 import asyncio
+import json
 import random
 import logging
-import requests
+import time
+from contextlib import asynccontextmanager
 
 import numpy as np
-import redis
-import aio_pika
-from aio_pika.abc import AbstractRobustExchange, AbstractRobustConnection
+import redis.asyncio as redis
 from fastapi import FastAPI
 
+from candidates import ItemArray, blend, sample_items, to_item_array
+from catalogue import CATALOGUE_PATH, Catalogue
+from instrumentation import instrument_app, track_call
+from item_index import ItemIndex
 from models import RecommendationsResponse, NewItemsEvent
+from rabbitmq_pool import RabbitMQPool
+from recent_likes import RecentLikes
+from recs_store import INVALIDATION_CHANNEL, LIKES_CHANNEL, RECS_GENERATION_KEY, recs_key, recent_likes_key
 from watched_filter import WatchedFilter
 
 logging.basicConfig(level=logging.INFO, filename=".logs",filemode="w",
                     format="%(asctime)s %(levelname)s %(message)s")
 
-app = FastAPI()
 redis_conn = 'redis://{username}:{password}@{host}:{port}/0'.format(
     username=os.environ.get('REDIS_USER', 'default'),
     password=os.environ.get('REDIS_PASSWORD'),
     host=os.environ.get('REDIS_HOST', 'localhost'),
     port=os.environ.get('REDIS_PORT', 6379),
 )
-redis_connection = redis.Redis.from_url(redis_conn)
-watched_filter = WatchedFilter()
+redis_connection = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+    redis_conn,
+    max_connections=int(os.environ.get('REDIS_POOL_SIZE', 64)),
+    timeout=5,
+))
+watched_filter = WatchedFilter(redis_connection=redis_connection)
 
-queue_name = "user_interactions"
-routing_key = "user.interact.message"
-exchange = "user.interact"
+# нужен только для очистки очереди в /cleanup
+rabbitmq = RabbitMQPool(pool_size=1)
 
-_rabbitmq_connection: AbstractRobustConnection = None
-_rabbitmq_exchange = None
-
-unique_item_ids = set()
+# фильмы, добавленные через /add_items
+unique_item_ids = ItemArray()
 EPSILON = 0.05
+rng = np.random.default_rng()
+
+# размер выдачи и квоты источников в порядке приоритета, например "personal:18,session:4,popular:5,random:3"
+TOP_K = int(os.environ.get('RECS_TOP_K', 30))
+SOURCE_QUOTAS = {
+    name: int(quota)
+    for name, quota in (part.split(':') for part in os.environ.get(
+        'RECS_QUOTAS', 'personal:18,session:4,popular:5,random:3').split(','))
+}
+# кандидатов из популярных и случайных берем с запасом, часть отсеется как просмотренные
+OVERFETCH = 3
+
+# индекс похожих фильмов строит ml-pipeline после обучения
+ITEM_INDEX_PATH = os.environ.get('ITEM_INDEX_PATH', './data/item_index.npz')
+_item_index: ItemIndex = None
+_item_index_mtime = None
+# последние лайки пользователей, event collector сообщает о новых через pub/sub
+recent_likes = RecentLikes(max_users=int(os.environ.get('RECENT_LIKES_CACHE_USERS', 100_000)))
+
+# каталог собирает сервис catalogue до запуска остальных; случайные кандидаты выбираются
+# прямо из отображенного в память массива id, общего с фронтендом, без копии в процессе
+catalogue = Catalogue(CATALOGUE_PATH)
+
+# редко меняющиеся значения держим в памяти процесса, ml-pipeline сообщает об их
+# обновлении через pub/sub, а на случай пропущенного сообщения они перечитываются по таймеру
+HOT_CACHE_REFRESH_INTERVAL = 30
+hot_cache = {'top_items': np.empty(0, dtype=np.int64), 'generation': None}
+
+
+async def refresh_hot_cache():
+    try:
+        pipe = redis_connection.pipeline(transaction=False)
+        pipe.json().get('top_items')
+        pipe.get(RECS_GENERATION_KEY)
+        with track_call('redis', 'hot_cache'):
+            top_items, generation = await pipe.execute()
+    except redis.ConnectionError:
+        return
+    hot_cache['top_items'] = to_item_array(top_items or [])
+    hot_cache['generation'] = generation.decode() if generation else None
+
 
-movie_id_imdb = eval(requests.get('http://frontend:8000/get_all_items').content.decode())
+async def listen_invalidations():
+    while True:
+        try:
+            async with redis_connection.pubsub() as pubsub:
+                await pubsub.subscribe(INVALIDATION_CHANNEL, LIKES_CHANNEL)
+                # пока подписки не было, сообщения о лайках терялись
+                recent_likes.clear()
+                await refresh_hot_cache()
+                refreshed_at = time.monotonic()
+                while True:
+                    # перечитываем и по сообщению об обновлении, и по истечении таймаута
+                    timeout = max(0.0, refreshed_at + HOT_CACHE_REFRESH_INTERVAL - time.monotonic())
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+                    if message is not None and message['channel'] == LIKES_CHANNEL.encode():
+                        for user_id, item_ids in json.loads(message['data']):
+                            recent_likes.push(user_id, item_ids)
+                        if time.monotonic() - refreshed_at < HOT_CACHE_REFRESH_INTERVAL:
+                            continue
+                    await refresh_hot_cache()
+                    refreshed_at = time.monotonic()
+        except redis.RedisError:
+            logging.warning('redis unavailable, hot cache is not refreshed')
+            await asyncio.sleep(HOT_CACHE_REFRESH_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    listener = asyncio.create_task(listen_invalidations())
+    yield
+    listener.cancel()
+    await rabbitmq.close()
+
+
+app = FastAPI(lifespan=lifespan)
+instrument_app(app)
 
 
 @app.get('/healthcheck')
 def healthcheck():
     logging.info('/healthcheck')
-    return 200
+    return {'rabbitmq': rabbitmq.health()}
 
 
 @app.post('/add_items')
 def add_movie(request: NewItemsEvent):
-    global unique_item_ids
-    for item_id in request.item_ids:
-        logging.info(f'/add_item {item_id}')
-        unique_item_ids.add(item_id)
+    logging.info(f'/add_item {request.item_ids}')
+    unique_item_ids.extend(to_item_array(request.item_ids).tolist())
     return 200
 
 
 @app.get('/recs/{user_id}')
-def get_recs(user_id: str):
+async def get_recs(user_id: str):
     logging.info(f'/recs/{user_id}')
-    global unique_item_ids
 
-    #  Персональные рекомендации
+    quotas = SOURCE_QUOTAS
+    random_pool = catalogue.item_ids
+    #  С определенным шансом берутся случайные, в первую очередь из новых фильмов
+    if random.random() < EPSILON:
+        quotas = {'random': TOP_K}
+        if len(unique_item_ids) != 0:
+            random_pool = unique_item_ids.values
+    popular_item_ids = hot_cache['top_items'][:OVERFETCH * TOP_K].tolist()
+    random_item_ids = sample_items(random_pool, OVERFETCH * quotas.get('random', 0) + TOP_K, rng).tolist()
+    #  Похожие на последние лайки строятся по их копии в памяти, поэтому тоже известны до запроса.
+    #  Для пользователя, которого процесс еще не видел, их нет до следующего запроса
+    session_item_ids = to_item_array(session_candidates(
+        recent_likes.get(user_id), OVERFETCH * SOURCE_QUOTAS.get('session', 0))).tolist()
+
+    #  Все кандидаты проверяются на просмотренность за один round-trip: известные заранее -
+    #  через SMISMEMBER, а персональные Redis сам вычитает из их sorted set через ZDIFF.
+    #  Последние лайки читаются в том же pipeline и обновляют копию в памяти
+    generation = hot_cache['generation']
+    personal_item_ids = []
     try:
-        item_ids = redis_connection.json().get(user_id)
-        popular_item_ids = redis_connection.json().get('top_items')
-        random_item_ids = np.random.choice(list(movie_id_imdb), size=20, replace=False).tolist()
+        pipe = redis_connection.pipeline(transaction=False)
+        pipe.lrange(recent_likes_key(user_id), 0, -1)
+        watched_filter.filter_in_pipeline(pipe, user_id, popular_item_ids)
+        watched_filter.filter_in_pipeline(pipe, user_id, random_item_ids)
+        watched_filter.filter_in_pipeline(pipe, user_id, session_item_ids)
+        if generation is not None:
+            watched_filter.diff_in_pipeline(pipe, user_id, recs_key(generation, user_id))
+        with track_call('redis', 'recs'):
+            results = await pipe.execute()
+        recent_likes.set(user_id, [item_id.decode() for item_id in results[0]])
+        popular_item_ids = WatchedFilter.unwatched(popular_item_ids, results[1])
+        random_item_ids = WatchedFilter.unwatched(random_item_ids, results[2])
+        session_item_ids = WatchedFilter.unwatched(session_item_ids, results[3])
+        if generation is not None:
+            personal_item_ids = to_item_array(results[4]).tolist()
+    except redis.ConnectionError:
+        # без redis остаются популярные из кэша и случайные
+        session_item_ids = []
 
-        item_ids = item_ids if item_ids else [] + popular_item_ids if popular_item_ids else [] + random_item_ids
+    item_ids = blend(
+        {
+            'personal': personal_item_ids,
+            'session': session_item_ids,
+            'popular': popular_item_ids,
+            'random': random_item_ids,
+        },
+        quotas,
+        TOP_K,
+    )
+    return RecommendationsResponse(item_ids=item_ids.astype(str).tolist())
 
-    except redis.exceptions.ConnectionError:
-        item_ids = np.random.choice(list(unique_item_ids), size=20, replace=False).tolist()
 
-    #  С определенным шансом берутся случайные
-    if random.random() < EPSILON:
-        if len(unique_item_ids) != 0:
-            item_ids = np.random.choice(list(unique_item_ids), size=20, replace=False).tolist()
-        else:
-            item_ids = np.random.choice(list(movie_id_imdb), size=20, replace=False).tolist()
+@app.get('/popular')
+def get_popular(k: int = 100):
+    logging.info('/popular')
+    # без обращения к redis, фронтенд использует список как fallback
+    return RecommendationsResponse(item_ids=hot_cache['top_items'][:k].astype(str).tolist())
+
+
+def get_item_index():
+    """
+    :return: item index, reloaded when the pipeline writes a new one, or None
+    """
+    global _item_index, _item_index_mtime
+    try:
+        mtime = os.stat(ITEM_INDEX_PATH).st_mtime
+    except FileNotFoundError:
+        return _item_index
+    if mtime != _item_index_mtime:
+        logging.info(f'loading item index {ITEM_INDEX_PATH}')
+        _item_index = ItemIndex.load(ITEM_INDEX_PATH)
+        _item_index_mtime = mtime
+    return _item_index
+
+
+def session_candidates(likes, k):
+    """
+    :param likes: recent likes, newest first, or None
+    :return: up to k items similar to the likes
+    """
+    item_index = get_item_index()
+    if item_index is None or not likes or k <= 0:
+        return []
+    return item_index.similar(likes, k)
+
 
-    #  Фильтруем уже просмотренные
-    item_ids = [i for i in item_ids if redis_connection.get(f"{user_id}_{i}") is None]
+@app.get('/similar/{item_id}')
+def get_similar(item_id: str, k: int = 20):
+    logging.info(f'/similar/{item_id}')
+    item_index = get_item_index()
+    if item_index is None:
+        return RecommendationsResponse(item_ids=[])
+    return RecommendationsResponse(item_ids=item_index.similar([item_id], k))
+
+
+@app.get('/session/{user_id}')
+async def get_session_recs(user_id: str, k: int = 20):
+    logging.info(f'/session/{user_id}')
+    if get_item_index() is None:
+        return RecommendationsResponse(item_ids=[])
+    # берем с запасом, часть отсеется как уже просмотренные
+    likes = recent_likes.get(user_id)
+    item_ids = session_candidates(likes, 2 * k)
+    try:
+        pipe = redis_connection.pipeline(transaction=False)
+        pipe.lrange(recent_likes_key(user_id), 0, -1)
+        watched_filter.filter_in_pipeline(pipe, user_id, item_ids)
+        with track_call('redis', 'session'):
+            fresh_likes, watched = await pipe.execute()
+    except redis.ConnectionError:
+        return RecommendationsResponse(item_ids=[])
+
+    fresh_likes = [item_id.decode() for item_id in fresh_likes]
+    recent_likes.set(user_id, fresh_likes)
+    if fresh_likes == likes:
+        item_ids = WatchedFilter.unwatched(item_ids, watched)
+    else:
+        # первый запрос пользователя после старта процесса или лайк, сообщение о котором еще
+        # не дошло: других кандидатов у этого маршрута нет, поэтому проверяем свежие отдельно
+        with track_call('redis', 'watched'):
+            item_ids = await watched_filter.filter(user_id, session_candidates(fresh_likes, 2 * k))
+    return RecommendationsResponse(item_ids=item_ids[:k])
 
-    return RecommendationsResponse(item_ids=item_ids)
 
 @app.post('/cleanup')
 async def cleanup():
@@ -88,46 +268,12 @@ async def cleanup():
 
     # Clear Redis
     global unique_item_ids
-    unique_item_ids = set()
-    redis_connection.flushall()
+    unique_item_ids = ItemArray()
+    recent_likes.clear()
+    with track_call('redis', 'flushall'):
+        await redis_connection.flushall()
+    await refresh_hot_cache()
     
     # Clear RabbitMQ
-    global _rabbitmq_exchange, _rabbitmq_connection
-    await create_rabbitmq_exchange()
-
-    # Getting channel
-    channel = await _rabbitmq_connection.channel()
-
-    # Getting queue
-    queue = await channel.declare_queue(queue_name)
-
-    # Clear queue
-    await queue.purge()
+    await rabbitmq.purge_queue()
     return 200
-
-async def create_rabbitmq_exchange() -> AbstractRobustExchange:
-    global _rabbitmq_exchange, _rabbitmq_connection
-    if _rabbitmq_exchange is None or _rabbitmq_connection.is_closed:
-        conn_url = "amqp://{}:{}@{}/".format(
-            os.environ.get('RABBITMQ_USER', 'guest'),
-            os.environ.get('RABBITMQ_PASS', 'guest'),
-            os.environ.get('RABBITMQ_HOST', 'localhost')
-        )
-        _rabbitmq_connection = await aio_pika.connect_robust(
-            conn_url,
-            loop=asyncio.get_event_loop(),
-            port=int(os.environ.get('RABBITMQ_PORT', 5672))
-        )
-
-        # Creating channel
-        channel = await _rabbitmq_connection.channel()
-
-        # Declaring exchange
-        _rabbitmq_exchange = await channel.declare_exchange("user.interact", type='direct')
-
-        # Declaring queue
-        queue = await channel.declare_queue(queue_name)
-
-        # Binding queue
-        await queue.bind(_rabbitmq_exchange, routing_key)
-    return _rabbitmq_exchange
\ No newline at end of file
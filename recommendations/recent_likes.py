@@ -0,0 +1,56 @@
+from collections import OrderedDict
+
+from recs_store import RECENT_LIKES_LIMIT
+
+
+class RecentLikes:
+    """
+    Копия последних лайков пользователей в памяти процесса, как списки ``likes:<user_id>``
+    в Redis: новые лайки в начале, не больше ``limit`` на пользователя.
+
+    Event collector сообщает о новых лайках через pub/sub, поэтому кандидаты по сессии
+    известны до запроса к Redis и проверяются на просмотренность в том же round-trip,
+    что и остальные кандидаты. Лайки приходят только для уже известных пользователей:
+    без полного списка из Redis дописывать некуда. Давно не встречавшиеся пользователи
+    вытесняются, когда их больше ``max_users``.
+
+    :param max_users: max number of users kept
+    :param limit: max number of likes kept per user
+    """
+
+    def __init__(self, max_users=100_000, limit=RECENT_LIKES_LIMIT):
+        self.max_users = max_users
+        self.limit = limit
+        self._likes = OrderedDict()
+
+    def __len__(self):
+        return len(self._likes)
+
+    def get(self, user_id):
+        """
+        :return: item ids, newest first, or None if the user is not cached
+        """
+        likes = self._likes.get(user_id)
+        if likes is not None:
+            self._likes.move_to_end(user_id)
+        return likes
+
+    def set(self, user_id, item_ids):
+        """
+        :param item_ids: full list of recent likes read from Redis, newest first
+        """
+        self._likes[user_id] = list(item_ids)[:self.limit]
+        self._likes.move_to_end(user_id)
+        if len(self._likes) > self.max_users:
+            self._likes.popitem(last=False)
+
+    def push(self, user_id, item_ids):
+        """
+        Повторяет LPUSH и LTRIM event collector-а для известного пользователя.
+        """
+        likes = self._likes.get(user_id)
+        if likes is not None:
+            self._likes[user_id] = (list(reversed(item_ids)) + likes)[:self.limit]
+
+    def clear(self):
+        self._likes.clear()
@@ -0,0 +1,90 @@
+from itertools import chain
+
+import numpy as np
+
+
+# сколько памяти можно занять под матрицу скоров одной пачки пользователей
+SCORES_MEMORY_BUDGET = 64 * 1024 ** 2
+
+
+def _context_vectors(model, contexts):
+    key_to_index = model.wv.key_to_index
+    lengths = np.fromiter((len(context) for context in contexts), dtype=np.int64, count=len(contexts))
+    flat = np.fromiter(
+        (key_to_index.get(key, -1) for key in chain.from_iterable(contexts)),
+        dtype=np.int64,
+        count=int(lengths.sum()),
+    )
+    rows = np.repeat(np.arange(len(contexts)), lengths)
+    # слова не из словаря пропускаются, как и в predict_output_word
+    known = flat >= 0
+    flat, rows = flat[known], rows[known]
+    counts = np.bincount(rows, minlength=len(contexts))
+
+    vectors = np.zeros((len(contexts), model.wv.vector_size), dtype=np.float32)
+    nonempty = np.flatnonzero(counts)
+    if len(nonempty):
+        starts = np.concatenate([[0], np.cumsum(counts[nonempty])[:-1]])
+        vectors[nonempty] = np.add.reduceat(model.wv.vectors[flat], starts, axis=0)
+        if model.cbow_mean:
+            vectors[nonempty] /= counts[nonempty, None]
+    return vectors, counts > 0
+
+
+def _mask(scores, exclude, key_to_index):
+    rows, cols = [], []
+    for row, keys in enumerate(exclude):
+        for key in keys:
+            index = key_to_index.get(key)
+            if index is not None:
+                rows.append(row)
+                cols.append(index)
+    scores[rows, cols] = -np.inf
+
+
+def predict_output_words(model, contexts, topn, exclude=None):
+    """
+    Пакетный аналог ``Word2Vec.predict_output_word``: контекстные векторы всех
+    пользователей пачки считаются разом и умножаются на выходную матрицу эмбеддингов.
+    Softmax монотонен, поэтому порядок берется прямо по скалярным произведениям.
+
+    :param model: trained gensim Word2Vec with negative sampling
+    :param contexts: list of context item lists, one per user
+    :param topn: number of items to return
+    :param exclude: optional list of item lists masked out per user (e.g. history)
+    :return: (n_users, topn) array of vocabulary indices, rows without known context are -1
+    """
+    n_items = len(model.wv.index_to_key)
+    topn = min(topn, n_items)
+    chunk_size = max(1, SCORES_MEMORY_BUDGET // (n_items * 4))
+    output = model.syn1neg.T
+    result = np.full((len(contexts), topn), -1, dtype=np.int64)
+
+    for start in range(0, len(contexts), chunk_size):
+        chunk = contexts[start:start + chunk_size]
+        vectors, has_context = _context_vectors(model, chunk)
+        scores = vectors @ output
+        if exclude is not None:
+            _mask(scores, exclude[start:start + chunk_size], model.wv.key_to_index)
+
+        if topn < n_items:
+            top = np.argpartition(-scores, topn - 1, axis=1)[:, :topn]
+        else:
+            top = np.broadcast_to(np.arange(n_items), scores.shape)
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(scores, top, axis=1)
+
+        # замаскированные элементы не возвращаем
+        top[np.isneginf(top_scores)] = -1
+        top[~has_context] = -1
+        result[start:start + len(chunk)] = top
+    return result
+
+
+def indices_to_keys(model, indices):
+    """
+    :return: list of recommended keys per user without padding
+    """
+    index_to_key = model.wv.index_to_key
+    return [[index_to_key[i] for i in row if i >= 0] for row in indices]
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import math
+import os
+import time
+
+import orjson
+import polars as pl
+
+from interaction_store import SCHEMA
+from rabbitmq_pool import RabbitMQPool
+
+# сколько сообщений брокер выдает без подтверждения и как часто они сбрасываются в хранилище
+CONSUMER_PREFETCH = int(os.environ.get('CONSUMER_PREFETCH', 1000))
+CONSUMER_FLUSH_INTERVAL = float(os.environ.get('CONSUMER_FLUSH_INTERVAL', 10))
+ACTIONS = {'like', 'dislike'}
+
+
+class BatchConsumer:
+    """
+    Читает события из очереди RabbitMQ и сбрасывает их в хранилище пачками.
+
+    Тела сообщений сразу раскладываются по колонкам будущего DataFrame. Сообщения
+    подтверждаются одним ``ack(multiple=True)`` только после того, как пачка записана,
+    поэтому при падении незаписанные события будут доставлены повторно (at-least-once).
+    Пачка сбрасывается по таймеру, даже если очередь молчит, или раньше, когда набралось
+    ``max_messages`` неподтвержденных сообщений или ``max_events`` событий.
+
+    :param queue: aio-pika queue, channel prefetch should be at least ``max_messages``
+    :param write: blocking durable write of a DataFrame, runs in a thread
+    :param on_events: optional callable called with decoded events of every message
+    :param on_flush: optional callable called with number of events, seconds and success of every flush
+    :param flush_interval: max time in seconds between flushes
+    :param max_messages: number of unacked messages that triggers a flush
+    :param max_events: number of buffered events that triggers a flush
+    :param stats: optional dict updated with consumer statistics
+    """
+
+    def __init__(self, queue, write, on_events=None, on_flush=None, flush_interval=CONSUMER_FLUSH_INTERVAL,
+                 max_messages=CONSUMER_PREFETCH, max_events=100_000, stats=None):
+        self.queue = queue
+        self.write = write
+        self.on_events = on_events
+        self.on_flush = on_flush
+        self.flush_interval = flush_interval
+        self.max_messages = max_messages
+        self.max_events = max_events
+        self.stats = stats if stats is not None else {}
+        self.stats.update({'unflushed_events': 0, 'flushes': 0, 'failed_flushes': 0,
+                           'last_batch_size': 0, 'last_flush_duration': None})
+        self._messages = []
+        self._columns = self._empty_columns()
+        self._flush_requested = asyncio.Event()
+
+    @staticmethod
+    def _empty_columns():
+        return {name: [] for name in SCHEMA}
+
+    def _decode(self, body):
+        message = orjson.loads(body)
+        # event collector публикует пачки событий, одиночное событие - старый формат
+        events = message if isinstance(message, list) else [message]
+        # сначала раскладываем во временные колонки, чтобы битое событие не испортило буфер:
+        # все, что попало в буфер, должно собраться в DataFrame, иначе пачка с ним
+        # возвращалась бы в очередь и падала при каждой повторной доставке
+        columns = self._empty_columns()
+        decoded = []
+        for event in events:
+            user_id = str(event['user_id'])
+            item_ids = [str(item_id) for item_id in event['item_ids']]
+            actions = list(event['actions'])
+            timestamp = float(event['timestamp'])
+            if not math.isfinite(timestamp):
+                raise ValueError(f'timestamp {timestamp}')
+            if len(actions) != len(item_ids):
+                raise ValueError(f'{len(item_ids)} item_ids and {len(actions)} actions')
+            if not set(actions) <= ACTIONS:
+                raise ValueError(f'unknown actions {set(actions) - ACTIONS}')
+            columns['user_id'].extend([user_id] * len(item_ids))
+            columns['item_id'].extend(item_ids)
+            columns['action'].extend(actions)
+            columns['timestamp'].extend([timestamp] * len(item_ids))
+            decoded.append({'user_id': user_id, 'item_ids': item_ids, 'actions': actions, 'timestamp': timestamp})
+        for name, values in columns.items():
+            self._columns[name].extend(values)
+        return decoded
+
+    async def _on_message(self, message):
+        try:
+            events = self._decode(message.body)
+        except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+            # битое сообщение не исправится при повторной доставке, поэтому оно отбрасывается
+            # само по себе и не возвращает в очередь остальную пачку
+            logging.exception('dropping malformed message')
+            await message.reject()
+            return
+        self._messages.append(message)
+        if self.on_events is not None:
+            self.on_events(events)
+        self.stats['unflushed_events'] = len(self._columns['user_id'])
+        if len(self._messages) >= self.max_messages or self.stats['unflushed_events'] >= self.max_events:
+            self._flush_requested.set()
+
+    async def flush(self):
+        if not self._messages:
+            return
+        messages, columns = self._messages, self._columns
+        self._messages, self._columns = [], self._empty_columns()
+        self.stats['unflushed_events'] = 0
+
+        t_start = time.time()
+        n_events = len(columns['user_id'])
+        # типы проверены в _decode, в очередь возвращаются только пачки, которые не удалось записать
+        df = pl.DataFrame(columns, schema=SCHEMA)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.write, df)
+        except Exception:
+            self.stats['failed_flushes'] += 1
+            logging.exception(f'failed to write {n_events} events, returning them to the queue')
+            await messages[-1].nack(multiple=True, requeue=True)
+            if self.on_flush is not None:
+                self.on_flush(n_events, time.time() - t_start, False)
+            return
+
+        try:
+            # подтверждает все сообщения канала до последнего в пачке
+            await messages[-1].ack(multiple=True)
+        except Exception:
+            # канал переоткрылся, брокер доставит эти сообщения повторно
+            logging.exception(f'failed to ack {len(messages)} messages')
+        self.stats['flushes'] += 1
+        self.stats['last_batch_size'] = n_events
+        self.stats['last_flush_duration'] = time.time() - t_start
+        if self.on_flush is not None:
+            self.on_flush(n_events, self.stats['last_flush_duration'], True)
+        logging.info(f'saved {n_events} events from {len(messages)} messages')
+
+    async def run(self):
+        await self.queue.consume(self._on_message)
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+
+async def open_rabbitmq_queue(shard, num_shards):
+    """
+    :return: queue of the shard on a new channel with prefetch for a whole batch
+    """
+    rabbitmq = RabbitMQPool(num_shards=num_shards)
+    connection = await rabbitmq.connect()
+    channel = await connection.channel()
+    # сообщения подтверждаются пачкой после записи, поэтому брокер должен
+    # выдавать их с запасом на целую пачку
+    await channel.set_qos(prefetch_count=CONSUMER_PREFETCH)
+    # exchange и binding объявлены в RabbitMQPool.connect, очередь объявляется на этом
+    # канале повторно, чтобы robust-канал восстановил подписку после переподключения
+    return await channel.declare_queue(rabbitmq.queue_name(shard))
@@ -0,0 +1,22 @@
+class SessionCorpus:
+    """
+    Перезапускаемый корпус предложений для Word2Vec поверх списковой колонки polars.
+
+    Word2Vec проходит по корпусу несколько раз (словарь и каждая эпоха), поэтому нужен
+    итерируемый объект, а не генератор. Предложения превращаются в python-списки кусками
+    по ``chunk_size``, так что в памяти одновременно живет один кусок, а не весь корпус.
+
+    :param sentences: polars Series of lists of item indices
+    :param chunk_size: number of sentences converted at once
+    """
+
+    def __init__(self, sentences, chunk_size=10_000):
+        self.sentences = sentences
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def __iter__(self):
+        for offset in range(0, len(self.sentences), self.chunk_size):
+            yield from self.sentences.slice(offset, self.chunk_size).to_list()
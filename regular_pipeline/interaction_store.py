@@ -0,0 +1,194 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager, ExitStack
+
+import polars as pl
+
+
+SCHEMA = {
+    'user_id': pl.String,
+    'item_id': pl.String,
+    'action': pl.String,
+    'timestamp': pl.Float64,
+}
+
+
+class InteractionStore:
+    """
+    Append-only хранилище истории взаимодействий.
+
+    Каждый сброс пачки событий пишется отдельным parquet-сегментом в партицию
+    по дню события (``date=YYYY-MM-DD``). Сегмент сначала пишется во временный
+    файл и затем атомарно переименовывается, поэтому читатели никогда не видят
+    недописанных данных, а стоимость записи зависит только от размера пачки.
+    Мелкие сегменты периодически сливаются в один методом ``compact``.
+
+    :param path: store directory
+    :param recover: finish interrupted compactions and remove temporary files on start,
+        should be False in processes which only append while another one compacts
+    """
+
+    def __init__(self, path='./data/interactions', recover=True):
+        self.path = path
+        # компакция удаляет сегменты, поэтому не должна идти во время чтения через snapshot
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        if recover:
+            self._recover()
+
+    def _partition_path(self, date):
+        return os.path.join(self.path, f'date={date}')
+
+    def _segments(self, partition='*'):
+        return sorted(glob.glob(os.path.join(self.path, partition, '*.parquet')))
+
+    def _write_atomic(self, df, path):
+        tmp_path = path + '.tmp'
+        df.write_parquet(tmp_path)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def append(self, df):
+        """
+        :param df: new interactions with columns user_id, item_id, action, timestamp
+        :return: number of written rows
+        """
+        if len(df) == 0:
+            return 0
+        df = df.select([pl.col(name).cast(dtype) for name, dtype in SCHEMA.items()])
+        df = df.with_columns(
+            pl.from_epoch(pl.col('timestamp'), time_unit='s').dt.strftime('%Y-%m-%d').alias('_date')
+        )
+        for (date,), part in df.group_by(['_date']):
+            partition = self._partition_path(date)
+            os.makedirs(partition, exist_ok=True)
+            segment = os.path.join(partition, f'part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet')
+            self._write_atomic(part.drop('_date'), segment)
+        return len(df)
+
+    def is_empty(self):
+        return len(self._segments()) == 0
+
+    def scan(self):
+        """
+        :return: lazy frame over all committed segments
+        """
+        segments = self._segments()
+        if not segments:
+            return pl.LazyFrame(schema=SCHEMA)
+        return pl.scan_parquet(segments)
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Как ``scan``, но гарантирует, что сегменты не удалит компакция, пока идет чтение.
+        """
+        with self._lock:
+            yield self.scan()
+
+    def compact(self, min_segments=8):
+        """
+        Сливает сегменты каждой партиции в один, если их накопилось не меньше ``min_segments``.
+        Перед заменой пишется манифест со списком исходных файлов, чтобы после падения
+        процесса можно было довести или откатить компакцию в ``_recover``.
+        """
+        for partition in sorted(glob.glob(os.path.join(self.path, 'date=*'))):
+            segments = self._segments(os.path.basename(partition))
+            if len(segments) < min_segments:
+                continue
+            logging.info(f'compacting {len(segments)} segments in {partition}')
+            compacted = os.path.join(partition, f'part-{time.time_ns()}-compacted.parquet')
+            pl.scan_parquet(segments).sort('timestamp').collect().write_parquet(compacted + '.tmp')
+
+            with self._lock:
+                manifest = os.path.join(partition, '_compaction.json')
+                with open(manifest + '.tmp', 'w') as f:
+                    json.dump({'target': compacted, 'sources': segments}, f)
+                os.replace(manifest + '.tmp', manifest)
+
+                os.replace(compacted + '.tmp', compacted)
+                self._finish_compaction(manifest)
+
+    def _finish_compaction(self, manifest):
+        with open(manifest) as f:
+            compaction = json.load(f)
+        if os.path.exists(compaction['target']):
+            # новый сегмент на месте - исходные больше не нужны
+            for segment in compaction['sources']:
+                if os.path.exists(segment):
+                    os.remove(segment)
+        os.remove(manifest)
+
+    def _recover(self):
+        for manifest in glob.glob(os.path.join(self.path, 'date=*', '_compaction.json')):
+            logging.warning(f'recovering interrupted compaction {manifest}')
+            self._finish_compaction(manifest)
+        for tmp_path in glob.glob(os.path.join(self.path, 'date=*', '*.tmp')):
+            os.remove(tmp_path)
+
+    def import_csv(self, csv_path):
+        """
+        Переносит историю из старого interactions.csv в хранилище (однократно).
+        """
+        if not os.path.exists(csv_path):
+            return
+        logging.info(f'importing {csv_path} into interaction store')
+        self.append(pl.read_csv(csv_path, schema_overrides={'item_id': pl.String}))
+        os.replace(csv_path, csv_path + '.migrated')
+
+
+
+class ShardedInteractionStore:
+    """
+    Хранилище, разбитое по шардам пользователей: процесс-потребитель шарда K пишет
+    в свое ``InteractionStore`` в ``shard=K``, а чтение и компакция идут по всем шардам сразу.
+    Данные, записанные до шардирования, остаются в корне и читаются вместе с шардами.
+
+    :param path: root directory
+    :param num_shards: number of shards
+    """
+
+    def __init__(self, path='./data/interactions', num_shards=1):
+        self.path = path
+        self.root = InteractionStore(path)
+        self.shards = [InteractionStore(self.shard_path(path, shard)) for shard in range(num_shards)]
+
+    @staticmethod
+    def shard_path(path, shard):
+        return os.path.join(path, f'shard={shard}')
+
+    @property
+    def stores(self):
+        return [self.root, *self.shards]
+
+    def is_empty(self):
+        return all(store.is_empty() for store in self.stores)
+
+    def scan(self):
+        """
+        :return: lazy frame over committed segments of all shards
+        """
+        segments = [segment for store in self.stores for segment in store._segments()]
+        if not segments:
+            return pl.LazyFrame(schema=SCHEMA)
+        return pl.scan_parquet(segments)
+
+    @contextmanager
+    def snapshot(self):
+        with ExitStack() as stack:
+            for store in self.stores:
+                stack.enter_context(store._lock)
+            yield self.scan()
+
+    def compact(self, min_segments=8):
+        for store in self.stores:
+            store.compact(min_segments)
+
+    def import_csv(self, csv_path):
+        self.root.import_csv(csv_path)
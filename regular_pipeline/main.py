@@ -1,19 +1,20 @@
 import asyncio
-import json
 import os.path
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-import aio_pika
-import polars as pl
 import redis
 from aio_pika import Message
 
+from consumer import BatchConsumer, open_rabbitmq_queue
+from instrumentation import CONSUMER_EVENTS, CONSUMER_LAG, start_metrics_server, track_call, track_flush
+from interaction_store import InteractionStore, ShardedInteractionStore
 from ml_model import W2V_model
-
-
-logging.basicConfig(level=logging.INFO, filename=".logs",filemode="w",
-                    format="%(asctime)s %(levelname)s %(message)s")
+from popularity import PopularityEngine
+from rabbitmq_pool import NUM_SHARDS
+from recs_store import INVALIDATION_CHANNEL
+from shards import ShardWorkers
 
 
 redis_conn = 'redis://{username}:{password}@{host}:{port}/0'.format(
@@ -24,101 +25,139 @@ redis_conn = 'redis://{username}:{password}@{host}:{port}/0'.format(
 )
 redis_connection = redis.Redis.from_url(redis_conn)
 
+# состояние создается в main(): процессы подбора параметров импортируют этот модуль
+# и не должны трогать хранилище
+interaction_store: InteractionStore = None
+popularity: PopularityEngine = None
+
+# отставание потребителя: сколько секунд прошло от события до его чтения из очереди
+consumer_stats = {'lag': 0.0, 'unflushed_events': 0}
+
+
+class JobScheduler:
+    """
+    Запускает тяжелые задачи (сборка датасета, подбор параметров, обучение, публикация)
+    в пуле потоков, чтобы event loop продолжал читать очередь. Если предыдущий запуск
+    задачи еще не закончился, новый пропускается.
+    """
+
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pipeline-job')
+        self.running = {}
+        self.stats = {}
+
+    def submit(self, name, func, *args):
+        stats = self.stats.setdefault(name, {'runs': 0, 'skipped': 0, 'failed': 0, 'last_duration': None})
+        if name in self.running:
+            stats['skipped'] += 1
+            logging.warning(f'job {name} is still running for '
+                            f'{time.time() - self.running[name]:.1f}s, skipping')
+            return None
+        self.running[name] = time.time()
+        return asyncio.create_task(self._run(name, func, *args))
+
+    async def _run(self, name, func, *args):
+        stats = self.stats[name]
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        except Exception:
+            stats['failed'] += 1
+            logging.exception(f'job {name} failed')
+        finally:
+            stats['runs'] += 1
+            stats['last_duration'] = time.time() - self.running.pop(name)
+            logging.info(f'job {name} finished in {stats["last_duration"]:.1f}s')
+
+
+scheduler: JobScheduler = None
+
+
+def track_events(events):
+    for event in events:
+        popularity.update_event(event)
+    if events:
+        consumer_stats['lag'] = time.time() - events[-1]['timestamp']
+        CONSUMER_LAG.set(consumer_stats['lag'])
+        CONSUMER_EVENTS.inc(len(events))
 
-async def collect_messages():
-    conn_url = "amqp://{}:{}@{}/".format(
-        os.environ.get('RABBITMQ_USER', 'guest'),
-        os.environ.get('RABBITMQ_PASS', 'guest'),
-        os.environ.get('RABBITMQ_HOST', 'localhost')
-    )
-    connection = await aio_pika.connect_robust(
-        conn_url,
-        loop=asyncio.get_event_loop(),
-        port=int(os.environ.get('RABBITMQ_PORT', 5672))
-    )
-
-    queue_name = "user_interactions"
-    routing_key = "user.interact.message"
-    exchange = "user.interact"
-
-    async with connection:
-        # Creating channel
-        channel = await connection.channel()
-
-        # Will take no more than 50 messages in advance
-        await channel.set_qos(prefetch_count=50)
-
-        # Declaring queue
-        queue = await channel.declare_queue(queue_name)
-
-        # Declaring exchange
-        exchange = await channel.declare_exchange(exchange, type='direct')
-        await queue.bind(exchange, routing_key)
-
-        t_start = time.time()
-        data = []
-        async with queue.iterator() as queue_iter:
-            async for message in queue_iter:
-                async with message.process():
-                    message = message.body.decode()
-                    message = json.loads(message)
-                    data.append(message)
-                    if time.time() - t_start > 10:
-                        logging.info('saving events from rabbitmq')
-                        # update data if 10s passed
-                        new_data = pl.DataFrame(data).explode(['item_ids', 'actions']).rename({
-                            'item_ids': 'item_id',
-                            'actions': 'action'
-                        })
-
-                        if len(new_data) > 0:
-                            if os.path.exists('./data/interactions.csv'):
-                                data = pl.concat([pl.read_csv('./data/interactions.csv', schema_overrides={'item_id': pl.String}), new_data])
-                            else:
-                                data = new_data
-                            data.write_csv('./data/interactions.csv')
-
-                        data = []
-                        t_start = time.time()
 
+async def collect_messages():
+    if NUM_SHARDS == 1:
+        queue = await open_rabbitmq_queue(0, 1)
+        consumer = BatchConsumer(queue, interaction_store.append, on_events=track_events,
+                                 on_flush=lambda *flush: track_flush(0, *flush), stats=consumer_stats)
+        await consumer.run()
+    else:
+        # каждый шард читает и пишет отдельный процесс, сюда приходят только события для популярного
+        workers = ShardWorkers(NUM_SHARDS, interaction_store.path)
+        await workers.run(track_events, consumer_stats, track_flush)
 
 
 async def calculate_top_recommendations():
+    published_top_items = None
     while True:
-        if os.path.exists('./data/interactions.csv'):
-            logging.info('calculating top recommendations')
-            interactions = pl.read_csv('./data/interactions.csv', schema_overrides={'item_id': pl.String})
-            top_items = (
-                interactions
-                .sort('timestamp')
-                .unique(['user_id', 'item_id', 'action'], keep='last')
-                .filter(pl.col('action') == 'like')
-                .group_by('item_id')
-                .len()
-                .sort('len', descending=True)
-                .head(500)
-            )['item_id'].to_list()
-
-            top_items = [str(item_id) for item_id in top_items]
-
-            redis_connection.json().set('top_items', '.', top_items)
+        logging.info('calculating top recommendations')
+        popularity.expire(time.time())
+        top_items = popularity.top()
+        if top_items:
+            with track_call('redis', 'top_items'):
+                redis_connection.json().set('top_items', '.', top_items)
+                if top_items != published_top_items:
+                    # сервис рекомендаций держит top_items в памяти и перечитывает по сигналу
+                    redis_connection.publish(INVALIDATION_CHANNEL, 'top_items')
+                    published_top_items = top_items
         await asyncio.sleep(10)
 
 
 async def calculate_w2v_recommendations():
     while True:
-        if os.path.exists('./data/interactions.csv'):
+        if not interaction_store.is_empty():
             logging.info('calculating w2v recommendations')
-            W2V_model.run_pipeline()
+            scheduler.submit('w2v', W2V_model.run_pipeline, interaction_store)
+        await asyncio.sleep(60)
+
+
+async def compact_interactions():
+    while True:
+        await asyncio.sleep(600)
+        logging.info('compacting interaction store')
+        scheduler.submit('compaction', interaction_store.compact)
+
+
+async def report_stats():
+    while True:
         await asyncio.sleep(60)
+        logging.info(f'consumer: {consumer_stats}, jobs: {scheduler.stats}')
+
 
 async def main():
+    global interaction_store, popularity, scheduler
+    start_metrics_server()
+    scheduler = JobScheduler()
+    if NUM_SHARDS == 1:
+        interaction_store = InteractionStore('./data/interactions')
+    else:
+        interaction_store = ShardedInteractionStore('./data/interactions', NUM_SHARDS)
+    # история, накопленная до перехода на parquet-хранилище
+    interaction_store.import_csv('./data/interactions.csv')
+
+    popularity = PopularityEngine(
+        top_n=500,
+        half_life=float(os.environ['TOP_ITEMS_HALF_LIFE']) if os.environ.get('TOP_ITEMS_HALF_LIFE') else None,
+        window=float(os.environ['TOP_ITEMS_WINDOW']) if os.environ.get('TOP_ITEMS_WINDOW') else None,
+    )
+    popularity.bootstrap(interaction_store.scan())
+
     await asyncio.gather(
         collect_messages(),
         calculate_top_recommendations(),
         calculate_w2v_recommendations(),
+        compact_interactions(),
+        report_stats(),
     )
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, filename=".logs", filemode="w",
+                        format="%(asctime)s %(levelname)s %(message)s")
     asyncio.run(main())
@@ -2,15 +2,61 @@ import polars as pl
 import numpy as np
 import optuna
 import redis
+import json
 import logging
+import multiprocessing
 import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 from gensim.models import Word2Vec
 
-from ml_metrics import user_ndcg, user_recall
+from batch_scorer import predict_output_words, indices_to_keys
+from consumer import CONSUMER_FLUSH_INTERVAL
+from corpus import SessionCorpus
+from instrumentation import PIPELINE_BEST_VALUE, PIPELINE_TRIALS, track_stage
+from item_index import ItemIndex
+from ml_metrics import batch_metrics, to_csr
+from recs_store import publish_recommendations, update_recommendations
 
 RANDOM_STATE = 42
 TOP_K = 30
+# сколько ключей с рекомендациями пишется в redis за один round-trip
+PUBLISH_CHUNK_SIZE = int(os.environ.get('RECS_PUBLISH_CHUNK_SIZE', 1000))
+# словарь item_id -> индекс, сохраняется между запусками, чтобы индексы не менялись
+ITEM_VOCAB_PATH = './data/item_vocab.parquet'
+# датасет сохраняется на диск, чтобы его могли прочитать процессы подбора параметров
+DATASET_PATH = './data/w2v_dataset.parquet'
+# сколько последних лайков пользователя попадает в датасет, 0 - вся история
+HISTORY_LIMIT = int(os.environ.get('W2V_HISTORY_LIMIT', 0)) or None
+# по сколько пользователей обрабатывается за раз при обучении, оценке и предсказании
+CHUNK_SIZE = 10_000
+
+EPOCHS = 10
+# журнал optuna переживает перезапуски, поэтому лучшие параметры прошлого поиска не теряются
+OPTUNA_STORAGE_PATH = './data/optuna.journal'
+# каждый поиск идет в своем study "w2v-<время>": качество на разных снимках датасета несравнимо
+STUDY_NAME = 'w2v'
+N_TRIALS = 100
+TUNING_WORKERS = int(os.environ.get('TUNING_WORKERS', os.cpu_count() or 1))
+# ограничение по времени на один поиск, секунды
+TUNING_BUDGET = float(os.environ.get('TUNING_BUDGET', 600))
+# как часто запускать поиск заново, в остальные циклы модель обучается на лучших параметрах
+TUNE_EVERY = float(os.environ.get('TUNE_EVERY', 6 * 3600))
+
+MODEL_PATH = './data/w2v.model'
+# метка последнего учтенного события и время последнего полного переобучения
+CHECKPOINT_PATH = './data/w2v_checkpoint.json'
+# событие попадает в хранилище позже своей метки времени: шарды сбрасывают пачки каждый
+# по своему таймеру, а незаписанная пачка возвращается в очередь и пишется при следующем
+# сбросе. Чекпоинт отстает от момента чтения хранилища на этот запас, чтобы такие события
+# попали в следующее дообучение, а не ждали полного переобучения
+CHECKPOINT_MARGIN = float(os.environ.get('W2V_CHECKPOINT_MARGIN', max(300, 3 * CONSUMER_FLUSH_INTERVAL)))
+# между полными переобучениями модель только дообучается на новых сессиях
+FULL_RETRAIN_EVERY = float(os.environ.get('FULL_RETRAIN_EVERY', 6 * 3600))
+# индекс похожих фильмов, его читает сервис рекомендаций
+ITEM_INDEX_PATH = './data/item_index.npz'
 
 redis_conn = 'redis://{username}:{password}@{host}:{port}/0'.format(
     username=os.environ.get('REDIS_USER', 'default'),
@@ -23,51 +69,93 @@ redis_connection = redis.Redis.from_url(redis_conn)
 class W2V_model:
 
     @classmethod
-    def create_dataset(cls):
-        logging.info('Creating dataset for w2v ...')
-        interactions = pl.read_csv('./data/interactions.csv', schema_overrides={'item_id': pl.String})
-        cls.user_mapping = {k: v for v, k in enumerate(interactions['item_id'].unique())}
-        cls.user_mapping_inverse = {k: v for v, k in cls.user_mapping.items()}
-        
-        grouped_df = (
-            interactions
-            .sort('timestamp')
-            # оставляем только положительные взаимодействия
-            .filter(pl.col('action') == 'like')
-            # .unique(['user_id', 'item_id', 'action'], keep='last')
-            .with_columns(pl.col('item_id').map_elements(cls.user_mapping.get))
-            .group_by('user_id')
-            .agg([
-                # для валидации оставим последнее взаимодействие в истории
-                pl.col('item_id').map_elements(lambda x: x[:-1]).alias('train_item_ids'),
-                pl.col('item_id').map_elements(lambda x: x[-1:]).alias('test_item_ids'),
-            ])
-            # и оставим только те сессии, где есть какая-то тренировочная выборка
-            .filter(pl.col('train_item_ids').list.len() > 0)
+    def update_vocabulary(cls, item_ids):
+        """
+        :param item_ids: lazy frame with item_id column
+        :return: vocabulary with item_id and idx columns, new items get the next free indices
+        """
+        if os.path.exists(ITEM_VOCAB_PATH):
+            vocabulary = pl.read_parquet(ITEM_VOCAB_PATH)
+        else:
+            vocabulary = pl.DataFrame(schema={'item_id': pl.String, 'idx': pl.Int64})
+
+        new_items = (
+            item_ids
+            .select('item_id')
+            .unique()
+            .join(vocabulary.lazy(), on='item_id', how='anti')
+            .sort('item_id')
+            .collect(streaming=True)
         )
+        if len(new_items) > 0:
+            vocabulary = pl.concat([
+                vocabulary,
+                new_items.with_columns((pl.int_range(pl.len(), dtype=pl.Int64) + len(vocabulary)).alias('idx')),
+            ])
+            vocabulary.write_parquet(ITEM_VOCAB_PATH + '.tmp')
+            os.replace(ITEM_VOCAB_PATH + '.tmp', ITEM_VOCAB_PATH)
+        return vocabulary
+
+    @classmethod
+    def create_dataset(cls, interaction_store):
+        logging.info('Creating dataset for w2v ...')
+        # все события старше snapshot_time - CHECKPOINT_MARGIN к этому моменту уже записаны
+        cls.snapshot_time = time.time()
+        with interaction_store.snapshot() as interactions:
+            vocabulary = cls.update_vocabulary(interactions)
+            # индексы идут подряд с нуля, поэтому обратное отображение - просто массив
+            cls.item_vocabulary = vocabulary.sort('idx')['item_id'].to_numpy()
+
+            # историю упорядочиваем внутри пользователя, а не сортируем целиком
+            item_ids = pl.col('item_id').sort_by('timestamp', maintain_order=True)
+            if HISTORY_LIMIT is not None:
+                item_ids = item_ids.tail(HISTORY_LIMIT)
+            grouped_df = (
+                interactions
+                # оставляем только положительные взаимодействия
+                .filter(pl.col('action') == 'like')
+                # .unique(['user_id', 'item_id', 'action'], keep='last')
+                .select(
+                    'user_id',
+                    # индексов меньше 2^31, int32 вдвое экономит память списков
+                    pl.col('item_id').replace_strict(vocabulary['item_id'], vocabulary['idx'], return_dtype=pl.Int32),
+                    'timestamp',
+                )
+                .group_by('user_id')
+                .agg(item_ids, pl.col('timestamp').max().alias('last_timestamp'))
+                .with_columns(
+                    # для валидации оставим последнее взаимодействие в истории
+                    pl.col('item_id').list.slice(0, pl.col('item_id').list.len() - 1).alias('train_item_ids'),
+                    pl.col('item_id').list.slice(-1, 1).alias('test_item_ids'),
+                )
+                # и оставим только те сессии, где есть какая-то тренировочная выборка
+                .filter(pl.col('train_item_ids').list.len() > 0)
+                .select('user_id', 'train_item_ids', 'test_item_ids', 'last_timestamp')
+                .collect(streaming=True)
+            )
         cls.grouped_df = grouped_df
+        grouped_df.write_parquet(DATASET_PATH + '.tmp')
+        os.replace(DATASET_PATH + '.tmp', DATASET_PATH)
         logging.info('Dataset created!')
 
     @classmethod
     def evaluate_model(cls, model):
-        ndcg_list = []
-        recall_list = []
-        # для оптимизации вычислений будем оценивать модель только на подвыборке
-        for train_ids, y_rel in cls.grouped_df.select('train_item_ids', 'test_item_ids').rows():
-            model_preds = model.predict_output_word(
-                train_ids[-model.window:],
-                topn=(TOP_K + len(train_ids))
+        keys = np.asarray(model.wv.index_to_key, dtype=np.int64)
+        ndcg, recall = [], []
+        for chunk in cls.grouped_df.iter_slices(CHUNK_SIZE):
+            train_ids, test_ids = chunk['train_item_ids'].to_list(), chunk['test_item_ids'].to_list()
+            # уже просмотренные фильмы не рекомендуем
+            model_preds = predict_output_words(
+                model,
+                [ids[-model.window:] for ids in train_ids],
+                topn=TOP_K,
+                exclude=train_ids,
             )
-    
-            if model_preds is None:
-                ndcg_list.append(0)
-                recall_list.append(0)
-                continue
-    
-            y_rec = [pred[0] for pred in model_preds]
-            ndcg_list.append(user_ndcg(y_rel, y_rec, TOP_K))
-            recall_list.append(user_recall(y_rel, y_rec, TOP_K))
-        return np.mean(ndcg_list), np.mean(recall_list)
+            y_rec = np.where(model_preds >= 0, keys[model_preds], -1)
+            metrics = batch_metrics(y_rec, *to_csr(test_ids), k=TOP_K)
+            ndcg.append(metrics['ndcg'])
+            recall.append(metrics['recall'])
+        return np.concatenate(ndcg).mean(), np.concatenate(recall).mean()
 
     @classmethod
     def objective(cls, trial):
@@ -87,9 +175,9 @@ class W2V_model:
                 'min_count': min_count,
                 'vector_size': vector_size,
             })
-        
+
+            sentences = SessionCorpus(cls.grouped_df['train_item_ids'], CHUNK_SIZE)
             model = Word2Vec(
-                cls.grouped_df['train_item_ids'].to_list(),
                 window=window,
                 sg=sg,
                 min_count=min_count,
@@ -97,12 +185,32 @@ class W2V_model:
                 negative=negative,
                 ns_exponent=ns_exponent,
                 seed=RANDOM_STATE,
-                epochs=10,
+                epochs=EPOCHS,
             )
-        
+            model.build_vocab(sentences)
+
+            # учим по эпохе с тем же линейным затуханием alpha, что и при обучении за один вызов,
+            # и отдаем промежуточное качество pruner-у, чтобы рано бросать слабые конфигурации
+            alpha_step = (model.alpha - model.min_alpha) / EPOCHS
+            for epoch in range(EPOCHS):
+                model.train(
+                    sentences,
+                    total_examples=model.corpus_count,
+                    epochs=1,
+                    start_alpha=model.alpha - alpha_step * epoch,
+                    end_alpha=model.alpha - alpha_step * (epoch + 1),
+                )
+                if epoch % 2 == 1 and epoch + 1 < EPOCHS:
+                    _, mean_recall = cls.evaluate_model(model)
+                    trial.report(mean_recall, epoch)
+                    if trial.should_prune():
+                        raise optuna.TrialPruned()
+
             mean_ndcg, mean_recall = cls.evaluate_model(model)
             logging.info(f'NDCG@{TOP_K} = {mean_ndcg}, Recall@{TOP_K} = {mean_recall}')
-        except:
+        except optuna.TrialPruned:
+            raise
+        except Exception:
             return 0
         return mean_recall
 
@@ -111,8 +219,9 @@ class W2V_model:
         logging.info('Fitting the best model ...')
         try:
             cls.model = Word2Vec(
-                cls.grouped_df['train_item_ids'].to_list(),
-                epochs=10, 
+                SessionCorpus(cls.grouped_df['train_item_ids'], CHUNK_SIZE),
+                seed=RANDOM_STATE,
+                epochs=EPOCHS,
                 **best_params
             )
             logging.info('Best model was created!')
@@ -120,27 +229,230 @@ class W2V_model:
             logging.critical(e)
             
         
+    @classmethod
+    def study_storage(cls):
+        return optuna.storages.JournalStorage(optuna.storages.JournalFileStorage(OPTUNA_STORAGE_PATH))
+
+    @classmethod
+    def load_study(cls, study_name):
+        return optuna.create_study(
+            study_name=study_name,
+            storage=cls.study_storage(),
+            directions=('maximize',),
+            pruner=optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=1),
+            load_if_exists=True,
+        )
+
+    @classmethod
+    def study_names(cls):
+        """
+        :return: names of studies of all tuning rounds, oldest first
+        """
+        names = [name for name in optuna.get_all_study_names(cls.study_storage())
+                 if name == STUDY_NAME or name.startswith(STUDY_NAME + '-')]
+        # study без суффикса остался от единого поиска до раундов
+        return sorted(names, key=lambda name: int(name.partition('-')[2] or 0))
+
+    @classmethod
+    def last_tuned_study(cls):
+        """
+        :return: study of the last tuning round with completed trials or None
+        """
+        for name in reversed(cls.study_names()):
+            study = cls.load_study(name)
+            if cls.completed_trials(study):
+                return study
+        return None
+
+    @classmethod
+    def new_study(cls, previous=None):
+        """
+        Открывает study нового раунда поиска. Испытания прошлых раундов оценены на другом
+        снимке датасета, поэтому в новый study они не попадают, а лучшие параметры прошлого
+        раунда ставятся в очередь первым испытанием и переоцениваются на текущих данных.
+
+        :param previous: study of the previous tuning round with completed trials
+        """
+        study = cls.load_study(f'{STUDY_NAME}-{time.time_ns()}')
+        if previous is not None:
+            study.enqueue_trial(previous.best_params)
+        return study
+
+    @classmethod
+    def completed_trials(cls, study):
+        return study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,))
+
+    @classmethod
+    def delete_studies_before(cls, study):
+        for name in cls.study_names():
+            if name == study.study_name:
+                break
+            optuna.delete_study(study_name=name, storage=cls.study_storage())
+
+    @classmethod
+    def init_tuning_worker(cls):
+        logging.basicConfig(level=logging.INFO, filename=".logs", filemode="a",
+                            format="%(asctime)s %(levelname)s %(message)s")
+        cls.grouped_df = pl.read_parquet(DATASET_PATH)
+
+    @classmethod
+    def optimize_worker(cls, study_name, n_trials, timeout):
+        cls.load_study(study_name).optimize(cls.objective, n_trials=n_trials, timeout=timeout)
+
+    @classmethod
+    def tune(cls, study):
+        logging.info(f'Starting optuna validation with {TUNING_WORKERS} workers ...')
+        t_start = time.time()
+        # испытания идут и в других процессах, поэтому считаем их по хранилищу study
+        states_before = Counter(trial.state.name for trial in study.get_trials(deepcopy=False))
+        if TUNING_WORKERS <= 1:
+            study.optimize(cls.objective, n_trials=N_TRIALS, timeout=TUNING_BUDGET)
+        else:
+            trials_per_worker = -(-N_TRIALS // TUNING_WORKERS)
+            # spawn, а не fork: форк процесса с запущенным пулом потоков polars может зависнуть
+            with ProcessPoolExecutor(
+                    max_workers=TUNING_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=cls.init_tuning_worker) as executor:
+                futures = [
+                    executor.submit(cls.optimize_worker, study.study_name, trials_per_worker, TUNING_BUDGET)
+                    for _ in range(TUNING_WORKERS)
+                ]
+                for future in futures:
+                    future.result()
+        study.set_user_attr('last_tuned', time.time())
+        states = Counter(trial.state.name for trial in study.get_trials(deepcopy=False)) - states_before
+        for state, count in states.items():
+            PIPELINE_TRIALS.labels(state.lower()).inc(count)
+        PIPELINE_BEST_VALUE.set(study.best_value)
+        logging.info(f'Optuna validation finished in {time.time() - t_start:.1f}s, '
+                     f'best value {study.best_value}')
+
     @classmethod
     def fit(cls):
-        logging.info('Starting optuna validation ...')
-        study = optuna.create_study(directions=('maximize',))
-        study.optimize(cls.objective, n_trials=100)
-        cls.fit_best(study.best_params)
+        study = cls.last_tuned_study()
+        if study is None or time.time() - study.user_attrs.get('last_tuned', 0) > TUNE_EVERY:
+            study = cls.new_study(study)
+            with track_stage('tune'):
+                cls.tune(study)
+            # прошлые раунды больше не нужны: их лучшие параметры переоценены в новом
+            cls.delete_studies_before(study)
+        with track_stage('fit'):
+            cls.fit_best(study.best_params)
+
+    @classmethod
+    def update_model(cls, sessions):
+        """
+        Дообучает сохраненную модель на сессиях, изменившихся с последнего чекпоинта.
+        """
+        logging.info(f'Updating the model on {len(sessions)} sessions ...')
+        sentences = SessionCorpus(sessions['train_item_ids'], CHUNK_SIZE)
+        cls.model.build_vocab(sentences, update=True)
+        cls.model.train(sentences, total_examples=len(sentences), epochs=cls.model.epochs)
+
+    @classmethod
+    def build_item_index(cls):
+        t_start = time.time()
+        item_ids = cls.item_vocabulary[np.asarray(cls.model.wv.index_to_key, dtype=np.int64)]
+        ItemIndex.build(item_ids, cls.model.wv.vectors).save(ITEM_INDEX_PATH)
+        logging.info(f'Item index with {len(item_ids)} items built in {time.time() - t_start:.1f}s')
+
+    @classmethod
+    def save_checkpoint(cls, full_retrain):
+        checkpoint = cls.load_checkpoint() or {}
+        # не по последнему событию датасета: событие с меньшей меткой могло еще не дойти
+        # до хранилища и было бы пропущено следующим дообучением
+        checkpoint['timestamp'] = cls.snapshot_time - CHECKPOINT_MARGIN
+        if full_retrain:
+            checkpoint['last_full_retrain'] = time.time()
+
+        cls.model.save(MODEL_PATH + '.tmp', separately=[])
+        os.replace(MODEL_PATH + '.tmp', MODEL_PATH)
+        with open(CHECKPOINT_PATH + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(CHECKPOINT_PATH + '.tmp', CHECKPOINT_PATH)
+
+    @classmethod
+    def load_checkpoint(cls):
+        if not os.path.exists(CHECKPOINT_PATH) or not os.path.exists(MODEL_PATH):
+            return None
+        with open(CHECKPOINT_PATH) as f:
+            return json.load(f)
+
+    @classmethod
+    def predict_recommendations(cls, sessions):
+        for chunk in sessions.iter_slices(CHUNK_SIZE):
+            user_ids = chunk['user_id'].to_list()
+            item_ids = [
+                train_ids + test_ids
+                for train_ids, test_ids in chunk.select('train_item_ids', 'test_item_ids').rows()
+            ]
+            model_preds = indices_to_keys(cls.model, predict_output_words(cls.model, item_ids, TOP_K, exclude=item_ids))
+            for user_id, y_rec in zip(user_ids, model_preds):
+                if y_rec:
+                    yield user_id, cls.item_vocabulary[y_rec].tolist()
 
     @classmethod
-    def get_recommendations(cls):
+    def get_recommendations(cls, sessions=None):
+        """
+        :param sessions: if passed, only these users are updated in the current generation
+        :return: publishing stats or None if publishing failed
+        """
         logging.info('Get recommendations ')
         global redis_connection
         try:
-            for user_id, ids in cls.grouped_df.select('user_id', pl.struct('train_item_ids', 'test_item_ids')).rows():
-                item_ids = ids['train_item_ids'] + ids['test_item_ids']
-                y_rec = [cls.user_mapping_inverse.get(pred[0]) for pred in cls.model.predict_output_word(item_ids, TOP_K)]
-                redis_connection.json().set(user_id, '.', y_rec)
+            if sessions is not None:
+                stats = update_recommendations(redis_connection, cls.predict_recommendations(sessions), PUBLISH_CHUNK_SIZE)
+                if stats is not None:
+                    return stats
+            return publish_recommendations(redis_connection, cls.predict_recommendations(cls.grouped_df), PUBLISH_CHUNK_SIZE)
         except BaseException as e:
             logging.critical(e)
 
     @classmethod
-    def run_pipeline(cls):    
-        cls.create_dataset()
-        cls.fit()
-        cls.get_recommendations()
\ No newline at end of file
+    def run_pipeline(cls, interaction_store):
+        with track_stage('create_dataset'):
+            cls.create_dataset(interaction_store)
+        try:
+            cls._run_pipeline()
+        finally:
+            # датасет пересобирается на каждом запуске, держать его между запусками незачем
+            cls.grouped_df = None
+
+    @classmethod
+    def _run_pipeline(cls):
+        checkpoint = cls.load_checkpoint()
+        if checkpoint is not None and getattr(cls, 'model', None) is None:
+            cls.model = Word2Vec.load(MODEL_PATH)
+        if checkpoint is None or time.time() - checkpoint.get('last_full_retrain', 0) > FULL_RETRAIN_EVERY:
+            # периодическое полное переобучение не дает модели уплыть от дообучений
+            cls.fit()
+            with track_stage('get_recommendations'):
+                stats = cls.get_recommendations()
+            with track_stage('build_item_index'):
+                cls.build_item_index()
+            cls.save_checkpoint_if_published(stats, full_retrain=True)
+            return
+
+        sessions = cls.grouped_df.filter(pl.col('last_timestamp') > checkpoint['timestamp'])
+        if len(sessions) == 0:
+            logging.info('No new sessions since the last checkpoint')
+            return
+        with track_stage('update_model'):
+            cls.update_model(sessions)
+        with track_stage('get_recommendations'):
+            stats = cls.get_recommendations(sessions)
+        with track_stage('build_item_index'):
+            cls.build_item_index()
+        cls.save_checkpoint_if_published(stats, full_retrain=False)
+
+    @classmethod
+    def save_checkpoint_if_published(cls, stats, full_retrain):
+        if stats is None:
+            # чекпоинт остается прежним, и следующий запуск опубликует эти сессии заново
+            logging.warning('Recommendations were not published, checkpoint is not moved')
+            # следующий запуск загрузит модель последнего чекпоинта и дообучит ее на тех же сессиях
+            cls.model = None
+            return
+        with track_stage('save_checkpoint'):
+            cls.save_checkpoint(full_retrain=full_retrain)
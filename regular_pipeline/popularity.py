@@ -0,0 +1,153 @@
+import heapq
+import math
+
+import polars as pl
+
+
+class PopularityEngine:
+    """
+    Инкрементальный подсчет популярных фильмов.
+
+    Для каждой пары (user_id, item_id) хранится последнее действие, а для фильма -
+    число пользователей, у которых последнее действие - лайк. Смена лайка на дизлайк
+    уменьшает счетчик. Топ поддерживается в куче с ленивым удалением устаревших
+    записей, поэтому обновление на одно событие стоит O(log n).
+
+    :param top_n: size of published top
+    :param half_life: optional half-life of a like in seconds (exponential time decay)
+    :param window: optional window in seconds, only likes newer than ``now - window`` count
+    """
+
+    def __init__(self, top_n=500, half_life=None, window=None):
+        self.top_n = top_n
+        self.half_life = half_life
+        self.window = window
+        self._last_action = {}
+        self._scores = {}
+        self._heap = []
+        # очередь лайков на выбывание из окна
+        self._expiry = []
+        self._horizon = -math.inf
+        self._t0 = None
+
+    def _weight(self, timestamp):
+        if self.half_life is None:
+            return 1
+        # вес хранится относительно _t0: общий множитель 2^(-(now - t0) / half_life)
+        # одинаков для всех фильмов и не влияет на порядок
+        return 2 ** ((timestamp - self._t0) / self.half_life)
+
+    def _add(self, item_id, delta):
+        score = self._scores.get(item_id, 0) + delta
+        if score <= 1e-9:
+            self._scores.pop(item_id, None)
+            return
+        self._scores[item_id] = score
+        heapq.heappush(self._heap, (-score, item_id))
+        if len(self._heap) > 4 * len(self._scores) + 1024:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self._heap = [(-score, item_id) for item_id, score in self._scores.items()]
+        heapq.heapify(self._heap)
+
+    def _rebase(self, timestamp):
+        # не даем весам затухания переполнить float
+        factor = 2 ** ((self._t0 - timestamp) / self.half_life)
+        self._scores = {item_id: score * factor for item_id, score in self._scores.items()}
+        self._t0 = timestamp
+        self._rebuild_heap()
+
+    def _is_active(self, timestamp):
+        return timestamp >= self._horizon
+
+    def update(self, user_id, item_id, action, timestamp):
+        if self._t0 is None:
+            self._t0 = timestamp
+        elif self.half_life is not None and (timestamp - self._t0) / self.half_life > 512:
+            self._rebase(timestamp)
+
+        key = (user_id, item_id)
+        prev = self._last_action.get(key)
+        if prev is not None and prev[0] > timestamp:
+            # событие пришло позже более свежего - оно уже ничего не меняет
+            return
+        self._last_action[key] = (timestamp, action)
+
+        if prev is not None and prev[1] == 'like' and self._is_active(prev[0]):
+            self._add(item_id, -self._weight(prev[0]))
+        if action == 'like' and self._is_active(timestamp):
+            self._add(item_id, self._weight(timestamp))
+            if self.window is not None:
+                heapq.heappush(self._expiry, (timestamp, user_id, item_id))
+
+    def update_event(self, event):
+        """
+        :param event: message from RabbitMQ with user_id, item_ids, actions, timestamp
+        """
+        for item_id, action in zip(event['item_ids'], event['actions']):
+            self.update(event['user_id'], str(item_id), action, event['timestamp'])
+
+    def expire(self, now):
+        """
+        Убирает из окна лайки старше ``now - window``.
+        """
+        if self.window is None:
+            return
+        self._horizon = max(self._horizon, now - self.window)
+        while self._expiry and self._expiry[0][0] < self._horizon:
+            timestamp, user_id, item_id = heapq.heappop(self._expiry)
+            if self._last_action.get((user_id, item_id)) == (timestamp, 'like'):
+                self._add(item_id, -self._weight(timestamp))
+
+    def bootstrap(self, interactions):
+        """
+        Восстанавливает состояние по истории взаимодействий.
+
+        :param interactions: lazy frame with user_id, item_id, action, timestamp
+        """
+        last_actions = (
+            interactions
+            .sort('timestamp', maintain_order=True)
+            .unique(['user_id', 'item_id'], keep='last', maintain_order=True)
+            .collect()
+        )
+        for user_id, item_id, action, timestamp in last_actions.select(
+                'user_id', 'item_id', 'action', 'timestamp').iter_rows():
+            self.update(user_id, item_id, action, timestamp)
+
+    def top(self, n=None):
+        n = n or self.top_n
+        result = []
+        valid = []
+        seen = set()
+        while self._heap and len(result) < n:
+            neg_score, item_id = heapq.heappop(self._heap)
+            if item_id in seen or self._scores.get(item_id) != -neg_score:
+                # устаревшая запись
+                continue
+            seen.add(item_id)
+            valid.append((neg_score, item_id))
+            result.append(item_id)
+        for entry in valid:
+            heapq.heappush(self._heap, entry)
+        return result
+
+
+def top_items_batch(interactions, n=500):
+    """
+    Полный пересчет топа по всей истории, та же семантика, что у PopularityEngine без затухания.
+
+    :param interactions: lazy frame with user_id, item_id, action, timestamp
+    """
+    return (
+        interactions
+        .sort('timestamp', maintain_order=True)
+        .unique(['user_id', 'item_id'], keep='last', maintain_order=True)
+        .filter(pl.col('action') == 'like')
+        .group_by('item_id')
+        .len()
+        .sort(['len', 'item_id'], descending=[True, False])
+        .head(n)
+        .collect()
+    )['item_id'].to_list()
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import time
+
+from consumer import BatchConsumer, open_rabbitmq_queue
+from interaction_store import InteractionStore, ShardedInteractionStore
+
+# как часто процессы шардов присылают свою статистику
+STATS_INTERVAL = 10
+# сколько пачек событий может ждать разбора в главном процессе
+EVENTS_QUEUE_SIZE = 10000
+
+
+async def consume_shard(shard, num_shards, store_path, events, open_queue):
+    # компакцию и восстановление хранилища делает главный процесс
+    store = InteractionStore(ShardedInteractionStore.shard_path(store_path, shard), recover=False)
+    stats = {}
+    consumer = BatchConsumer(
+        await open_queue(shard, num_shards),
+        store.append,
+        on_events=lambda batch: events.put(('events', shard, batch)),
+        on_flush=lambda *flush: events.put(('flush', shard, flush)),
+        stats=stats,
+    )
+
+    async def report_stats():
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            events.put(('stats', shard, dict(stats)))
+
+    await asyncio.gather(consumer.run(), report_stats())
+
+
+def run_shard_worker(shard, num_shards, store_path, events, open_queue=open_rabbitmq_queue):
+    """
+    Точка входа процесса шарда: читает очередь шарда и пишет в его часть хранилища.
+
+    :param events: multiprocessing queue to send decoded events and stats to the main process
+    :param open_queue: coroutine function (shard, num_shards) -> queue, e.g. an in-memory broker stand-in
+    """
+    logging.basicConfig(level=logging.INFO, filename='.logs', filemode='a',
+                        format=f'%(asctime)s %(levelname)s shard-{shard} %(message)s')
+    asyncio.run(consume_shard(shard, num_shards, store_path, events, open_queue))
+
+
+class ShardWorkers:
+    """
+    Запускает по процессу-потребителю на шард и перезапускает упавшие. События из всех шардов
+    приходят в главный процесс через общую очередь, где по ним считается популярное.
+
+    :param num_shards: number of shards and worker processes
+    :param store_path: root directory of ShardedInteractionStore
+    :param open_queue: picklable coroutine function (shard, num_shards) -> queue
+    """
+
+    def __init__(self, num_shards, store_path, open_queue=open_rabbitmq_queue):
+        self.num_shards = num_shards
+        self.store_path = store_path
+        self.open_queue = open_queue
+        # spawn, а не fork: в главном процессе уже работают потоки и event loop
+        self.context = multiprocessing.get_context('spawn')
+        self.events = self.context.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self.processes = {}
+
+    def start(self, shard):
+        process = self.context.Process(
+            target=run_shard_worker,
+            args=(shard, self.num_shards, self.store_path, self.events, self.open_queue),
+            name=f'consumer-{shard}',
+            daemon=True,
+        )
+        process.start()
+        self.processes[shard] = process
+        logging.info(f'started consumer process {process.pid} for shard {shard}')
+
+    def restart_dead(self):
+        for shard, process in list(self.processes.items()):
+            if not process.is_alive():
+                logging.warning(f'consumer of shard {shard} exited with code {process.exitcode}, restarting')
+                self.start(shard)
+
+    def _receive(self, timeout=1.0, limit=1000):
+        try:
+            received = [self.events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(received) < limit:
+            try:
+                received.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        return received
+
+    async def run(self, on_events, stats, on_flush=None):
+        """
+        :param on_events: callable called with decoded events of every message of every shard
+        :param stats: dict to put per-shard consumer statistics to
+        :param on_flush: optional callable called with shard, number of events, seconds and success of every flush
+        """
+        for shard in range(self.num_shards):
+            self.start(shard)
+        stats['shards'] = {}
+        loop = asyncio.get_running_loop()
+        last_check = time.time()
+        try:
+            while True:
+                for kind, shard, payload in await loop.run_in_executor(None, self._receive):
+                    if kind == 'events':
+                        on_events(payload)
+                    elif kind == 'flush':
+                        if on_flush is not None:
+                            on_flush(shard, *payload)
+                    else:
+                        stats['shards'][shard] = payload
+                if time.time() - last_check > STATS_INTERVAL:
+                    self.restart_dead()
+                    last_check = time.time()
+        finally:
+            self.stop()
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=5)
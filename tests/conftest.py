@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# модули сервисов импортируют друг друга по имени, как в контейнерах с PYTHONPATH=/app/utils
+for name in ('utils', 'regular_pipeline', 'recommendations', 'event_collector'):
+    path = os.path.join(ROOT, name)
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from gensim.models import Word2Vec
+
+from batch_scorer import indices_to_keys, predict_output_words
+
+
+def sessions(seed, n_sessions=300, n_items=60):
+    rng = np.random.default_rng(seed)
+    return [[str(item) for item in rng.integers(0, n_items, rng.integers(2, 15))] for _ in range(n_sessions)]
+
+
+@pytest.fixture(scope='module', params=[0, 1], ids=['cbow', 'skipgram'])
+def model(request):
+    # один рабочий поток - обучение детерминировано при фиксированном seed
+    return Word2Vec(sessions(0), vector_size=16, window=3, negative=5, min_count=2, sg=request.param,
+                    epochs=5, seed=42, workers=1)
+
+
+def contexts(model, seed):
+    rng = np.random.default_rng(seed)
+    vocabulary = model.wv.index_to_key
+    result = [[str(key) for key in rng.choice(vocabulary, rng.integers(1, 6))] for _ in range(50)]
+    # ключи не из словаря пропускаются, а контекст из одних таких ключей дает пустой ответ
+    result[0] = result[0] + ['missing']
+    result[1] = ['missing', 'also-missing']
+    result[2] = []
+    return result
+
+
+def assert_same_ranking(keys, expected):
+    """
+    Тот же набор ключей, что у predict_output_word, и тот же порядок по его вероятностям.
+    Ключи с вероятностями, равными до точности float32, могут поменяться местами.
+    """
+    probabilities = dict(expected)
+    assert keys[:5] == [key for key, _ in expected[:5]]
+    assert sorted(keys) == sorted(probabilities)
+    ranked = np.array([probabilities[key] for key in keys])
+    assert (np.diff(ranked) <= 1e-6 * ranked[:-1]).all()
+
+
+@pytest.mark.parametrize('topn', [1, 10, 1000])
+def test_matches_predict_output_word(model, topn):
+    batch = contexts(model, topn)
+    indices = predict_output_words(model, batch, topn)
+    assert indices.shape == (len(batch), min(topn, len(model.wv)))
+    for context, row in zip(batch, indices):
+        expected = model.predict_output_word(context, topn=topn)
+        if expected is None:
+            assert (row == -1).all()
+        else:
+            assert_same_ranking(indices_to_keys(model, [row])[0], expected)
+
+
+def test_exclude(model):
+    batch = contexts(model, 7)
+    exclude = [context + ['missing'] for context in batch]
+    keys = indices_to_keys(model, predict_output_words(model, batch, 10, exclude=exclude))
+    for context, row, excluded in zip(batch, keys, exclude):
+        expected = model.predict_output_word(context, topn=len(model.wv))
+        if expected is None:
+            assert row == []
+            continue
+        expected = [key for key, _ in expected if key not in excluded][:10]
+        assert row == expected
+
+
+def test_exclude_everything(model):
+    vocabulary = list(model.wv.index_to_key)
+    indices = predict_output_words(model, [vocabulary[:3]], 5, exclude=[vocabulary[:-2]])
+    # осталось только два незамаскированных элемента, остальное - паддинг
+    assert sorted(indices_to_keys(model, indices)[0]) == sorted(vocabulary[-2:])
+    assert (indices[0, 2:] == -1).all()
+
+
+def test_chunks(model, monkeypatch):
+    import batch_scorer
+
+    batch = contexts(model, 3)
+    expected = predict_output_words(model, batch, 10)
+    # пачки по несколько пользователей дают тот же результат
+    monkeypatch.setattr(batch_scorer, 'SCORES_MEMORY_BUDGET', len(model.wv) * 4 * 7)
+    np.testing.assert_array_equal(predict_output_words(model, batch, 10), expected)
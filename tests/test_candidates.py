@@ -0,0 +1,39 @@
+import numpy as np
+
+from candidates import ItemArray, blend, sample_items, to_item_array
+
+
+def test_sample_items_from_memmap(tmp_path):
+    path = tmp_path / 'item_ids.bin'
+    np.arange(1, 100_001, dtype=np.int64).tofile(path)
+    item_ids = np.memmap(path, dtype=np.int64, mode='r')
+    rng = np.random.default_rng(0)
+
+    chosen = sample_items(item_ids, 50, rng)
+    assert len(set(chosen.tolist())) == 50
+    assert chosen.min() >= 1 and chosen.max() <= 100_000
+    # k не меньше размера - весь массив в случайном порядке
+    assert sorted(sample_items(item_ids[:10], 20, rng).tolist()) == list(range(1, 11))
+
+
+def test_item_array():
+    items = ItemArray([3, 1, 3], capacity=2)
+    items.extend([2, 1, 2, 5])
+    assert items.values.tolist() == [1, 3, 2, 5]
+    assert sorted(items.sample(4, np.random.default_rng(0)).tolist()) == [1, 2, 3, 5]
+    assert len(set(items.sample(3, np.random.default_rng(0)).tolist())) == 3
+
+
+def test_blend_quotas_and_dedup():
+    item_ids = blend(
+        {'personal': [1, 2, 3, 4], 'popular': [2, 5, 6], 'random': [7, 8]},
+        {'personal': 2, 'popular': 1, 'random': 1},
+        6,
+        exclude=[1],
+    )
+    # сначала квоты источников, затем недобор по приоритету; 2 остается у personal
+    assert item_ids.tolist() == [2, 3, 5, 7, 4, 6]
+
+
+def test_to_item_array():
+    assert to_item_array([b'12', '7', 3, 'tt01']).tolist() == [12, 7, 3]
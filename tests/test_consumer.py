@@ -0,0 +1,107 @@
+import asyncio
+
+import orjson
+
+from consumer import BatchConsumer
+
+
+class Message:
+
+    def __init__(self, log, tag, body):
+        self.log = log
+        self.tag = tag
+        self.body = body if isinstance(body, bytes) else orjson.dumps(body)
+
+    async def ack(self, multiple=False):
+        self.log.append(('ack', self.tag, multiple))
+
+    async def nack(self, multiple=False, requeue=True):
+        self.log.append(('nack', self.tag, multiple))
+
+    async def reject(self, requeue=False):
+        self.log.append(('reject', self.tag))
+
+
+def event(user_id, item_ids, actions, timestamp=1.7e9):
+    return {'user_id': user_id, 'item_ids': item_ids, 'actions': actions, 'timestamp': timestamp}
+
+
+def consume(bodies, write):
+    log, events = [], []
+    consumer = BatchConsumer(None, write, on_events=events.extend)
+
+    async def run():
+        for tag, body in enumerate(bodies):
+            await consumer._on_message(Message(log, tag, body))
+        await consumer.flush()
+
+    asyncio.run(run())
+    return consumer, log, events
+
+
+def test_flush_writes_and_acks_batch():
+    frames = []
+    consumer, log, events = consume([
+        event('u1', ['1', '2'], ['like', 'dislike']),
+        [event('u2', ['3'], ['like']), event('u3', [4], ['like'])],
+    ], frames.append)
+
+    assert log == [('ack', 1, True)]
+    assert len(events) == 3
+    assert frames[0].to_dict(as_series=False) == {
+        'user_id': ['u1', 'u1', 'u2', 'u3'],
+        'item_id': ['1', '2', '3', '4'],
+        'action': ['like', 'dislike', 'like', 'like'],
+        'timestamp': [1.7e9] * 4,
+    }
+    assert consumer.stats['last_batch_size'] == 4
+
+
+def test_mismatched_lengths_are_rejected():
+    frames = []
+    consumer, log, events = consume([
+        event('u1', ['1', '2'], ['like']),
+        # вся пачка из сообщения отбрасывается, даже если первое событие в ней целое
+        [event('u2', ['3'], ['like']), event('u3', ['4'], [])],
+        event('u4', ['5'], ['like']),
+        b'not json',
+    ], frames.append)
+
+    assert log == [('reject', 0), ('reject', 1), ('reject', 3), ('ack', 2, True)]
+    assert [event['user_id'] for event in events] == ['u4']
+    assert frames[0]['user_id'].to_list() == ['u4']
+
+
+def test_wrong_types_are_rejected():
+    frames = []
+    consumer, log, events = consume([
+        event('u1', ['1'], ['like'], timestamp='soon'),
+        event('u2', ['2'], ['like']),
+        event('u3', ['3'], ['love']),
+        event('u4', ['4'], ['like'], timestamp=None),
+        event('u4', ['4'], ['like'], timestamp='nan'),
+        # числа приводятся к типам схемы
+        event(5, [6], ['dislike'], timestamp='1700000000'),
+    ], frames.append)
+
+    # битые сообщения отбрасываются по одному, целые записываются и подтверждаются
+    assert log == [('reject', 0), ('reject', 2), ('reject', 3), ('reject', 4), ('ack', 5, True)]
+    assert consumer.stats['failed_flushes'] == 0
+    assert frames[0].to_dict(as_series=False) == {
+        'user_id': ['u2', '5'],
+        'item_id': ['2', '6'],
+        'action': ['like', 'dislike'],
+        'timestamp': [1.7e9, 1.7e9],
+    }
+    # on_events получает только проверенные события уже в типах схемы
+    assert events[-1] == {'user_id': '5', 'item_ids': ['6'], 'actions': ['dislike'], 'timestamp': 1.7e9}
+
+
+def test_failed_write_is_returned_to_queue():
+    def write(df):
+        raise OSError('disk full')
+
+    consumer, log, _ = consume([event('u1', ['1'], ['like'])], write)
+    assert log == [('nack', 0, True)]
+    assert consumer.stats['failed_flushes'] == 1
+    assert consumer.stats['unflushed_events'] == 0
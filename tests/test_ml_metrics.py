@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from ml_metrics import batch_metrics, to_csr, user_hitrate, user_intersection, user_ndcg, user_recall
+
+
+def random_case(seed, n_users=200, n_items=30):
+    """
+    Маленький каталог, чтобы попаданий было много; рекомендации с повторами и паддингом -1,
+    релевантные фильмы тоже бывают повторены.
+    """
+    rng = np.random.default_rng(seed)
+    width = int(rng.integers(1, 25))
+    y_rec = rng.integers(0, n_items, (n_users, width))
+    padding = rng.integers(0, width + 1, n_users)
+    y_rec[np.arange(width) >= width - padding[:, None]] = -1
+    y_rel = [rng.integers(0, n_items, rng.integers(1, 12)).tolist() for _ in range(n_users)]
+    return y_rec, y_rel
+
+
+def user_ap(y_rel, y_rec, k):
+    seen, hits, total = set(), 0, 0.
+    for position, item in enumerate(y_rec[:k]):
+        if item in y_rel and item not in seen:
+            hits += 1
+            total += hits / (position + 1)
+        seen.add(item)
+    return total / min(len(set(y_rel)), k)
+
+
+@pytest.mark.parametrize('seed', range(30))
+@pytest.mark.parametrize('k', [1, 5, 10, 30])
+def test_matches_scalar_metrics(seed, k):
+    y_rec, y_rel = random_case(seed)
+    metrics = batch_metrics(y_rec, *to_csr(y_rel), k=k)
+
+    rows = y_rec.tolist()
+    np.testing.assert_array_equal(metrics['hitrate'], [user_hitrate(rel, rec, k) for rel, rec in zip(y_rel, rows)])
+    np.testing.assert_array_equal(metrics['intersection'],
+                                  [user_intersection(rel, rec, k) for rel, rec in zip(y_rel, rows)])
+    # те же значения с точностью до порядка суммирования float
+    np.testing.assert_allclose(metrics['recall'], [user_recall(rel, rec, k) for rel, rec in zip(y_rel, rows)],
+                               rtol=1e-12, atol=0)
+    np.testing.assert_allclose(metrics['ndcg'], [user_ndcg(rel, rec, k) for rel, rec in zip(y_rel, rows)],
+                               rtol=1e-12, atol=0)
+    np.testing.assert_allclose(metrics['map'], [user_ap(rel, rec, k) for rel, rec in zip(y_rel, rows)],
+                               rtol=1e-12, atol=0)
+
+
+def test_padding_and_duplicates():
+    y_rec = np.array([
+        [3, 3, 5, -1, -1],
+        [-1, -1, -1, -1, -1],
+        [7, 1, 7, 1, 2],
+    ])
+    y_rel = [[3, 4], [1], [1, 1, 2]]
+    metrics = batch_metrics(y_rec, *to_csr(y_rel), k=5)
+
+    # повторно рекомендованный фильм входит в пересечение один раз
+    assert metrics['intersection'].tolist() == [1, 0, 2]
+    assert metrics['hitrate'].tolist() == [1, 0, 1]
+    np.testing.assert_allclose(metrics['recall'], [0.5, 0, 1])
+    for user, (rel, rec) in enumerate(zip(y_rel, y_rec.tolist())):
+        assert metrics['ndcg'][user] == pytest.approx(user_ndcg(rel, rec, 5), rel=1e-12)
+
+
+def test_coverage():
+    y_rec = np.array([[1, 2, -1], [2, 3, 3]])
+    metrics = batch_metrics(y_rec, *to_csr([[1], [3]]), k=3, n_items=10)
+    assert metrics['coverage'] == pytest.approx(0.3)
+
+
+def test_to_csr():
+    indptr, indices = to_csr([[5, 1], [], [2]])
+    assert indptr.tolist() == [0, 2, 2, 3]
+    assert indices.tolist() == [5, 1, 2]
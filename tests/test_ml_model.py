@@ -0,0 +1,111 @@
+import json
+import os
+import time
+
+import fakeredis
+import polars as pl
+import pytest
+
+import ml_model
+from interaction_store import InteractionStore
+from ml_model import CHECKPOINT_PATH, W2V_model
+from recs_store import RECS_GENERATION_KEY, recs_key
+
+FIT_PARAMS = {'sg': 1, 'window': 3, 'negative': 5, 'min_count': 1, 'vector_size': 8, 'workers': 1}
+
+
+def likes(user_id, item_ids, timestamp):
+    return pl.DataFrame({
+        'user_id': [user_id] * len(item_ids),
+        'item_id': [str(item_id) for item_id in item_ids],
+        'action': ['like'] * len(item_ids),
+        'timestamp': [timestamp + i for i in range(len(item_ids))],
+    })
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    monkeypatch.setattr(W2V_model, 'model', None, raising=False)
+
+    store = InteractionStore('./data/interactions')
+    t_start = time.time() - 3600
+    for user in range(30):
+        store.append(likes(f'u{user}', [(user + i) % 20 for i in range(5)], t_start))
+    # последнее событие датасета - почти сейчас
+    store.append(likes('recent', [1, 2, 3], time.time() - 3))
+    return store
+
+
+@pytest.fixture
+def pipeline(store, monkeypatch):
+    redis_connection = fakeredis.FakeRedis()
+    monkeypatch.setattr(ml_model, 'redis_connection', redis_connection)
+    # без подбора параметров optuna
+    monkeypatch.setattr(W2V_model, 'fit', classmethod(lambda cls: cls.fit_best(FIT_PARAMS)))
+    return store, redis_connection
+
+
+def published(redis_connection, user_id):
+    generation = redis_connection.get(RECS_GENERATION_KEY).decode()
+    return redis_connection.zrange(recs_key(generation, user_id), 0, -1)
+
+
+def test_late_event_is_picked_up_by_next_update(pipeline):
+    store, redis_connection = pipeline
+    W2V_model.run_pipeline(store)
+    assert published(redis_connection, 'recent')
+
+    # событие старше последнего в датасете дошло до хранилища только после его чтения,
+    # например, шард сбросил пачку позже других
+    store.append(likes('late', [4, 5, 6], time.time() - 10))
+    W2V_model.run_pipeline(store)
+    assert published(redis_connection, 'late')
+
+
+def test_checkpoint_is_not_moved_when_publishing_fails(pipeline, monkeypatch):
+    store, redis_connection = pipeline
+    W2V_model.run_pipeline(store)
+    with open(CHECKPOINT_PATH) as f:
+        checkpoint = json.load(f)
+
+    update_recommendations = ml_model.update_recommendations
+    redis_down = True
+
+    def update(*args, **kwargs):
+        if redis_down:
+            raise ConnectionError('redis is down')
+        return update_recommendations(*args, **kwargs)
+
+    store.append(likes('new', [7, 8, 9], time.time()))
+    monkeypatch.setattr(ml_model, 'update_recommendations', update)
+    W2V_model.run_pipeline(store)
+    with open(CHECKPOINT_PATH) as f:
+        assert json.load(f) == checkpoint
+    assert published(redis_connection, 'new') == []
+
+    # после восстановления redis те же сессии публикуются следующим запуском
+    redis_down = False
+    W2V_model.run_pipeline(store)
+    assert published(redis_connection, 'new')
+
+
+def test_every_tuning_round_gets_a_fresh_study(store, monkeypatch):
+    monkeypatch.setattr(ml_model, 'N_TRIALS', 3)
+    monkeypatch.setattr(ml_model, 'TUNING_WORKERS', 1)
+    monkeypatch.setattr(ml_model, 'TUNE_EVERY', 0)
+    W2V_model.create_dataset(store)
+
+    W2V_model.fit()
+    [first] = W2V_model.study_names()
+    best_params = W2V_model.load_study(first).best_params
+
+    W2V_model.fit()
+    # испытания прошлого раунда не смешиваются с новыми, раунд удален после поиска
+    [second] = W2V_model.study_names()
+    assert second != first
+    trials = W2V_model.load_study(second).get_trials()
+    assert len(trials) == 3
+    # а лучшие параметры прошлого раунда переоценены первым испытанием нового
+    assert trials[0].params == best_params
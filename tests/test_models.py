@@ -0,0 +1,25 @@
+import pytest
+from pydantic import TypeAdapter, ValidationError
+
+from models import InteractEvent
+
+
+def test_interact_event():
+    event = InteractEvent(user_id='u1', item_ids=['1', '2'], actions=['like', 'dislike'])
+    assert event.item_ids == ['1', '2']
+
+
+@pytest.mark.parametrize('item_ids, actions', [(['1', '2'], ['like']), (['1'], []), ([], ['like'])])
+def test_lengths_must_match(item_ids, actions):
+    with pytest.raises(ValidationError, match='lengths must be equal'):
+        InteractEvent(user_id='u1', item_ids=item_ids, actions=actions)
+
+
+def test_batch_reports_the_bad_event():
+    events = [
+        {'user_id': 'u1', 'item_ids': ['1'], 'actions': ['like']},
+        {'user_id': 'u1', 'item_ids': ['1', '2'], 'actions': ['like']},
+    ]
+    with pytest.raises(ValidationError) as e:
+        TypeAdapter(list[InteractEvent]).validate_python(events)
+    assert [error['loc'] for error in e.value.errors()] == [(1,)]
@@ -0,0 +1,123 @@
+import numpy as np
+import polars as pl
+import pytest
+
+from popularity import PopularityEngine, top_items_batch
+
+
+def random_history(rng, n_events, n_users=50, n_items=40):
+    return {
+        'user_id': [f'u{user}' for user in rng.integers(0, n_users, n_events)],
+        'item_id': [str(item) for item in rng.integers(0, n_items, n_events)],
+        'action': rng.choice(['like', 'dislike'], n_events, p=[0.7, 0.3]).tolist(),
+        'timestamp': rng.integers(0, 10_000, n_events).astype(float).tolist(),
+    }
+
+
+def feed(engine, history):
+    for event in zip(history['user_id'], history['item_id'], history['action'], history['timestamp']):
+        engine.update(*event)
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('top_n', [5, 500])
+def test_matches_batch(seed, top_n):
+    rng = np.random.default_rng(seed)
+    history = random_history(rng, 2_000)
+    engine = PopularityEngine(top_n=top_n)
+    # события приходят не по порядку, как из нескольких продюсеров
+    feed(engine, history)
+
+    expected = top_items_batch(pl.LazyFrame(history), n=top_n)
+    assert engine.top() == expected
+    # top() не портит кучу
+    assert engine.top() == expected
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_bootstrap_matches_batch(seed):
+    history = random_history(np.random.default_rng(seed), 2_000)
+    engine = PopularityEngine(top_n=20)
+    engine.bootstrap(pl.LazyFrame(history))
+    assert engine.top() == top_items_batch(pl.LazyFrame(history), n=20)
+
+
+def test_like_dislike_flips():
+    engine = PopularityEngine()
+    engine.update('u1', 'a', 'like', 1)
+    engine.update('u2', 'a', 'like', 2)
+    engine.update('u1', 'b', 'like', 3)
+    assert engine.top() == ['a', 'b']
+
+    engine.update('u1', 'a', 'dislike', 4)
+    engine.update('u2', 'a', 'dislike', 5)
+    assert engine.top() == ['b']
+
+    engine.update('u1', 'a', 'like', 6)
+    engine.update('u2', 'a', 'like', 7)
+    assert engine.top() == ['a', 'b']
+
+    # запоздавший дизлайк старше последнего лайка ничего не меняет
+    engine.update('u1', 'a', 'dislike', 0)
+    assert engine.top() == ['a', 'b']
+
+
+def test_window_expiry():
+    engine = PopularityEngine(window=100)
+    engine.update('u1', 'a', 'like', 0)
+    engine.update('u2', 'a', 'like', 10)
+    engine.update('u1', 'b', 'like', 50)
+    assert engine.top() == ['a', 'b']
+
+    engine.expire(105)
+    assert engine._scores == {'a': 1, 'b': 1}
+    engine.expire(120)
+    assert engine.top() == ['b']
+    engine.expire(151)
+    assert engine.top() == []
+
+    # лайк за горизонтом окна не считается, свежий - считается
+    engine.update('u3', 'a', 'like', 40)
+    engine.update('u3', 'b', 'like', 200)
+    assert engine.top() == ['b']
+
+
+def test_window_flip_after_expiry():
+    engine = PopularityEngine(window=100)
+    engine.update('u1', 'a', 'like', 0)
+    engine.expire(150)
+    # дизлайк после выбывшего лайка не уводит счетчик в минус
+    engine.update('u1', 'a', 'dislike', 160)
+    engine.update('u2', 'a', 'like', 170)
+    assert engine._scores == {'a': 1}
+
+
+def test_decay():
+    engine = PopularityEngine(half_life=10)
+    engine.update('u1', 'old', 'like', 0)
+    engine.update('u2', 'old', 'like', 0)
+    engine.update('u3', 'old', 'like', 0)
+    engine.update('u1', 'new', 'like', 20)
+    engine.update('u2', 'new', 'like', 20)
+    # 2 свежих лайка весят 2 * 4 = 8 против 3 лайков двумя периодами раньше
+    assert engine.top() == ['new', 'old']
+    assert engine._scores['new'] / engine._scores['old'] == pytest.approx(8 / 3)
+
+    # смена лайка на дизлайк снимает ровно его затухший вес
+    engine.update('u1', 'new', 'dislike', 25)
+    engine.update('u2', 'new', 'dislike', 25)
+    assert engine.top() == ['old']
+
+
+def test_decay_rebase():
+    engine = PopularityEngine(half_life=1)
+    engine.update('u1', 'a', 'like', 0)
+    engine.update('u2', 'b', 'like', 0)
+    engine.update('u3', 'b', 'like', 0)
+    # веса пересчитываются к новой точке отсчета, порядок и отношения сохраняются
+    engine.update('u4', 'c', 'like', 600)
+    assert engine._t0 == 600
+    assert engine.top() == ['c', 'b', 'a']
+    assert engine._scores['b'] / engine._scores['a'] == pytest.approx(2)
+    engine.update('u4', 'c', 'dislike', 601)
+    assert engine.top() == ['b', 'a']
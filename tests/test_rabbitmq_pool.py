@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+import rabbitmq_pool
+from rabbitmq_pool import RabbitMQPool
+
+
+class Channel:
+
+    async def declare_exchange(self, name, type):
+        return name
+
+    async def declare_queue(self, name):
+        # как PRECONDITION_FAILED на очереди, объявленной раньше с другими аргументами
+        raise RuntimeError(f'PRECONDITION_FAILED - inequivalent arg for queue {name}')
+
+
+class Connection:
+
+    def __init__(self):
+        self.closed = False
+
+    async def channel(self):
+        return Channel()
+
+    async def close(self):
+        self.closed = True
+
+
+def test_connection_is_closed_when_declaration_fails(monkeypatch):
+    connections = []
+
+    async def connect_robust(url):
+        connections.append(Connection())
+        return connections[-1]
+
+    monkeypatch.setattr(rabbitmq_pool.aio_pika, 'connect_robust', connect_robust)
+    rabbitmq = RabbitMQPool(num_shards=2)
+
+    async def run():
+        for _ in range(3):
+            with pytest.raises(RuntimeError):
+                await rabbitmq.connect()
+
+    asyncio.run(run())
+    # ни одно robust-соединение не остается переподключаться в фоне
+    assert len(connections) == 3
+    assert all(connection.closed for connection in connections)
+    assert rabbitmq.connection is None
+    assert 'PRECONDITION_FAILED' in rabbitmq.stats['last_error']
@@ -0,0 +1,132 @@
+import asyncio
+import importlib.util
+import os
+
+import fakeredis
+import fakeredis.aioredis
+import httpx
+import numpy as np
+import pytest
+
+from catalogue import build
+from item_index import ItemIndex
+from recent_likes import RecentLikes
+from recs_store import publish_recommendations, recent_likes_key
+from watched_filter import WatchedFilter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ITEM_IDS = [str(item_id) for item_id in range(1, 201)]
+WATCHED = ITEM_IDS[:10] + ITEM_IDS[100:110]
+
+
+class CountingConnection(fakeredis.aioredis.FakeAsyncRedisConnection):
+    # одна отправка - одна команда или целый pipeline
+    round_trips = 0
+
+    async def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        await super().send_packed_command(command, check_health)
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    # сервис пишет лог и читает каталог и индекс относительно текущей директории
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    build(os.path.join(ROOT, 'webapp', 'static', 'movies.csv'), os.path.join(ROOT, 'webapp', 'static', 'links.csv'))
+    vectors = np.random.default_rng(0).normal(size=(len(ITEM_IDS), 8))
+    ItemIndex.build(ITEM_IDS, vectors).save('./data/item_index.npz')
+
+    spec = importlib.util.spec_from_file_location('recommendations_main', os.path.join(ROOT, 'recommendations', 'main.py'))
+    recs = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(recs)
+
+    server = fakeredis.FakeServer()
+    recs.redis_connection = recs.watched_filter.redis_connection = fakeredis.aioredis.FakeRedis(
+        server=server, connection_class=CountingConnection)
+    sync_redis = fakeredis.FakeRedis(server=server)
+    stats = publish_recommendations(sync_redis, [('u1', ITEM_IDS[:40])])
+    recs.hot_cache['generation'] = stats['generation']
+    recs.hot_cache['top_items'] = np.arange(1, 101, dtype=np.int64)
+    # пользователь уже посмотрел часть персональных, популярных и похожих фильмов
+    sync_redis.sadd(WatchedFilter.key('u1'), *WATCHED)
+    sync_redis.lpush(recent_likes_key('u1'), *ITEM_IDS[100:103])
+    return recs, sync_redis
+
+
+def get(recs, *paths):
+    """
+    :param paths: request paths, a callable among them is called between requests
+    :return: response item ids and number of round-trips to Redis of every request
+    """
+    async def run():
+        # соединение открывается заранее, чтобы не считать команды рукопожатия
+        await recs.redis_connection.ping()
+        transport = httpx.ASGITransport(app=recs.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://recs') as client:
+            responses = []
+            for path in paths:
+                if callable(path):
+                    path()
+                    continue
+                CountingConnection.round_trips = 0
+                response = await client.get(path)
+                response.raise_for_status()
+                responses.append((response.json()['item_ids'], CountingConnection.round_trips))
+            return responses
+
+    return asyncio.run(run())
+
+
+def test_recs_cost_one_round_trip(service, monkeypatch):
+    recs, _ = service
+    monkeypatch.setattr(recs.random, 'random', lambda: 1.0)
+    (cold, cold_trips), (warm, warm_trips) = get(recs, '/recs/u1', '/recs/u1')
+    assert cold_trips == warm_trips == 1
+    for item_ids in (cold, warm):
+        assert len(item_ids) == recs.TOP_K
+        assert not set(WATCHED) & set(item_ids)
+    # персональные идут первыми в порядке ранга, без просмотренных
+    assert warm[:18] == ITEM_IDS[10:28]
+    # лайки прочитаны первым запросом: в нем за персональными сразу популярные,
+    # а со второго - похожие на лайки
+    assert recs.recent_likes.get('u1') == ITEM_IDS[102:99:-1]
+    assert cold[18:23] == ITEM_IDS[40:45]
+    similar = recs.session_candidates(recs.recent_likes.get('u1'), 12)
+    assert set(warm[18:22]) <= set(similar)
+
+
+def test_session_costs_one_round_trip_once_likes_are_cached(service):
+    recs, sync_redis = service
+
+    def like():
+        # как event collector: лайк пишется в redis, а сообщение о нем приходит через pub/sub
+        sync_redis.lpush(recent_likes_key('u1'), ITEM_IDS[50])
+        recs.recent_likes.push('u1', [ITEM_IDS[50]])
+
+    (cold, cold_trips), (warm, warm_trips), (liked, liked_trips) = get(
+        recs, '/session/u1?k=5', '/session/u1?k=5', like, '/session/u1?k=5')
+    # первый запрос проверяет похожие на лайки, прочитанные этим же запросом, отдельной командой
+    assert (cold_trips, warm_trips, liked_trips) == (2, 1, 1)
+    assert cold == warm
+    assert len(warm) == 5 and not set(warm) & set(WATCHED)
+    similar = recs.session_candidates(recs.recent_likes.get('u1'), 10)
+    assert liked == [item_id for item_id in similar if item_id not in WATCHED][:5]
+
+
+def test_recent_likes_mirror_redis_list():
+    redis_connection = fakeredis.FakeRedis()
+    likes = RecentLikes(max_users=2, limit=4)
+    likes.set('u1', [])
+    for item_ids in (['1', '2'], ['3'], ['4', '5', '6']):
+        redis_connection.lpush('likes', *item_ids)
+        redis_connection.ltrim('likes', 0, 3)
+        likes.push('u1', item_ids)
+    assert likes.get('u1') == [item_id.decode() for item_id in redis_connection.lrange('likes', 0, -1)]
+
+    # о незнакомом пользователе лайки не запоминаются: полного списка нет
+    likes.push('u2', ['1'])
+    assert likes.get('u2') is None
+    likes.set('u2', ['1'])
+    likes.set('u3', ['2'])
+    assert likes.get('u1') is None and len(likes) == 2
@@ -0,0 +1,204 @@
+import hashlib
+import io
+import os
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from s3_connect import ETAGS_FILE, download_file, download_static_images, download_static_images_arch
+
+
+class RangeServer:
+    """
+    Локальный HTTP-сервер одного файла с поддержкой ``Range: bytes=N-``, как у object storage.
+    """
+
+    def __init__(self, content, ranges=True):
+        self.content = content
+        self.ranges = ranges
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                header = self.headers.get('Range')
+                server.requests.append(header)
+                body, status = server.content, 200
+                if header and server.ranges:
+                    offset = int(header.removeprefix('bytes=').rstrip('-'))
+                    if offset >= len(server.content):
+                        self.send_response(416)
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    body, status = server.content[offset:], 206
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/images.zip'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.mark.parametrize('ranges', [True, False], ids=['range', 'no-range'])
+def test_download_file_resumes(tmp_path, ranges):
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    filename = str(tmp_path / 'file.bin')
+    # прерванная загрузка оставила первый мегабайт
+    with open(filename + '.part', 'wb') as f:
+        f.write(content[:1024 * 1024])
+
+    # без поддержки Range сервер отдает файл целиком, и он скачивается заново
+    with RangeServer(content, ranges=ranges) as server:
+        download_file(server.url, filename)
+
+    with open(filename, 'rb') as f:
+        assert f.read() == content
+    assert not os.path.exists(filename + '.part')
+    assert server.requests == [f'bytes={1024 * 1024}-']
+
+
+def test_download_file_already_complete(tmp_path):
+    content = b'x' * 100
+    filename = str(tmp_path / 'file.bin')
+    with open(filename + '.part', 'wb') as f:
+        f.write(content)
+    with RangeServer(content) as server:
+        download_file(server.url, filename)
+    with open(filename, 'rb') as f:
+        assert f.read() == content
+
+
+def make_archive(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zip_file:
+        for name, data in files.items():
+            zip_file.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_archive_extracts_and_skips_existing(tmp_path):
+    files = {f'{i}.jpg': os.urandom(1000 + i) for i in range(20)}
+    path = str(tmp_path / 'static')
+    os.makedirs(path)
+    # один файл уже распакован, другой обрезан прошлой распаковкой
+    with open(os.path.join(path, '0.jpg'), 'wb') as f:
+        f.write(files['0.jpg'])
+    with open(os.path.join(path, '1.jpg'), 'wb') as f:
+        f.write(files['1.jpg'][:10])
+
+    with RangeServer(make_archive(files)) as server:
+        assert download_static_images_arch(path, server.url) == 19
+
+    for name, data in files.items():
+        with open(os.path.join(path, name), 'rb') as f:
+            assert f.read() == data
+    # архив после распаковки удаляется
+    assert sorted(os.listdir(path)) == sorted(files)
+
+
+def test_archive_resumes_partial_download(tmp_path):
+    archive = make_archive({f'{i}.jpg': os.urandom(50_000) for i in range(10)})
+    path = str(tmp_path / 'static')
+    os.makedirs(path)
+    with open(os.path.join(path, '.images.zip.part'), 'wb') as f:
+        f.write(archive[:200_000])
+
+    with RangeServer(archive) as server:
+        assert download_static_images_arch(path, server.url) == 10
+    assert server.requests == ['bytes=200000-']
+
+
+class FakeS3:
+    """
+    Стенд-ин boto3-клиента: постраничный list_objects_v2 и download_file.
+    """
+
+    def __init__(self, objects, page_size=100, failing=()):
+        self.objects = objects
+        self.page_size = page_size
+        self.failing = set(failing)
+        self.downloads = []
+        self._lock = threading.Lock()
+
+    def put(self, key, data):
+        self.objects[key] = data
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket):
+        keys = sorted(self.objects)
+        for start in range(0, len(keys), self.page_size):
+            yield {'Contents': [
+                {'Key': key, 'Size': len(self.objects[key]), 'ETag': f'"{hashlib.md5(self.objects[key]).hexdigest()}"'}
+                for key in keys[start:start + self.page_size]
+            ]}
+        if not keys:
+            yield {'KeyCount': 0}
+
+    def download_file(self, Bucket, Key, Filename):
+        with self._lock:
+            self.downloads.append(Key)
+        if Key in self.failing:
+            raise OSError(f'connection reset while downloading {Key}')
+        with open(Filename, 'wb') as f:
+            f.write(self.objects[Key])
+
+
+def test_sync_paginates_and_resumes(tmp_path):
+    objects = {f'posters/{i}.jpg': os.urandom(100 + i % 7) for i in range(250)}
+    objects['posters/'] = b''
+    path = str(tmp_path / 'static')
+    client = FakeS3(objects, failing={'posters/3.jpg', 'posters/200.jpg'})
+
+    stats = download_static_images(path, client=client, workers=4)
+    # все три страницы списка прочитаны, папка пропущена
+    assert stats == {'listed': 251, 'downloaded': 248, 'skipped': 1, 'failed': 2}
+    assert not os.path.exists(os.path.join(path, 'posters', '3.jpg'))
+
+    # повторный запуск докачивает только то, что упало, и измененный объект
+    client.failing.clear()
+    client.downloads.clear()
+    client.put('posters/10.jpg', b'new poster')
+    stats = download_static_images(path, client=client, workers=4)
+    assert stats == {'listed': 251, 'downloaded': 3, 'skipped': 248, 'failed': 0}
+    assert sorted(client.downloads) == ['posters/10.jpg', 'posters/200.jpg', 'posters/3.jpg']
+
+    for key, data in objects.items():
+        if not key.endswith('/'):
+            with open(os.path.join(path, key), 'rb') as f:
+                assert f.read() == data
+    assert os.path.exists(os.path.join(path, ETAGS_FILE))
+
+
+def test_sync_redownloads_same_size_change(tmp_path):
+    path = str(tmp_path / 'static')
+    client = FakeS3({'a.jpg': b'aaaa'})
+    download_static_images(path, client=client)
+    # размер тот же, но ETag другой
+    client.put('a.jpg', b'bbbb')
+    assert download_static_images(path, client=client)['downloaded'] == 1
+    with open(os.path.join(path, 'a.jpg'), 'rb') as f:
+        assert f.read() == b'bbbb'
+
+
+def test_sync_empty_bucket(tmp_path):
+    stats = download_static_images(str(tmp_path / 'static'), client=FakeS3({}))
+    assert stats == {'listed': 0, 'downloaded': 0, 'skipped': 0, 'failed': 0}
@@ -0,0 +1,112 @@
+import asyncio
+import functools
+import multiprocessing
+import time
+
+import orjson
+import pytest
+
+from interaction_store import InteractionStore, ShardedInteractionStore
+from rabbitmq_pool import shard_of
+from shards import ShardWorkers
+
+NUM_SHARDS = 3
+
+
+class QueueMessage:
+    """
+    Сообщение стенд-ина брокера: подтверждения некуда отправлять, тело уже доставлено.
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    async def ack(self, multiple=False):
+        pass
+
+    async def nack(self, multiple=False, requeue=True):
+        pass
+
+    async def reject(self, requeue=False):
+        pass
+
+
+class ProcessQueue:
+    """
+    Очередь шарда поверх multiprocessing-очереди, в которую тест публикует сообщения
+    с маршрутизацией по shard_of, как RabbitMQPool.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self._task = None
+
+    async def consume(self, callback):
+        async def deliver():
+            loop = asyncio.get_running_loop()
+            while True:
+                await callback(QueueMessage(await loop.run_in_executor(None, self.source.get)))
+
+        self._task = asyncio.create_task(deliver())
+
+
+async def open_process_queue(sources, shard, num_shards):
+    return ProcessQueue(sources[shard])
+
+
+def test_workers_write_own_shards(tmp_path, monkeypatch):
+    # процессы шардов читают переменные окружения при импорте consumer и пишут лог в текущую директорию
+    monkeypatch.setenv('CONSUMER_FLUSH_INTERVAL', '0.2')
+    monkeypatch.chdir(tmp_path)
+    store_path = str(tmp_path / 'interactions')
+    context = multiprocessing.get_context('spawn')
+    sources = [context.Queue() for _ in range(NUM_SHARDS)]
+    workers = ShardWorkers(NUM_SHARDS, store_path, functools.partial(open_process_queue, sources))
+
+    events = [
+        {'user_id': f'u{user}', 'item_ids': [str(user), str(user + 1)], 'actions': ['like', 'dislike'],
+         'timestamp': 1.7e9 + user}
+        for user in range(300)
+    ]
+    for start in range(0, len(events), 7):
+        batch = events[start:start + 7]
+        # event collector публикует пачку в очередь шарда каждого пользователя
+        for shard in range(NUM_SHARDS):
+            routed = [event for event in batch if shard_of(event['user_id'], NUM_SHARDS) == shard]
+            if routed:
+                sources[shard].put(orjson.dumps(routed))
+
+    received, flushed = [], {}
+    stats = {}
+
+    def on_flush(shard, n_events, duration, ok):
+        if ok:
+            flushed[shard] = flushed.get(shard, 0) + n_events
+
+    async def run():
+        task = asyncio.create_task(workers.run(received.extend, stats, on_flush))
+        deadline = time.monotonic() + 60
+        while len(received) < len(events) or sum(flushed.values()) < 2 * len(events):
+            if task.done() or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+
+    assert sorted(event['user_id'] for event in received) == sorted(event['user_id'] for event in events)
+    assert set(flushed) == set(range(NUM_SHARDS))
+    total = 0
+    for shard in range(NUM_SHARDS):
+        df = InteractionStore(ShardedInteractionStore.shard_path(store_path, shard), recover=False).scan().collect()
+        assert len(df) == flushed[shard]
+        assert {shard_of(user_id, NUM_SHARDS) for user_id in df['user_id']} == {shard}
+        total += len(df)
+    assert total == 2 * len(events)
+
+    # чтение идет по всем шардам сразу
+    merged = ShardedInteractionStore(store_path, NUM_SHARDS).scan().collect()
+    assert sorted(merged['item_id'].to_list()) == sorted(item for event in events for item in event['item_ids'])
+    assert all(not process.is_alive() for process in workers.processes.values())
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+
+import orjson
+from aio_pika import Message
+
+
+class BatchPublisher:
+    """
+    Копит события в ограниченной очереди и отправляет их в RabbitMQ пачками:
+    одно сообщение с JSON-массивом событий на пачку и routing key. Пачка уходит, когда набралось
+    ``max_batch`` событий или прошло ``max_delay`` секунд с первого события в ней.
+    Публикация должна идти через канал с publisher confirms, тогда future из ``submit``
+    завершается только после подтверждения пачки брокером.
+
+    :param publish: coroutine function publishing aio_pika.Message with routing key, e.g. RabbitMQPool.publish
+    :param routing_key: routing key for published batches or callable event -> routing key,
+        then every batch is split into one message per routing key
+    :param on_batch: optional coroutine function called with events after publishing
+    :param max_batch: max number of events in one message
+    :param max_delay: max time in seconds an event waits in the buffer
+    :param max_queue: buffer size, submit raises asyncio.QueueFull when it is exceeded
+    """
+
+    def __init__(self, publish, routing_key, on_batch=None, max_batch=500, max_delay=0.05, max_queue=10000):
+        self.publish = publish
+        self.routing_key = routing_key
+        self.on_batch = on_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        # отправляем то, что осталось в буфере
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            await self._flush(batch)
+
+    def submit(self, event):
+        """
+        :param event: json-serializable event
+        :return: future resolved when the batch with the event is confirmed by the broker
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((event, future))
+        return future
+
+    def submit_many(self, events):
+        """
+        Ставит в буфер все события или ни одного.
+
+        :param events: list of json-serializable events
+        :return: future resolved when all batches with the events are confirmed by the broker
+        :raises asyncio.QueueFull: if the buffer has no room for all events
+        """
+        if self.queue.maxsize > 0 and self.queue.maxsize - self.queue.qsize() < len(events):
+            raise asyncio.QueueFull
+        return asyncio.gather(*[self.submit(event) for event in events])
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        if callable(self.routing_key):
+            routes = {}
+            for item in batch:
+                routes.setdefault(self.routing_key(item[0]), []).append(item)
+            await asyncio.gather(*[self._publish(routing_key, items) for routing_key, items in routes.items()])
+        else:
+            await self._publish(self.routing_key, batch)
+
+    async def _publish(self, routing_key, batch):
+        events = [event for event, _ in batch]
+        try:
+            await self.publish(
+                Message(orjson.dumps(events), content_type='application/json'),
+                routing_key,
+            )
+        except Exception as e:
+            logging.exception(f'failed to publish batch of {len(events)} events')
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if self.on_batch is not None:
+            try:
+                await self.on_batch(events)
+            except Exception:
+                logging.exception(f'on_batch failed for {len(events)} events')
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
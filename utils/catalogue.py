@@ -0,0 +1,154 @@
+"""
+Компактный каталог фильмов в одном файле, который сервисы открывают через mmap.
+
+Формат: 8 байт сигнатуры, длина JSON-заголовка (uint64 little-endian), заголовок и секции
+с массивами, каждая выровнена на 64 байта. Заголовок хранит число фильмов, список жанров
+и смещение, тип и длину каждой секции:
+
+- ``item_ids`` - int64, отсортированы по возрастанию
+- ``imdb_ids`` - int64, 0 если ссылки нет
+- ``genre_masks`` - битовые маски жанров, бит i соответствует ``genres[i]`` из заголовка
+- ``title_offsets`` - int64, n + 1 смещений названий в ``title_blob``
+- ``title_blob`` - названия в utf-8 подряд
+
+Сборка из csv MovieLens:
+
+    python utils/catalogue.py webapp/static/movies.csv webapp/static/links.csv data/catalogue.bin
+"""
+import csv
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+MAGIC = b'RECSCAT1'
+ALIGNMENT = 64
+CATALOGUE_PATH = os.environ.get('CATALOGUE_PATH', './data/catalogue.bin')
+NO_GENRES = '(no genres listed)'
+
+
+def imdb_url(imdb_id):
+    return f'https://www.imdb.com/title/tt{int(imdb_id):07d}'
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def build(movies_path, links_path, path=CATALOGUE_PATH):
+    """
+    Собирает каталог из movies.csv и links.csv. Файл пишется атомарно.
+
+    :return: number of items
+    """
+    titles, genre_names, imdb_ids = {}, {}, {}
+    with open(movies_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            movie_id = int(row['movieId'])
+            titles[movie_id] = row['title']
+            genre_names[movie_id] = [genre for genre in row['genres'].split('|') if genre and genre != NO_GENRES]
+    with open(links_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if row['imdbId']:
+                imdb_ids[int(row['movieId'])] = int(row['imdbId'])
+
+    item_ids = np.array(sorted(titles.keys() | imdb_ids.keys()), dtype=np.int64)
+    genres = sorted({genre for names in genre_names.values() for genre in names})
+    if len(genres) > 64:
+        raise ValueError(f'{len(genres)} genres do not fit into 64-bit masks')
+    genre_bit = {genre: 1 << i for i, genre in enumerate(genres)}
+    genre_dtype = np.uint32 if len(genres) <= 32 else np.uint64
+
+    encoded_titles = [titles.get(item_id, '').encode('utf-8') for item_id in item_ids.tolist()]
+    sections = {
+        'item_ids': item_ids,
+        'imdb_ids': np.array([imdb_ids.get(item_id, 0) for item_id in item_ids.tolist()], dtype=np.int64),
+        'genre_masks': np.array([
+            sum(genre_bit[genre] for genre in genre_names.get(item_id, []))
+            for item_id in item_ids.tolist()
+        ], dtype=genre_dtype),
+        'title_offsets': np.concatenate([[0], np.cumsum([len(title) for title in encoded_titles])]).astype(np.int64),
+        'title_blob': np.frombuffer(b''.join(encoded_titles), dtype=np.uint8),
+    }
+
+    # смещения секций зависят от длины заголовка, поэтому считаем их с запасом под заголовок
+    header = {'version': 1, 'n_items': len(item_ids), 'genres': genres, 'sections': {}}
+    header_size = len(json.dumps(header)) + 100 * len(sections) + 64
+    offset = _align(len(MAGIC) + 8 + header_size)
+    for name, array in sections.items():
+        header['sections'][name] = {'offset': offset, 'dtype': array.dtype.str, 'length': len(array)}
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode()
+    assert len(header_bytes) <= header_size
+
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in sections.items():
+            f.seek(header['sections'][name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+    return len(item_ids)
+
+
+class Catalogue:
+    """
+    Каталог, открытый через mmap: массивы - представления над файлом без копирования,
+    поэтому несколько воркеров на одной машине делят одни и те же страницы.
+
+    :param path: artifact built by ``build``
+    """
+
+    def __init__(self, path=CATALOGUE_PATH):
+        self.path = path
+        self._mmap = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self._mmap[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f'{path} is not a catalogue')
+        (header_length,) = struct.unpack('<Q', bytes(self._mmap[len(MAGIC):len(MAGIC) + 8]))
+        header_start = len(MAGIC) + 8
+        self.header = json.loads(bytes(self._mmap[header_start:header_start + header_length]))
+        self.genre_names = self.header['genres']
+
+        for name, section in self.header['sections'].items():
+            dtype = np.dtype(section['dtype'])
+            setattr(self, name, np.ndarray(
+                shape=(section['length'],), dtype=dtype, buffer=self._mmap, offset=section['offset']))
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def positions(self, item_ids):
+        """
+        :param item_ids: item ids as int or str
+        :return: positions of item ids in the catalogue, -1 for unknown ones
+        """
+        item_ids = np.array([int(item_id) if str(item_id).isdigit() else -1 for item_id in item_ids], dtype=np.int64)
+        if len(self.item_ids) == 0:
+            return np.full(len(item_ids), -1)
+        positions = np.searchsorted(self.item_ids, item_ids)
+        positions = np.minimum(positions, len(self.item_ids) - 1)
+        return np.where(self.item_ids[positions] == item_ids, positions, -1)
+
+    def __contains__(self, item_id):
+        return self.positions([item_id])[0] >= 0
+
+    def title(self, position):
+        start, end = self.title_offsets[position], self.title_offsets[position + 1]
+        return bytes(self.title_blob[start:end]).decode('utf-8')
+
+    def genres(self, position):
+        mask = int(self.genre_masks[position])
+        return [genre for i, genre in enumerate(self.genre_names) if mask >> i & 1]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        sys.exit(f'usage: {sys.argv[0]} movies.csv links.csv [catalogue.bin]')
+    n_items = build(*sys.argv[1:])
+    print(f'catalogue with {n_items} items written to {sys.argv[3] if len(sys.argv) == 4 else CATALOGUE_PATH}')
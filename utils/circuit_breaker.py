@@ -0,0 +1,58 @@
+import time
+
+
+class CircuitBreaker:
+    """
+    Размыкатель для вызовов внешнего сервиса.
+
+    После ``failure_threshold`` ошибок подряд цепь размыкается, и ``allow`` запрещает вызовы
+    на ``reset_timeout`` секунд: клиенты сразу уходят в fallback, а не ждут таймаута.
+    Затем пропускается один пробный вызов (half-open): успех замыкает цепь, ошибка
+    размыкает ее снова. Если пробный вызов не закончился ни успехом, ни ошибкой
+    (например, запрос отменили), через ``reset_timeout`` пропускается следующий.
+
+    :param failure_threshold: consecutive failures which open the circuit
+    :param reset_timeout: seconds before a trial call is allowed
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+        self.stats = {'calls': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    def allow(self):
+        now = time.monotonic()
+        if (self.state == self.OPEN and now - self.opened_at >= self.reset_timeout
+                or self.state == self.HALF_OPEN and now - self.trial_started_at >= self.reset_timeout):
+            self.state = self.HALF_OPEN
+            self.trial_started_at = now
+            return True
+        if self.state != self.CLOSED:
+            # пока идет пробный вызов, остальные тоже получают отказ
+            self.stats['rejected'] += 1
+            return False
+        return True
+
+    def record_success(self):
+        self.stats['calls'] += 1
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.stats['calls'] += 1
+        self.stats['failures'] += 1
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.stats['opened'] += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def health(self):
+        return {'state': self.state, **self.stats}
@@ -0,0 +1,245 @@
+"""
+Метрики Prometheus и профилирование сервисов.
+
+FastAPI-приложения подключают ``instrument_app``: гистограмма задержек по шаблону маршрута
+и ``/metrics``. ml-pipeline отдает те же метрики через ``start_metrics_server``. Вызовы Redis,
+RabbitMQ и других сервисов оборачиваются в ``track_call``, этапы пайплайна - в ``track_stage``.
+
+Профайлер сэмплирует стеки всех потоков и отдает их в формате folded stacks, из которого
+flamegraph.pl или speedscope рисуют flamegraph. Он включается переменной ``PROFILING_ENABLED``:
+у приложений появляется ``/debug/profile?seconds=10``, а ml-pipeline по сигналу SIGUSR1
+пишет профиль в файл.
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter as MetricCounter, Gauge, Histogram, generate_latest
+from prometheus_client import start_http_server
+
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 8001))
+# ограничение на длительность одного профиля, секунды
+MAX_PROFILE_SECONDS = 60
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route template',
+    ['method', 'route', 'status'],
+)
+DEPENDENCY_LATENCY = Histogram(
+    'dependency_call_duration_seconds', 'Latency of calls to Redis, RabbitMQ and other services',
+    ['dependency', 'operation'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+DEPENDENCY_ERRORS = MetricCounter(
+    'dependency_errors_total', 'Failed calls to Redis, RabbitMQ and other services',
+    ['dependency', 'operation'],
+)
+
+CONSUMER_LAG = Gauge('consumer_lag_seconds', 'Time from the last consumed event to its consumption')
+CONSUMER_EVENTS = MetricCounter('consumer_events_total', 'Events read from the queue')
+CONSUMER_BATCH_SIZE = Histogram(
+    'consumer_batch_size_events', 'Events written to the interaction store per flush', ['shard'],
+    buckets=(1, 10, 100, 1000, 10_000, 100_000, 1_000_000),
+)
+CONSUMER_FLUSH_DURATION = Histogram(
+    'consumer_flush_duration_seconds', 'Duration of one flush to the interaction store', ['shard'],
+)
+CONSUMER_FAILED_FLUSHES = MetricCounter(
+    'consumer_failed_flushes_total', 'Flushes returned to the queue after a write error', ['shard'],
+)
+
+PIPELINE_STAGE_DURATION = Histogram(
+    'pipeline_stage_duration_seconds', 'Duration of ml-pipeline stages', ['stage'],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200, 3600),
+)
+PIPELINE_STAGE_FAILURES = MetricCounter('pipeline_stage_failures_total', 'Failed ml-pipeline stages', ['stage'])
+PIPELINE_TRIALS = MetricCounter('pipeline_trials_total', 'Finished optuna trials by state', ['state'])
+PIPELINE_BEST_VALUE = Gauge('pipeline_best_value', 'Best objective value of the optuna study')
+
+
+@contextmanager
+def track_call(dependency, operation):
+    """
+    Замеряет вызов внешней зависимости, ошибки считаются и пробрасываются дальше.
+    Подходит и для ``await`` внутри блока.
+    """
+    t_start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        DEPENDENCY_ERRORS.labels(dependency, operation).inc()
+        raise
+    finally:
+        DEPENDENCY_LATENCY.labels(dependency, operation).observe(time.perf_counter() - t_start)
+
+
+@contextmanager
+def track_stage(stage):
+    t_start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        PIPELINE_STAGE_FAILURES.labels(stage).inc()
+        raise
+    finally:
+        PIPELINE_STAGE_DURATION.labels(stage).observe(time.perf_counter() - t_start)
+
+
+def track_flush(shard, batch_size, duration, ok=True):
+    if ok:
+        CONSUMER_BATCH_SIZE.labels(shard).observe(batch_size)
+        CONSUMER_FLUSH_DURATION.labels(shard).observe(duration)
+    else:
+        CONSUMER_FAILED_FLUSHES.labels(shard).inc()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware с гистограммой задержек. Маршрут берется из шаблона (``/recs/{user_id}``),
+    а не из пути запроса, чтобы число серий не росло с числом пользователей.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        t_start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # роутер starlette кладет найденный маршрут в scope
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            REQUEST_LATENCY.labels(scope['method'], route, status).observe(time.perf_counter() - t_start)
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профайлер: раз в ``interval`` секунд снимает стеки всех потоков процесса
+    через ``sys._current_frames`` и считает одинаковые стеки. Сам процесс не трассируется,
+    поэтому накладные расходы зависят только от частоты сэмплов. В стеке потока event loop
+    видна цепочка корутин, которая выполнялась в момент сэмпла.
+
+    :param interval: seconds between samples
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+    def sample(self, seconds, interval=None):
+        """
+        Блокирует вызывающий поток на ``seconds`` секунд, его собственный стек в профиль не попадает.
+        Одновременно идет только один профиль.
+
+        :param interval: seconds between samples, the profiler's interval by default
+        :return: Counter of stacks, each a tuple of frame names from the thread name to the leaf
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError('profiling is already running')
+        interval = interval or self.interval
+        try:
+            own_thread = threading.get_ident()
+            stacks = Counter()
+            deadline = time.monotonic() + min(seconds, MAX_PROFILE_SECONDS)
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_thread:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._frame_name(frame))
+                        frame = frame.f_back
+                    stack.append(names.get(thread_id, str(thread_id)))
+                    stacks[tuple(reversed(stack))] += 1
+                time.sleep(interval)
+            return stacks
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def folded(stacks):
+        """
+        :return: folded stacks, one ``frame;frame;frame count`` line per stack
+        """
+        return ''.join(f'{";".join(stack)} {count}\n' for stack, count in stacks.most_common())
+
+
+profiler = SamplingProfiler()
+
+
+def instrument_app(app, profiling=PROFILING_ENABLED):
+    """
+    Подключает к FastAPI-приложению гистограмму задержек, ``/metrics`` и, если включено,
+    ``/debug/profile``.
+    """
+    from fastapi import HTTPException, Response
+    from starlette.concurrency import run_in_threadpool
+
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get('/metrics', include_in_schema=False)
+    def metrics():
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+    if not profiling:
+        return app
+
+    @app.get('/debug/profile', include_in_schema=False)
+    async def profile(seconds: float = 10, interval: float = 0.005):
+        # сэмплер работает в отдельном потоке, а event loop продолжает обслуживать запросы
+        try:
+            stacks = await run_in_threadpool(profiler.sample, seconds, max(interval, 0.001))
+        except RuntimeError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        return Response(SamplingProfiler.folded(stacks), media_type='text/plain')
+
+    return app
+
+
+def start_metrics_server(port=METRICS_PORT, profile_dir='./data', profiling=PROFILING_ENABLED):
+    """
+    Отдает метрики процесса без FastAPI на ``port``. С включенным профилированием SIGUSR1
+    запускает профиль на 30 секунд в фоновом потоке и пишет его в ``profile_dir``.
+    """
+    start_http_server(port)
+    logging.info(f'metrics are served on port {port}')
+    if not profiling:
+        return
+
+    def write_profile():
+        try:
+            stacks = profiler.sample(30)
+        except RuntimeError:
+            logging.warning('profiling is already running')
+            return
+        path = os.path.join(profile_dir, f'profile-{int(time.time())}.folded')
+        with open(path + '.tmp', 'w') as f:
+            f.write(SamplingProfiler.folded(stacks))
+        os.replace(path + '.tmp', path)
+        logging.info(f'profile written to {path}')
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(
+        target=write_profile, name='profiler', daemon=True).start())
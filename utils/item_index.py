@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+
+
+class ItemIndex:
+    """
+    IVF-индекс эмбеддингов фильмов для поиска похожих по косинусной близости.
+
+    Векторы разбиваются k-means на ``n_lists`` кластеров и хранятся подряд по кластерам,
+    запрос сравнивается только с векторами из ``n_probe`` ближайших кластеров.
+
+    :param item_ids: item identifiers in index order
+    :param vectors: normalized item vectors sorted by cluster
+    :param centroids: normalized cluster centroids
+    :param offsets: start of each cluster in ``vectors``, len(centroids) + 1 values
+    """
+
+    def __init__(self, item_ids, vectors, centroids, offsets):
+        self.item_ids = np.asarray(item_ids)
+        self.vectors = vectors
+        self.centroids = centroids
+        self.offsets = offsets
+        self.positions = {item_id: i for i, item_id in enumerate(self.item_ids.tolist())}
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    @classmethod
+    def build(cls, item_ids, vectors, n_lists=None, n_iter=10, seed=42):
+        vectors = cls._normalize(np.asarray(vectors, dtype=np.float32))
+        n_lists = n_lists or max(1, int(np.sqrt(len(vectors))))
+        n_lists = min(n_lists, len(vectors))
+
+        # сферический k-means
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, vectors)
+            counts = np.bincount(assignment, minlength=n_lists)
+            empty = counts == 0
+            # пустые кластеры переинициализируем случайными точками
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+            centroids = cls._normalize(sums)
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+        return cls(np.asarray(item_ids)[order], vectors[order], centroids, offsets)
+
+    def save(self, path):
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, item_ids=self.item_ids.astype(str), vectors=self.vectors,
+                     centroids=self.centroids, offsets=self.offsets)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['item_ids'], data['vectors'], data['centroids'], data['offsets'])
+
+    def similar(self, item_ids, k=10, n_probe=8):
+        """
+        :param item_ids: query items, their mean vector is used as the query
+        :param k: number of items to return
+        :param n_probe: number of clusters to search in
+        :return: most similar items except the query ones
+        """
+        positions = [self.positions[item_id] for item_id in item_ids if item_id in self.positions]
+        if not positions:
+            return []
+        query = self._normalize(self.vectors[positions].mean(axis=0))
+
+        n_probe = min(n_probe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        candidates = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in lists])
+        candidates = candidates[~np.isin(candidates, positions)]
+        if len(candidates) == 0:
+            return []
+
+        scores = self.vectors[candidates] @ query
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return self.item_ids[candidates[top]].tolist()
@@ -1,6 +1,8 @@
 import numpy as np
 
-from typing import List, Any
+from functools import lru_cache
+from itertools import chain
+from typing import List, Any, Dict, Optional, Tuple
 
 
 def user_hitrate(y_relevant: List[str], y_recs: List[str], k: int = 10) -> int:
@@ -34,4 +36,70 @@ def user_ndcg(y_rel: List[Any], y_rec: List[Any], k: int = 10) -> float:
     """
     dcg = sum([1. / np.log2(idx + 2) for idx, item in enumerate(y_rec[:k]) if item in y_rel])
     idcg = sum([1. / np.log2(idx + 2) for idx, _ in enumerate(zip(y_rel, np.arange(k)))])
-    return dcg / idcg
\ No newline at end of file
+    return dcg / idcg
+
+@lru_cache(maxsize=None)
+def _discount(k: int) -> np.ndarray:
+    return 1. / np.log2(np.arange(k) + 2)
+
+
+def to_csr(y_rel: List[List[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param y_rel: relevant items for every user
+    :return: indptr and indices of relevance matrix in CSR layout
+    """
+    indptr = np.zeros(len(y_rel) + 1, dtype=np.int64)
+    np.cumsum([len(items) for items in y_rel], out=indptr[1:])
+    indices = np.fromiter(chain.from_iterable(y_rel), dtype=np.int64, count=indptr[-1])
+    return indptr, indices
+
+
+def batch_metrics(y_rec: np.ndarray, indptr: np.ndarray, indices: np.ndarray,
+                  k: int = 10, n_items: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Vectorized version of user_* metrics for all users at once.
+
+    :param y_rec: (n_users, n_recs) recommended item ids (non-negative ints), padded with -1
+    :param indptr: CSR row pointers of relevant items, see to_csr
+    :param indices: CSR relevant item ids
+    :param k: number of top recommended items
+    :param n_items: catalogue size for coverage
+    :return: per-user arrays ndcg, recall, hitrate, intersection, map and scalar coverage
+    """
+    y_rec = np.asarray(y_rec, dtype=np.int64)[:, :k]
+    n_users, width = y_rec.shape
+    rel_len = np.diff(indptr)
+    modulus = int(max(y_rec.max(initial=0), indices.max(initial=0))) + 1
+
+    # пары (пользователь, фильм) кодируем одним числом, чтобы искать попадания одним isin
+    rel_keys = np.unique(np.repeat(np.arange(n_users), rel_len) * modulus + indices)
+    rel_unique_len = np.bincount(rel_keys // modulus, minlength=n_users)
+    hits = np.isin(np.arange(n_users)[:, None] * modulus + y_rec, rel_keys) & (y_rec >= 0)
+
+    # в пересечение каждый фильм входит один раз, даже если рекомендован повторно
+    order = np.argsort(y_rec, axis=1, kind='stable')
+    sorted_rec = np.take_along_axis(y_rec, order, axis=1)
+    first_sorted = np.ones_like(sorted_rec, dtype=bool)
+    first_sorted[:, 1:] = sorted_rec[:, 1:] != sorted_rec[:, :-1]
+    first = np.empty_like(first_sorted)
+    np.put_along_axis(first, order, first_sorted, axis=1)
+    unique_hits = hits & first
+
+    intersection = unique_hits.sum(axis=1)
+    discount = _discount(k)
+    dcg = hits @ discount[:width]
+    idcg = np.concatenate([[0.], np.cumsum(discount)])[np.minimum(rel_len, k)]
+    precision = np.cumsum(unique_hits, axis=1) / np.arange(1, width + 1)
+    ap = (precision * unique_hits).sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics = {
+            'ndcg': dcg / idcg,
+            'recall': intersection / rel_unique_len,
+            'hitrate': (intersection > 0).astype(int),
+            'intersection': intersection,
+            'map': ap / np.minimum(rel_unique_len, k),
+        }
+    if n_items is not None:
+        metrics['coverage'] = len(np.unique(y_rec[y_rec >= 0])) / n_items
+    return metrics
@@ -1,7 +1,7 @@
 import time
 from typing import List, Optional, Literal
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 
 
 class RecommendationsResponse(BaseModel):
@@ -14,6 +14,14 @@ class InteractEvent(BaseModel):
     actions: List[Literal['like', 'dislike']] = Field(description="positive or negative reaction for items")
     timestamp: Optional[float] = Field(time.time(), description="timestamp of event")
 
+    @model_validator(mode='after')
+    def check_lengths(self):
+        # действие нужно каждому фильму, иначе пайплайн не сможет разложить событие по строкам
+        if len(self.item_ids) != len(self.actions):
+            raise ValueError(f'got {len(self.item_ids)} item_ids and {len(self.actions)} actions, '
+                             f'lengths must be equal')
+        return self
+
 
 class NewItemsEvent(BaseModel):
     item_ids: List[str] = Field(description="identifiers of new items")
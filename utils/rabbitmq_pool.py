@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+import time
+import zlib
+
+import aio_pika
+from aio_pika.pool import Pool
+
+from instrumentation import track_call
+
+QUEUE_NAME = 'user_interactions'
+ROUTING_KEY = 'user.interact.message'
+EXCHANGE_NAME = 'user.interact'
+# события делятся между очередями по хэшу user_id, при одном шарде остаются старые имена
+NUM_SHARDS = int(os.environ.get('NUM_SHARDS', 1))
+
+
+def connection_url():
+    return 'amqp://{}:{}@{}:{}/'.format(
+        os.environ.get('RABBITMQ_USER', 'guest'),
+        os.environ.get('RABBITMQ_PASS', 'guest'),
+        os.environ.get('RABBITMQ_HOST', 'localhost'),
+        int(os.environ.get('RABBITMQ_PORT', 5672)),
+    )
+
+
+def shard_of(user_id, num_shards=NUM_SHARDS):
+    """
+    Стабильный между процессами и перезапусками номер шарда пользователя.
+    """
+    return zlib.crc32(str(user_id).encode()) % num_shards
+
+
+def shard_queue_name(shard, num_shards=NUM_SHARDS):
+    return QUEUE_NAME if num_shards == 1 else f'{QUEUE_NAME}.{shard}'
+
+
+def shard_routing_key(shard, num_shards=NUM_SHARDS):
+    return ROUTING_KEY if num_shards == 1 else f'{ROUTING_KEY}.{shard}'
+
+
+class RabbitMQPool:
+    """
+    Одно robust-соединение с RabbitMQ на процесс и пул каналов поверх него.
+
+    Соединение открывается и exchange, очереди шардов и их binding объявляются один раз: параллельные
+    вызовы ``connect`` ждут первого под общим lock. После обрыва aio-pika сама переподключается
+    и повторяет объявления на канале, через который они были сделаны, поэтому этот канал
+    не закрывается до ``close``.
+
+    :param exchange_name: direct exchange events are published to
+    :param num_shards: number of shard queues bound to the exchange
+    :param pool_size: max number of channels used by concurrent publishers
+    :param publisher_confirms: whether publish waits for the broker ack
+    """
+
+    def __init__(self, exchange_name=EXCHANGE_NAME, num_shards=NUM_SHARDS, pool_size=8, publisher_confirms=True):
+        self.exchange_name = exchange_name
+        self.num_shards = num_shards
+        self.pool_size = pool_size
+        self.publisher_confirms = publisher_confirms
+
+        self.connection = None
+        self.channels = None
+        self._declare_channel = None
+        self._lock = None
+        self.stats = {'connects': 0, 'reconnects': 0, 'publish_errors': 0,
+                      'last_error': None, 'last_error_time': None}
+
+    async def connect(self):
+        """
+        :return: robust connection, opened and declared on the first call
+        """
+        if self.connection is not None:
+            return self.connection
+        # lock создается в работающем event loop, а не при импорте модуля
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.connection is not None:
+                return self.connection
+            connection = None
+            try:
+                with track_call('rabbitmq', 'connect'):
+                    connection = await aio_pika.connect_robust(connection_url())
+                    channel = await connection.channel()
+                    exchange = await channel.declare_exchange(self.exchange_name, type='direct')
+                    for shard in range(self.num_shards):
+                        queue = await channel.declare_queue(self.queue_name(shard))
+                        await queue.bind(exchange, self.routing_key(shard))
+            except Exception as e:
+                self._set_error(e)
+                if connection is not None:
+                    # иначе robust-соединение переподключалось бы в фоне, а следующий
+                    # connect открыл бы еще одно
+                    try:
+                        await connection.close()
+                    except Exception:
+                        logging.exception('failed to close rabbitmq connection')
+                raise
+            connection.reconnect_callbacks.add(self._on_reconnect)
+            self._declare_channel = channel
+            self.channels = Pool(self._open_channel, max_size=self.pool_size)
+            self.connection = connection
+            self.stats['connects'] += 1
+            logging.info(f'connected to rabbitmq, exchange {self.exchange_name} '
+                         f'and {self.num_shards} shard queues declared')
+        return self.connection
+
+    def queue_name(self, shard=0):
+        return shard_queue_name(shard, self.num_shards)
+
+    def routing_key(self, shard=0):
+        return shard_routing_key(shard, self.num_shards)
+
+    def routing_key_for(self, user_id):
+        return self.routing_key(shard_of(user_id, self.num_shards))
+
+    async def _open_channel(self):
+        return await self.connection.channel(publisher_confirms=self.publisher_confirms)
+
+    def _on_reconnect(self, *args):
+        self.stats['reconnects'] += 1
+        logging.warning('reconnected to rabbitmq')
+
+    def _set_error(self, error):
+        self.stats['last_error'] = repr(error)
+        self.stats['last_error_time'] = time.time()
+
+    async def publish(self, message, routing_key=None):
+        """
+        Публикует сообщение через свободный канал из пула.
+
+        :param message: aio_pika.Message
+        :param routing_key: routing key, the first shard one by default
+        """
+        await self.connect()
+        try:
+            with track_call('rabbitmq', 'publish'):
+                async with self.channels.acquire() as channel:
+                    # объявление уже сделано, здесь только ссылка на exchange без обращения к брокеру
+                    exchange = await channel.get_exchange(self.exchange_name, ensure=False)
+                    await exchange.publish(message, routing_key or self.routing_key())
+        except Exception as e:
+            self.stats['publish_errors'] += 1
+            self._set_error(e)
+            raise
+
+    async def purge_queue(self):
+        await self.connect()
+        with track_call('rabbitmq', 'purge'):
+            async with self.channels.acquire() as channel:
+                for shard in range(self.num_shards):
+                    queue = await channel.get_queue(self.queue_name(shard), ensure=False)
+                    await queue.purge()
+
+    def is_healthy(self):
+        return self.connection is not None and not self.connection.is_closed and self.connection.connected.is_set()
+
+    def health(self):
+        """
+        :return: connection state for /healthcheck
+        """
+        return {'connected': self.is_healthy(), **self.stats}
+
+    async def close(self):
+        if self.channels is not None:
+            await self.channels.close()
+        if self.connection is not None:
+            await self.connection.close()
+        self.connection = self.channels = self._declare_channel = None
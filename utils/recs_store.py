@@ -0,0 +1,128 @@
+import logging
+import time
+from itertools import islice
+
+from instrumentation import track_call
+
+
+# ключ с номером актуального поколения персональных рекомендаций. Рекомендации пользователя -
+# sorted set с позицией в выдаче вместо score, из него сервис рекомендаций вычитает просмотренные
+# одной командой ZDIFF. Поколения в JSON от прошлых версий записаны под старым ключом и не читаются
+RECS_GENERATION_KEY = 'recs:generation:zset'
+# сколько живут ключи предыдущего поколения после переключения
+PREVIOUS_GENERATION_TTL = 120
+# канал, в который пайплайн сообщает об обновлении top_items и поколения рекомендаций
+INVALIDATION_CHANNEL = 'recs:invalidate'
+# сколько последних лайков пользователя хранится для сессионных рекомендаций
+RECENT_LIKES_LIMIT = 20
+# канал, в который event collector пишет новые лайки пачки: JSON-список пар [user_id, item_ids]
+LIKES_CHANNEL = 'recs:likes'
+
+
+def recs_key(generation, user_id):
+    return f'recs:{generation}:{user_id}'
+
+
+def recent_likes_key(user_id):
+    return f'likes:{user_id}'
+
+
+def ranked(item_ids):
+    """
+    :return: sorted set mapping item id -> position in recommendations
+    """
+    return {item_id: rank for rank, item_id in enumerate(item_ids)}
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def publish_recommendations(redis_connection, recommendations, chunk_size=1000):
+    """
+    Пишет рекомендации в новое поколение ключей пачками через pipeline и только
+    после записи всех пачек переключает RECS_GENERATION_KEY, поэтому читатели
+    никогда не видят наполовину записанное поколение.
+
+    :param redis_connection: sync redis client
+    :param recommendations: iterable of (user_id, item_ids)
+    :param chunk_size: number of keys per pipeline round-trip
+    :return: publishing stats
+    """
+    generation = str(time.time_ns())
+    previous = redis_connection.get(RECS_GENERATION_KEY)
+    t_start = time.time()
+    keys_written = 0
+
+    for batch_num, chunk in enumerate(_chunks(recommendations, chunk_size)):
+        t_batch = time.time()
+        pipe = redis_connection.pipeline(transaction=False)
+        for user_id, item_ids in chunk:
+            pipe.zadd(recs_key(generation, user_id), ranked(item_ids))
+        with track_call('redis', 'publish_recs'):
+            pipe.execute()
+        keys_written += len(chunk)
+        logging.info(f'recs generation {generation}: batch {batch_num} '
+                     f'wrote {len(chunk)} keys in {time.time() - t_batch:.3f}s')
+
+    redis_connection.set(RECS_GENERATION_KEY, generation)
+    redis_connection.publish(INVALIDATION_CHANNEL, RECS_GENERATION_KEY)
+    if previous is not None:
+        expire_generation(redis_connection, previous.decode(), chunk_size)
+
+    stats = {
+        'generation': generation,
+        'keys': keys_written,
+        'seconds': time.time() - t_start,
+    }
+    logging.info(f'recs generation {generation} published: {stats}')
+    return stats
+
+
+def update_recommendations(redis_connection, recommendations, chunk_size=1000):
+    """
+    Перезаписывает рекомендации отдельных пользователей в текущем поколении.
+    Запись одного ключа атомарна, поэтому переключать поколение не нужно.
+
+    :return: publishing stats or None if there is no current generation yet
+    """
+    generation = redis_connection.get(RECS_GENERATION_KEY)
+    if generation is None:
+        return None
+    generation = generation.decode()
+    t_start = time.time()
+    keys_written = 0
+    for chunk in _chunks(recommendations, chunk_size):
+        # старый sorted set заменяется целиком в MULTI, читатель не увидит его пустым или смешанным
+        pipe = redis_connection.pipeline(transaction=True)
+        for user_id, item_ids in chunk:
+            pipe.delete(recs_key(generation, user_id))
+            pipe.zadd(recs_key(generation, user_id), ranked(item_ids))
+        with track_call('redis', 'update_recs'):
+            pipe.execute()
+        keys_written += len(chunk)
+
+    stats = {
+        'generation': generation,
+        'keys': keys_written,
+        'seconds': time.time() - t_start,
+    }
+    logging.info(f'recs generation {generation} updated: {stats}')
+    return stats
+
+
+def expire_generation(redis_connection, generation, chunk_size=1000):
+    """
+    Ставит TTL на ключи старого поколения, чтобы запросы, успевшие прочитать
+    его номер до переключения, еще получили свои данные.
+    """
+    keys = redis_connection.scan_iter(match=recs_key(generation, '*'), count=chunk_size)
+    for chunk in _chunks(keys, chunk_size):
+        pipe = redis_connection.pipeline(transaction=False)
+        for key in chunk:
+            pipe.expire(key, PREVIOUS_GENERATION_TTL)
+        with track_call('redis', 'expire_generation'):
+            pipe.execute()
+
@@ -1,26 +1,176 @@
-import boto3
+import json
+import logging
 import os
-import requests 
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import requests
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+ARCHIVE_URL = os.environ.get('IMAGES_ARCHIVE_URL', 'https://storage.yandexcloud.net/web-imgs-arch/images.zip')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://storage.yandexcloud.net')
+BUCKET = 'web-images'
+DOWNLOAD_WORKERS = int(os.environ.get('S3_DOWNLOAD_WORKERS', 16))
+CHUNK_SIZE = 1 << 20
+# ETag загруженных объектов, по нему повторная синхронизация пропускает неизменившиеся файлы
+ETAGS_FILE = '.etags.json'
+
+
+def s3_client():
+    return boto3.client(service_name='s3',
+                        region_name="ru-central1",
+                        endpoint_url=S3_ENDPOINT_URL,
+                        aws_access_key_id=os.environ.get('S3_PUB'),
+                        aws_secret_access_key=os.environ.get('S3_SECRET'))
+
+
+def _load_etags(path):
+    try:
+        with open(os.path.join(path, ETAGS_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_etags(path, etags):
+    etags_path = os.path.join(path, ETAGS_FILE)
+    with open(etags_path + '.tmp', 'w') as f:
+        json.dump(etags, f)
+    os.replace(etags_path + '.tmp', etags_path)
+
+
+def _is_synced(filename, obj, etags):
+    try:
+        size = os.path.getsize(filename)
+    except FileNotFoundError:
+        return False
+    return size == obj['Size'] and etags.get(obj['Key']) == obj['ETag']
+
+
+def download_static_images(path, bucket=BUCKET, client=None, workers=DOWNLOAD_WORKERS):
+    """
+    Синхронизирует бакет с директорией: список объектов читается постранично, файлы качаются
+    в пуле потоков во временные файлы и атомарно переименовываются. Файлы, совпадающие
+    с объектом по размеру и ETag, повторно не скачиваются, поэтому прерванную синхронизацию
+    можно просто запустить заново.
+
+    :param client: boto3 s3 client or a compatible stand-in
+    :return: dict with numbers of listed, downloaded, skipped and failed objects
+    """
+    client = client or s3_client()
+    os.makedirs(path, exist_ok=True)
+    etags = _load_etags(path)
+    stats = {'listed': 0, 'downloaded': 0, 'skipped': 0, 'failed': 0}
+
+    def download(obj):
+        filename = os.path.join(path, obj['Key'])
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        client.download_file(Bucket=bucket, Key=obj['Key'], Filename=filename + '.part')
+        os.replace(filename + '.part', filename)
+        return obj
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket):
+            for obj in page.get('Contents', []):
+                stats['listed'] += 1
+                if obj['Key'].endswith('/') or _is_synced(os.path.join(path, obj['Key']), obj, etags):
+                    stats['skipped'] += 1
+                    continue
+                futures.append(executor.submit(download, obj))
+
+        for i, future in enumerate(futures):
+            try:
+                obj = future.result()
+            except Exception:
+                stats['failed'] += 1
+                logging.exception('failed to download object')
+                continue
+            etags[obj['Key']] = obj['ETag']
+            stats['downloaded'] += 1
+            # прогресс сохраняется по ходу, чтобы после падения не качать все заново
+            if i % 1000 == 999:
+                _save_etags(path, etags)
+    _save_etags(path, etags)
+    logging.info(f'synced {path} with bucket {bucket}: {stats}')
+    return stats
+
+
+def download_file(url, filename, timeout=30):
+    """
+    Скачивает файл потоком на диск. Недокачанный ``filename.part`` докачивается
+    запросом Range, если сервер его поддерживает, иначе скачивается заново.
+    """
+    part = filename + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:
+            # все уже скачано
+            os.replace(part, filename)
+            return
+        response.raise_for_status()
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        with open(part, mode) as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+    os.replace(part, filename)
+
 
-from io import BytesIO
+def download_static_images_arch(path, url=ARCHIVE_URL):
+    """
+    Скачивает архив с картинками на диск и распаковывает его в ``path``. Архив
+    в память целиком не читается, уже распакованные файлы того же размера пропускаются.
+    """
+    os.makedirs(path, exist_ok=True)
+    archive = os.path.join(path, '.images.zip')
+    if not os.path.exists(archive):
+        download_file(url, archive)
+    extracted = 0
+    with zipfile.ZipFile(archive) as zip_file:
+        for member in zip_file.infolist():
+            target = os.path.join(path, member.filename)
+            if member.is_dir() or (os.path.exists(target) and os.path.getsize(target) == member.file_size):
+                continue
+            zip_file.extract(member, path)
+            extracted += 1
+    os.remove(archive)
+    logging.info(f'extracted {extracted} files from {url} to {path}')
+    return extracted
 
 
-def download_static_images(path):
-    s3 = boto3.client(service_name='s3',
-                    region_name="ru-central1",
-                    endpoint_url="https://storage.yandexcloud.net",
-                    aws_access_key_id=os.environ.get('S3_PUB'),
-                    aws_secret_access_key=os.environ.get('S3_SECRET'))
+def make_variants(path, out_path, width=300, image_format='WEBP', quality=80, workers=DOWNLOAD_WORKERS):
+    """
+    Делает уменьшенные копии картинок для сетки фильмов. Нужен Pillow; копии, которые
+    новее исходников, не пересоздаются.
 
-    os.makedirs(path)
+    :param width: width of variants in pixels, aspect ratio is kept
+    :return: number of created variants
+    """
+    if Image is None:
+        raise ImportError('Pillow is required to make image variants')
+    os.makedirs(out_path, exist_ok=True)
+    extension = image_format.lower()
 
-    for key in s3.list_objects(Bucket='web-images')['Contents']:
-        s3.download_file(Bucket='web-images',
-                    Key=key['Key'],
-                    Filename=os.path.join(path, key['Key']))
+    def convert(name):
+        source = os.path.join(path, name)
+        target = os.path.join(out_path, os.path.splitext(name)[0] + '.' + extension)
+        if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+            return False
+        with Image.open(source) as image:
+            image.thumbnail((width, width * 10))
+            image.save(target + '.tmp', format=image_format, quality=quality)
+        os.replace(target + '.tmp', target)
+        return True
 
-def download_static_images_arch(path):
-    arch = requests.get('https://storage.yandexcloud.net/web-imgs-arch/images.zip')
-    with zipfile.ZipFile(BytesIO(arch.content)) as zip_file:
-        zip_file.extractall(path)
+    names = [name for name in os.listdir(path) if name.lower().endswith(('.jpg', '.jpeg', '.png'))]
+    # Pillow отпускает GIL при декодировании и сжатии, поэтому потоки дают ускорение
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        created = sum(executor.map(convert, names))
+    logging.info(f'made {created} {image_format} variants of {len(names)} images in {out_path}')
+    return created
@@ -4,23 +4,84 @@ import redis.asyncio as redis
 
 
 class WatchedFilter:
-    def __init__(self):
-        self.redis_connection = redis.Redis(
+    """
+    Просмотренные пользователем фильмы хранятся одним множеством на пользователя,
+    поэтому проверка всех кандидатов - одна команда SMISMEMBER.
+
+    :param ttl: optional lifetime of a user's watched set in seconds, prolonged on every add
+    """
+
+    def __init__(self, ttl=None, redis_connection=None):
+        self.redis_connection = redis_connection or redis.Redis(
             host=os.environ.get('REDIS_HOST', 'localhost'),
-            port=int(os.environ.get('REDIS_PORT', 6397)),
+            port=int(os.environ.get('REDIS_PORT', 6379)),
             password=os.environ.get('REDIS_PASSWORD')
         )
+        self.ttl = ttl or int(os.environ.get('WATCHED_TTL', 0)) or None
+
+    @staticmethod
+    def key(user_id):
+        return f'watched:{user_id}'
 
-    async def add(self, user_id, item_id):
+    async def add(self, user_id, *item_ids):
+        if not item_ids:
+            return
         try:
-            await self.redis_connection.set(f'{user_id}_{item_id}', 1)
-        except redis.exceptions.ConnectionError:
+            pipe = self.redis_connection.pipeline(transaction=False)
+            self.add_to_pipeline(pipe, user_id, *item_ids)
+            await pipe.execute()
+        except redis.ConnectionError:
             # ignore errors if redis unavailable
             pass
 
-    def remove_all(self):
+    def add_to_pipeline(self, pipe, user_id, *item_ids):
+        """
+        Добавляет команды записи в чужой pipeline, чтобы объединить их с другими записями.
+        """
+        pipe.sadd(self.key(user_id), *item_ids)
+        if self.ttl is not None:
+            pipe.expire(self.key(user_id), self.ttl)
+
+    async def filter(self, user_id, item_ids):
+        """
+        :return: items from item_ids the user has not interacted with
+        """
+        if not item_ids:
+            return []
+        try:
+            watched = await self.redis_connection.smismember(self.key(user_id), item_ids)
+        except redis.ConnectionError:
+            return item_ids
+        return self.unwatched(item_ids, watched)
+
+    def filter_in_pipeline(self, pipe, user_id, item_ids):
+        """
+        Добавляет проверку кандидатов в чужой pipeline, чтобы она шла в том же round-trip,
+        что и остальные чтения. Ответ pipeline на эту команду разбирает ``unwatched``.
+        """
+        # SMISMEMBER требует хотя бы одного кандидата, пустая строка не бывает id фильма
+        pipe.smismember(self.key(user_id), item_ids or [''])
+
+    def diff_in_pipeline(self, pipe, user_id, key):
+        """
+        Добавляет в чужой pipeline чтение sorted set ``key`` без просмотренных пользователем
+        фильмов. Кандидаты вычитаются на стороне Redis, поэтому их не нужно читать заранее.
+        Ответ - оставшиеся id в порядке score.
+        """
+        pipe.zdiff([key, self.key(user_id)])
+
+    @staticmethod
+    def unwatched(item_ids, watched):
+        """
+        :param watched: SMISMEMBER reply for item_ids
+        """
+        return [item_id for item_id, is_watched in zip(item_ids, watched) if not is_watched]
+
+    async def remove_all(self):
         try:
-            self.redis_connection.delete('*')
-        except redis.exceptions.ConnectionError:
+            keys = [key async for key in self.redis_connection.scan_iter(match=self.key('*'), count=1000)]
+            for start in range(0, len(keys), 1000):
+                await self.redis_connection.unlink(*keys[start:start + 1000])
+        except redis.ConnectionError:
             # ignore errors if redis unavailable
             pass
@@ -1,88 +1,128 @@
 import os
+import asyncio
+import logging
+import random
+from contextlib import asynccontextmanager
 from typing import Optional
 import uuid
 
-import polars as pl
+import httpx
+import numpy as np
 
-import requests
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi import FastAPI, Response, Request, Cookie
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from fastapi import FastAPI, Request, Cookie
 from fastapi.templating import Jinja2Templates
 
-from s3_connect import download_static_images_arch
+from catalogue import CATALOGUE_PATH, Catalogue, build as build_catalogue, imdb_url
+from circuit_breaker import CircuitBreaker
+from instrumentation import instrument_app, track_call
+from s3_connect import download_static_images_arch, make_variants
 
 
 IMAGE_PATH = './static/images'
-if not os.path.exists(IMAGE_PATH):
+# недокачанный или нераспакованный архив остается рядом, тогда загрузка продолжается
+if not os.path.exists(IMAGE_PATH) or any(
+        os.path.exists(os.path.join('static', name)) for name in ('.images.zip', '.images.zip.part')):
     download_static_images_arch('static')
 
-templates = Jinja2Templates(directory="templates")
+# уменьшенные webp-копии постеров для сетки, включаются GRID_IMAGE_WIDTH (нужен Pillow)
+GRID_IMAGE_WIDTH = int(os.environ.get('GRID_IMAGE_WIDTH', 0))
+GRID_IMAGE_PATH = './static/grid'
+image_dir, image_extension = 'images', 'jpg'
+if GRID_IMAGE_WIDTH:
+    try:
+        make_variants(IMAGE_PATH, GRID_IMAGE_PATH, width=GRID_IMAGE_WIDTH)
+        image_dir, image_extension = 'grid', 'webp'
+    except ImportError as e:
+        logging.warning(f'serving original images: {e}')
 
-app = FastAPI(title='Recommendation')
-    
-app.mount(
-    "/static",
-    StaticFiles(directory=os.path.join(os.getcwd(), "static")),
-    name="static",
-)
-# app.secret_key = os.urandom(24)
+templates = Jinja2Templates(directory="templates")
 
 recommendation_service_url = os.environ.get('RECSYS_SERVICE_URL')
-print(recommendation_service_url)
 interactions_url = os.environ.get('SERVICE_API_URL')
 
-links_data = (
-    pl.read_csv('static/links.csv')
-    .with_columns(pl.col('movieId').cast(pl.Utf8))
-)
-movies_data = (
-    pl.read_csv('static/movies.csv')
-    .with_columns(pl.col('movieId').cast(pl.Utf8))
-)
+# сервис рекомендаций должен отвечать быстро, иначе страница показывает популярное
+RECS_TIMEOUT = float(os.environ.get('RECS_TIMEOUT', 0.5))
+POPULAR_REFRESH_INTERVAL = 60
+
+# один клиент на процесс: keep-alive соединения переиспользуются между запросами
+http_client: httpx.AsyncClient = None
+recs_breaker = CircuitBreaker(failure_threshold=5, reset_timeout=10)
+# локальный fallback, пока сервис рекомендаций недоступен
+popular_item_ids = []
+
+
+async def refresh_popular():
+    global popular_item_ids
+    while True:
+        try:
+            with track_call('recs', 'popular'):
+                response = await http_client.get('/popular')
+                response.raise_for_status()
+            if response.json()['item_ids']:
+                popular_item_ids = response.json()['item_ids']
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            logging.warning(f'failed to refresh popular items: {e!r}')
+        await asyncio.sleep(POPULAR_REFRESH_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    http_client = httpx.AsyncClient(
+        base_url=recommendation_service_url,
+        timeout=httpx.Timeout(RECS_TIMEOUT, connect=0.2),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    )
+    refresher = asyncio.create_task(refresh_popular())
+    yield
+    refresher.cancel()
+    await http_client.aclose()
 
 
-def imdb_url(imdb_id):
-    imdb_id = str(imdb_id)
-    return 'https://www.imdb.com/title/tt' + '0' * (7 - len(imdb_id)) + imdb_id
+app = FastAPI(title='Recommendation', lifespan=lifespan)
+instrument_app(app)
 
+app.mount(
+    "/static",
+    StaticFiles(directory=os.path.join(os.getcwd(), "static")),
+    name="static",
+)
+# app.secret_key = os.urandom(24)
 
-movie_id_title = {
-    movie_id: title
-    for movie_id, title in movies_data.select('movieId', 'title').rows()
-}
-movie_id_imdb = {
-    movie_id: imdb_url(imdb_id)
-    for movie_id, imdb_id in links_data.select('movieId', 'imdbId').rows()
-}
+# каталог собирает сервис catalogue, для локального запуска собираем его сами
+if not os.path.exists(CATALOGUE_PATH):
+    os.makedirs(os.path.dirname(CATALOGUE_PATH), exist_ok=True)
+    build_catalogue('static/movies.csv', 'static/links.csv', CATALOGUE_PATH)
+catalogue = Catalogue(CATALOGUE_PATH)
+# фильмы без названия на странице не показываются
+catalogue_item_ids = catalogue.item_ids[np.diff(catalogue.title_offsets) > 0].astype(str).tolist()
 # отображаем только топ-12 рекомендаций
 TOP_K = 12
 
 
 @app.get('/healthcheck')
 def health_check():
-    return {"status": "healthy"}
+    return {"status": "healthy", "recs_circuit": recs_breaker.health()}
 
 
 @app.get('/get_all_items')
-def get_all_items():
-    return set([str(i) for i in movie_id_imdb.keys()])
+def get_all_items(format: str = 'json'):
+    """
+    :param format: json - list of ints, binary - little-endian int64 array
+    """
+    if format == 'binary':
+        return Response(catalogue.item_ids.astype('<i8').tobytes(), media_type='application/octet-stream')
+    return JSONResponse(catalogue.item_ids.tolist())
 
 @app.get('/', response_class=HTMLResponse)
 async def index(request: Request):
-    print(recommendation_service_url)
     # если передан идентификатор пользователя, используем его
     user_id = get_user_id_from_cookies(request)
 
     # получить рекомендации через api модели
-    recommendations_url = f"{recommendation_service_url}/recs/{user_id}"
-    response = requests.get(recommendations_url)
-
-    if response.status_code == 200:
-        recommended_item_ids = response.json()['item_ids']
-    else:
-        # тут можно сделать fallback на стороне фронтенда
-        recommended_item_ids = []
+    recommended_item_ids = await get_recommendations(user_id)
     items_data = fetch_items_data_for_item_ids(recommended_item_ids)
     response = templates.TemplateResponse(
         request=request,
@@ -99,17 +139,45 @@ async def index(request: Request):
         response.set_cookie(key="user_id", value=uuid.uuid4())
     return response
 
+async def get_recommendations(user_id):
+    """
+    :return: recommendations from the service or cached popular items if it is slow or unavailable
+    """
+    if recs_breaker.allow():
+        try:
+            with track_call('recs', 'recs'):
+                response = await http_client.get(f'/recs/{user_id}')
+                response.raise_for_status()
+            recs_breaker.record_success()
+            return response.json()['item_ids']
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            recs_breaker.record_failure()
+            logging.warning(f'recommendations unavailable: {e!r}')
+        except BaseException:
+            # отмена запроса или неожиданная ошибка тоже завершают вызов, иначе пробный
+            # вызов half-open так и остался бы незакрытым
+            recs_breaker.record_failure()
+            raise
+    if popular_item_ids:
+        return random.sample(popular_item_ids, min(len(popular_item_ids), 3 * TOP_K))
+    # популярное еще не загружено - показываем случайные фильмы из каталога
+    return random.sample(catalogue_item_ids, min(len(catalogue_item_ids), TOP_K))
+
+
 def get_user_id_from_cookies(request: Request) -> Optional[str]:
     return request.cookies.get("user_id")
 
 def fetch_items_data_for_item_ids(item_ids):
-    return [
-               {
-                   "item_id": item_id,
-                   "imdb_url": movie_id_imdb[item_id],
-                   "image_filename": f'{item_id}.jpg',
-                   "title": movie_id_title[item_id]
-               }
-               for item_id in item_ids
-               if item_id in movie_id_title
-           ][:TOP_K]
\ No newline at end of file
+    items_data = []
+    for item_id, position in zip(item_ids, catalogue.positions(item_ids)):
+        if position < 0 or not catalogue.title(position):
+            continue
+        items_data.append({
+            "item_id": item_id,
+            "imdb_url": imdb_url(catalogue.imdb_ids[position]),
+            "image_path": f'{image_dir}/{item_id}.{image_extension}',
+            "title": catalogue.title(position)
+        })
+        if len(items_data) == TOP_K:
+            break
+    return items_data
\ No newline at end of file